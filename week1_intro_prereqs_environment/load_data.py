@@ -1,32 +1,158 @@
 import sys
 import pandas as pd
-# For removing files from a directory
 import os
-# import shutil
 from sqlalchemy import create_engine
 import time
 # For named arguments like user, password, host, port, database, table, file locations, etc.
 import argparse
 # For checking if file exists
 from pathlib import Path
+# For the in-memory buffer used by COPY FROM STDIN
+import io
+# For the Arrow-backed compact dtypes
+import pyarrow as pa
 
+# The download cache and adaptive chunk sizes are shared with the week4 loaders, so both behave the same
+#   - In the Docker image, those modules are copied in and put on the PYTHONPATH (see the Dockerfile)
+#   - When run from the repo, they're imported from week4_analytics_engineering/ next to this directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "week4_analytics_engineering"))
+from download_cache import get_cache
+from adaptive_chunks import ChunkSizer
 
-def remove_files():
-    print("Removing files...")
-    ## https://stackoverflow.com/questions/32834731/how-to-delete-a-file-by-extension-in-python
-    dir_name = "./data"
-    local_data = os.listdir(dir_name)
 
-    ## Remove the local compressed and uncompressed CSV's
-    for item in local_data:
-        if item.endswith(".csv.gz"):
-            os.remove(os.path.join(dir_name, item))
-        elif item.endswith(".csv"):
-            os.remove(os.path.join(dir_name, item))
+def cached_download(url, cache_dir="./data/cache", max_bytes=5 * 1024 ** 3):
+    """
+    Download a file into the shared download cache (keyed by its URL + ETag), unless that version
+        is cached already, and return its path
+    """
+    return get_cache(cache_dir, max_bytes).get(url)
+
+
+# Pin the data types up front so each column comes out of read_csv() as ONE type
+#   - Nullable "Int64" for INTs that can have NAN values, and a proper string type for
+#     store_and_fwd_flag (otherwise it's a mix of str's and float NaN's)
+# https://pandas.pydata.org/pandas-docs/stable/user_guide/integer_na.html#integer-na
+# https://stackoverflow.com/questions/24251219/pandas-read-csv-low-memory-and-dtype-options
+taxi_dtypes = {
+    "VendorID": pd.Int64Dtype(),
+    "passenger_count": pd.Int64Dtype(),
+    "trip_distance": float,
+    "RatecodeID": pd.Int64Dtype(),
+    "store_and_fwd_flag": pd.StringDtype(),
+    "PULocationID": pd.Int64Dtype(),
+    "DOLocationID": pd.Int64Dtype(),
+    "payment_type": pd.Int64Dtype(),
+    "fare_amount": float,
+    "extra": float,
+    "mta_tax": float,
+    "tip_amount": float,
+    "tolls_amount": float,
+    "improvement_surcharge": float,
+    "total_amount": float,
+    "congestion_surcharge": float
+}
+# With --compact, the smallest types that still hold every value (read with dtype_backend="pyarrow"):
+#   - Arrow-backed int8/int16 for the IDs and codes, and a categorical for the Y/N flag
+#   - to_sql() still creates the same BIGINT/TEXT columns for them, and COPY gets the same values
+compact_taxi_dtypes = {
+    "VendorID": pd.ArrowDtype(pa.int8()),
+    "passenger_count": pd.ArrowDtype(pa.int16()),
+    "RatecodeID": pd.ArrowDtype(pa.int16()),
+    "store_and_fwd_flag": "category",
+    "PULocationID": pd.ArrowDtype(pa.int16()),
+    "DOLocationID": pd.ArrowDtype(pa.int16()),
+    "payment_type": pd.ArrowDtype(pa.int8())
+}
+taxi_parse_dates = ["tpep_pickup_datetime", "tpep_dropoff_datetime"]
+taxi_date_format = "%Y-%m-%d %H:%M:%S"
+
+
+def check_column_types(df, strict=False):
+    """
+    Find columns that still hold a mix of Python types (e.g. str's and float NaN's)
+
+    Only "object" columns can be mixed, and pandas' infer_dtype() checks each of them in
+    Cython instead of calling type() on every cell like df[col].apply(type).unique() did
+    https://pandas.pydata.org/docs/reference/api/pandas.api.types.infer_dtype.html
+
+    In strict mode, raise a TypeError naming each mixed column and the file row offsets
+    of the values that don't match the column's most common type
+    """
+    mixed = [col for col in df.columns
+             if df[col].dtype == object and pd.api.types.infer_dtype(df[col], skipna=False).startswith("mixed")]
+
+    if mixed and strict:
+        problems = []
+        for col in mixed:
+            # Only done for columns that are already known to be mixed
+            types = df[col].map(type)
+            offenders = df.index[types != types.mode()[0]]
+            problems.append(f"{col} (rows {list(offenders[:10])}{' ...' if len(offenders) > 10 else ''})")
+        raise TypeError("Mixed data types in column(s): " + ", ".join(problems))
+
+    return mixed
+
+
+def memory_report(df, dtypes):
+    """Print the memory of each column of a chunk as read vs. cast to the given (default) dtypes"""
+    before = df.astype({col: dtype for col, dtype in dtypes.items() if col in df.columns}).memory_usage(index=False, deep=True)
+    after = df.memory_usage(index=False, deep=True)
+
+    print("Memory per column (MB), default vs. compact dtypes:")
+    for col in df.columns:
+        print(f"  {col:<24} {before[col] / 1024 ** 2:>8.2f} {after[col] / 1024 ** 2:>8.2f}  {df[col].dtype}")
+    print(f"  {'TOTAL':<24} {before.sum() / 1024 ** 2:>8.2f} {after.sum() / 1024 ** 2:>8.2f}"
+          f"  ({len(df)} rows, {after.sum() / len(df):.0f} bytes/row)")
 
-    # ## Remove all other the local files in the "data" directory
-    # ## https://stackoverflow.com/questions/48892772/how-to-remove-a-directory-is-os-removedirs-and-os-rmdir-only-used-to-delete-emp
-    # shutil.rmtree("./data/")
+
+def copy_from_df(df, table_name, engine):
+    """
+    Append a DataFrame to an existing Postgres table via COPY FROM STDIN (CSV format)
+
+    Returns the load method that was used: "insert" (to_sql()) if the engine's driver isn't
+    psycopg2, which is the only one with copy_expert()
+    """
+    # Stream the chunk through the raw psycopg2 connection underneath the SQLAlchemy engine
+    raw_conn = engine.raw_connection()
+    try:
+        cursor = raw_conn.cursor()
+        if not hasattr(cursor, "copy_expert"):
+            print("COPY FROM STDIN needs a psycopg2 connection, falling back to to_sql()...")
+            df.to_sql(name=table_name, con=engine, if_exists="append")
+            return "insert"
+
+        # Match the columns to_sql() creates, including its default "index" column
+        columns = ", ".join(f'"{column}"' for column in [df.index.name or "index"] + list(df.columns))
+
+        # Write the chunk to an in-memory CSV buffer (NaN's become empty strings, which COPY reads as NULL)
+        # https://www.postgresql.org/docs/current/sql-copy.html
+        buffer = io.StringIO()
+        df.to_csv(buffer, header=False)
+        buffer.seek(0)
+
+        cursor.copy_expert(f'COPY "{table_name}" ({columns}) FROM STDIN WITH (FORMAT CSV)', buffer)
+        raw_conn.commit()
+    except Exception:
+        raw_conn.rollback()
+        raise
+    finally:
+        raw_conn.close()
+
+    return "copy"
+
+
+def insert_chunk(df, table_name, engine, load_method):
+    """Append a chunk with COPY or to_sql() and report the rows/sec"""
+    start = time.time()
+
+    if load_method == "copy":
+        load_method = copy_from_df(df, table_name, engine)
+    else:
+        df.to_sql(name=table_name, con=engine, if_exists="append")
+
+    end = time.time()
+    print("Inserted %d rows via %s in %.3f seconds (%.0f rows/sec)."
+          % (len(df), load_method, end - start, len(df) / max(end - start, 1e-9)))
 
 
 def main(args):
@@ -42,26 +168,28 @@ def main(args):
     yellow_taxi_url = args.yellow_taxi_url
     zones_table_name = args.zones_table_name
     zones_url = args.zones_url
+    load_method = args.load_method
+    strict = args.strict
+    chunksize = args.chunksize
+    # Without a fixed --chunksize, size each chunk from the rows/sec and memory of the last ones
+    sizer = ChunkSizer(max_rss_bytes=int(args.max_memory_mb * 1024 ** 2), max_chunk_seconds=args.max_chunk_seconds,
+                       name=os.path.basename(args.yellow_taxi_url))
 
-    # Make the directory to hold the file if it doesn't exist
-    os.makedirs(os.path.dirname(f"./data/"), exist_ok=True)
+    def next_chunk():
+        """Read the next chunk, and time it from here until it's inserted"""
+        next_chunk.start = time.time()
+        return df_iter.get_chunk(chunksize or sizer.rows)
 
-    # Download the data via Unix-based GNU command "wget"    
-    taxi_csv_name = "./data/yellow_tripdata_2021-01.csv"
-    taxi_file = Path(taxi_csv_name)
-    
-    # If the file is not already downloaded/does not exist, download it
-    if not taxi_file.is_file():
-        print("Downloading the taxi data...")
-        os.system(f"wget {yellow_taxi_url} -O {taxi_csv_name}")  # -O = output to the given file name
+    def chunk_inserted(df):
+        if not chunksize:
+            sizer.record(len(df), time.time() - next_chunk.start, df.memory_usage(index=False, deep=True).sum())
 
-    zones_csv_name = "./data/taxi_zone_lookup.csv"
-    zones_file = Path(zones_csv_name)
+    # Download the data, unless this version of it is in the download cache already
+    print("Downloading the taxi data...")
+    taxi_csv_name = cached_download(yellow_taxi_url, args.cache_dir, int(args.cache_max_gb * 1024 ** 3))
 
-    # If the file is not already downloaded/does not exist, download it
-    if not zones_file.is_file():
-        print("\nDownloading the taxi zone data...")
-        os.system(f"wget {zones_url} -O {zones_csv_name}")  # -O = output to the given file name
+    print("\nDownloading the taxi zone data...")
+    zones_csv_name = cached_download(zones_url, args.cache_dir, int(args.cache_max_gb * 1024 ** 3))
 
     # # TEST: Check for mixed data type columns
     # # https://stackoverflow.com/questions/29376026/find-mixed-types-in-pandas-columns
@@ -85,7 +213,8 @@ def main(args):
     # Need to convert this DDL statement into something Postgres will understand using
     #   the sqlalchemy library's "create_engine" function
     # create_engine([database_type]://[user]:[password]@[hostname]:[port]/[database], con=[engine])
-    engine = create_engine(f"postgresql://{user}:{password}@{host}:{port}/{database}")
+    #   - "+psycopg2" since COPY goes through psycopg2's copy_expert() (SQLAlchemy 2.1 defaults to psycopg 3)
+    engine = create_engine(f"postgresql+psycopg2://{user}:{password}@{host}:{port}/{database}")
     print(engine.connect())
 
     # # Convert the dataframe into a Data Definition Language (DDL) statement in order
@@ -102,15 +231,28 @@ def main(args):
 
     print("\nLoading in taxi data in chunks...")
     # Chunk dataset into smaller sizes to load into the database via the "chunksize" arg
-    df_iter = pd.read_csv(taxi_csv_name, compression="gzip", iterator=True, chunksize=100000)
+    #   - Also pin the data types and parse the meter engaged and meter disengaged columns
+    #     from text to dates while reading, instead of fixing each chunk afterwards
+    #   - The chunks are sized adaptively (unless --chunksize is given), and with --compact each
+    #     row takes about half the memory, so they can grow bigger
+    if args.compact:
+        read_kwargs = {"dtype": {**taxi_dtypes, **compact_taxi_dtypes}, "dtype_backend": "pyarrow"}
+    else:
+        read_kwargs = {"dtype": taxi_dtypes}
+    df_iter = pd.read_csv(taxi_csv_name, compression="gzip", iterator=True,
+                          parse_dates=taxi_parse_dates, date_format=taxi_date_format, **read_kwargs)
     
     # Return the next item in an iterator object with the "next()" function
-    df = next(df_iter)
+    df = next_chunk()
     # print(len(df))
+    if args.compact:
+        memory_report(df, taxi_dtypes)
 
-    # Convert meter engaged and meter disengaged columns from text to dates
-    df.tpep_pickup_datetime = pd.to_datetime(df.tpep_pickup_datetime)
-    df.tpep_dropoff_datetime = pd.to_datetime(df.tpep_dropoff_datetime)
+    # Check for mixed data type columns
+    mixed = check_column_types(df, strict=strict)
+    if mixed:
+        print(f"Fixing mixed data types in {mixed}...")
+        df = df.astype({col: pd.StringDtype() for col in mixed})
 
     # Get the header/column names from the dataset via the 0-indexed row
     header = df.head(n=0)
@@ -124,10 +266,9 @@ def main(args):
     ## CAN NOW SEE THE EMPTY TABLE IN pgcli and inspect it via `\d yellow_taxi_data`
 
     # Add (append) first chunk of data to the table and time how long it takes
-    start = time.time()
-    df.to_sql(name=yellow_taxi_table_name, con=engine, if_exists="append")
-    end = time.time()
-    print("Time to insert first chunk: in %.3f seconds." % (end - start))
+    print("Inserting first chunk...")
+    insert_chunk(df, yellow_taxi_table_name, engine, load_method)
+    chunk_inserted(df)
 
     # Create function to use when looping through chunks to load
     def load_chunks(df):
@@ -135,49 +276,34 @@ def main(args):
             print("Loading next chunk...")
             start = time.time()
 
-            # Get next 100,000 row chunk
-            df = next(df_iter)
+            # Get next chunk (of --chunksize rows, or the adaptive size)
+            df = next_chunk()
 
-            # Check for mixed data type columns
+            # Check for mixed data type columns (the dtypes are pinned when reading,
+            #   so this should only ever find columns that aren't in taxi_dtypes)
             # https://stackoverflow.com/questions/29376026/find-mixed-types-in-pandas-columns
-            mixed = False
-            for col in df.columns:
-                # weird = (df[[col]].applymap(type) != df[[col]].iloc[0].apply(type)).any(axis=1)
-                # if len(df[weird]) > 0:
-                #     print(col)  # store_and_fwd_flag
-                unique_types = df[col].apply(type).unique()
-                if len(unique_types) > 1:
-                    mixed = True
-                    # print(col, unique_types, df[col].unique())
-
-            # Fix datetimes again
-            df.tpep_pickup_datetime = pd.to_datetime(df.tpep_pickup_datetime)
-            df.tpep_dropoff_datetime = pd.to_datetime(df.tpep_dropoff_datetime)
-
-            # Fix fields that have NAN values
-            # https://pandas.pydata.org/pandas-docs/stable/user_guide/integer_na.html#integer-na
+            mixed = check_column_types(df, strict=strict)
             if mixed:
-                print("Fixing column data types...")
-                # df.VendorID = pd.array(df.VendorID, dtype=pd.Int64Dtype())
-                # df.passenger_count = pd.array(df.passenger_count, dtype=pd.Int64Dtype())
-                # df.payment_type = pd.array(df.payment_type, dtype=pd.Int64Dtype())
-                # df.RatecodeID = pd.array(df.RatecodeID, dtype=pd.Int64Dtype())
-                df.store_and_fwd_flag = pd.array(df.store_and_fwd_flag, dtype=pd.StringDtype())
+                print(f"Fixing mixed data types in {mixed}...")
+                df = df.astype({col: pd.StringDtype() for col in mixed})
 
             # Append current chunk to Postgres table
-            df.to_sql(name=yellow_taxi_table_name, con=engine, if_exists="append")
+            insert_chunk(df, yellow_taxi_table_name, engine, load_method)
+            chunk_inserted(df)
 
             end = time.time()
 
             print("Inserted next chunk in %.3f seconds." % (end - start))
 
-        except:
+        except StopIteration:
             # Program will come to this clause when it throws an error after
             #   running out of data chunks
             print("All data chunks loaded.")
+            if sizer.history:
+                print(f"Adaptive chunk sizes for {sizer.summary()}")
 
-            # Remove all downloaded data files to free up space on machine
-            remove_files()
+            # The downloaded files stay in the cache for the next run (which then doesn't download them again)
+            get_cache().report()
 
             # Exit with code of 1 (an error occured)
             # NOTE: quit() is only intended to work in the interactive Python shell
@@ -205,6 +331,21 @@ if __name__ == "__main__":
     parser.add_argument("--yellow_taxi_url", help="URL of the Yellow Taxi CSV file")
     parser.add_argument("--zones_table_name", help="Name of table to write the taxi zones to")
     parser.add_argument("--zones_url", help="URL of the Taxi zones data")
+    parser.add_argument("--load_method", choices=["copy", "insert"], default="copy",
+                        help="Load chunks via COPY FROM STDIN (default) or via to_sql() INSERTs")
+    parser.add_argument("--strict", action="store_true",
+                        help="Stop with the offending columns and row offsets if a column has mixed data types")
+    parser.add_argument("--chunksize", type=int, default=None,
+                        help="Fixed number of rows to read and insert at a time (default: sized adaptively)")
+    parser.add_argument("--max_memory_mb", type=float, default=1536,
+                        help="RSS the adaptive chunk sizes must stay under (e.g. the container's memory limit)")
+    parser.add_argument("--max_chunk_seconds", type=float, default=30,
+                        help="Longest the adaptive chunk sizes may take to read and insert")
+    parser.add_argument("--compact", action="store_true",
+                        help="Read the IDs/codes/flag into compact Arrow-backed dtypes, about halving each chunk's memory")
+    parser.add_argument("--cache_dir", default="./data/cache", help="Directory to cache the downloaded files in")
+    parser.add_argument("--cache_max_gb", type=float, default=5,
+                        help="Size of the download cache, after which the least recently used files are deleted")
 
     # Gather all the args we just made
     args = parser.parse_args()
@@ -227,5 +368,6 @@ if __name__ == "__main__":
     --yellow_taxi_table_name=yellow_taxi_data \
     --yellow_taxi_url=${URL1} \
     --zones_table_name=zones \
-    --zones_url=${URL2}
+    --zones_url=${URL2} \
+    --load_method=copy
     """    
@@ -1,7 +1,7 @@
 # import io
 import os
+import sys
 import requests
-import pandas as pd
 from google.cloud import storage
 from config import gcloud_creds, bucket_name
 from pathlib import Path
@@ -10,7 +10,9 @@ from pathlib import Path
 # For Parquet manipulation
 import pyarrow as pa
 import pyarrow.parquet as pq
-import pyarrow.compute as pc
+## For the per-service schema the week4 loaders clean their Arrow batches with
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'week4_analytics_engineering'))
+from taxi_schema import clean_batch
 
 '''
 Pre-reqs: 
@@ -19,6 +21,8 @@ Pre-reqs:
     - Or import from a `config.py` file
 3. Set GCP_GCS_BUCKET as your bucket or change default value of BUCKET
     - Or import from a `config.py` file
+4. Keep the repo's `week4_analytics_engineering/` directory next to `week3_data_warehouse/`
+    - The batches are cleaned with week4's `taxi_schema.clean_batch()`, imported from there
 '''
 
 
@@ -67,34 +71,6 @@ def remove_files():
     # shutil.rmtree('./data/')
 
 
-def clean_data(df, service):
-    '''Fix datatype issues'''
-
-    if service == 'yellow':           
-        ## Rename columns to be better suited for a database/data warehouse table
-        df.rename({'VendorID':'vendor_id',
-                   'PULocationID':'pu_location_id',
-                   'DOLocationID':'do_location_id',
-                   'RatecodeID':'rate_code_id'
-                },
-            axis='columns', inplace=True
-        )
-        
-        ## Fix datetimes
-        df.tpep_pickup_datetime = pd.to_datetime(df.tpep_pickup_datetime)
-        df.tpep_dropoff_datetime = pd.to_datetime(df.tpep_dropoff_datetime)
-
-        ## This fixes fields for files that have NAN values and thus aren't INTs
-        ##   when they should be INTs
-        ## https://pandas.pydata.org/pandas-docs/stable/user_guide/integer_na.html#integer-na
-        df.vendor_id = pd.array(df.vendor_id, dtype=pd.Int64Dtype())
-        df.passenger_count = pd.array(df.passenger_count, dtype=pd.Int64Dtype())
-        df.payment_type = pd.array(df.payment_type, dtype=pd.Int64Dtype())
-        df.rate_code_id = pd.array(df.rate_code_id, dtype=pd.Int64Dtype())
-
-    return df
-
-
 def web_to_gcs(year, service, gcs_bucket):
 
     ## Loop through the months
@@ -125,16 +101,29 @@ def web_to_gcs(year, service, gcs_bucket):
         r = requests.get(request_url)
         open(f'./data/{file_name}', 'wb').write(r.content)
 
-        ## Read in the table to a table, then into a DataFrame
-        table = pq.read_table(f'./data/{file_name}')
-        df = table.to_pandas()
-
-        ## Clean the data and fix the data types
+        ## Stream the file one record batch at a time, cleaning each batch with Arrow compute
+        ##      kernels and writing it straight back out as a Parquet row group, so the month is
+        ##      never fully loaded into memory (or converted to pandas)
         print(f'Cleaning {path}...')
-        df = clean_data(df, service)
-
-        ## Read DataFrame into a Parquet file using `pyarrow` engine
-        df.to_parquet(f'./data/{file_name}', engine='pyarrow')
+        parquet_file = pq.ParquetFile(path)
+        clean_path = f'./data/clean_{file_name}'
+        writer = None
+        try:
+            for batch in parquet_file.iter_batches(batch_size=100000):
+                batch = clean_batch(batch, service)
+                if writer is None:
+                    writer = pq.ParquetWriter(clean_path, batch.schema)
+                writer.write_batch(batch)
+            if writer is None:
+                ## No rows at all, so write an empty file with the cleaned schema
+                empty = clean_batch(pa.RecordBatch.from_pylist([], schema=parquet_file.schema_arrow), service)
+                writer = pq.ParquetWriter(clean_path, empty.schema)
+        finally:
+            if writer is not None:
+                writer.close()
+
+        ## Replace the downloaded file with the cleaned one
+        os.replace(clean_path, path)
         
         ## Upload the resulting Parquet file to the GCS Bucket, whilst
         ##      creating a `data/` directory in GCS
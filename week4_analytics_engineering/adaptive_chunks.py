@@ -0,0 +1,129 @@
+## For measuring each chunk's wall time and the process' memory
+import os
+import resource
+import time
+
+'''
+Adaptive chunk sizing for the chunked CSV loaders, instead of a fixed `chunksize=100000`.
+
+The green, yellow and FHV files have very different widths (20 vs 18 vs 7 columns, with
+different mixes of strings and numbers), so a chunk size that suits one is too small or too big
+for the others. `ChunkSizer` starts small and, after each chunk, measures:
+    - rows/sec of the whole read -> clean -> load cycle of the chunk
+    - the chunk's bytes per row (`memory_usage(deep=True)`) and the process' current RSS
+and picks the next chunk size:
+    - grows it by `growth` while rows/sec keeps improving, stepping back to the best size so far
+        once a bigger chunk turns out slower
+    - never above what fits in `max_rss_bytes` (with `overhead` copies of each chunk in memory at
+        once: parsed, cleaned and its COPY buffer), or than what takes longer than
+        `max_chunk_seconds` (how much work a failed chunk throws away)
+    - halves it whenever the RSS is already over `max_rss_bytes`
+    - always within [`min_rows`, `max_rows`]
+Every change of size is printed, and `summary()` gives the sizes used for the run log.
+
+`iter_adaptive_chunks()` drives a `pd.read_csv(..., iterator=True)` reader with it, since
+`TextFileReader.get_chunk(rows)` can read a different number of rows each time.
+'''
+
+
+def current_rss():
+    '''Resident set size of this process in bytes (the peak RSS where /proc isn't available)'''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        ## Reported in KB on Linux (and bytes on macOS, which is close enough for a bound)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class ChunkSizer:
+    '''Picks the number of rows of each chunk from the measured throughput and memory of the last ones'''
+
+    def __init__(self, initial_rows=25000, min_rows=10000, max_rows=2000000, max_rss_bytes=1536 * 1024 ** 2,
+                 max_chunk_seconds=30.0, growth=2.0, overhead=3.0, name=''):
+        self.rows = initial_rows
+        self.min_rows = min_rows
+        self.max_rows = max_rows
+        self.max_rss_bytes = max_rss_bytes
+        self.max_chunk_seconds = max_chunk_seconds
+        self.growth = growth
+        self.overhead = overhead
+        self.name = name
+        self.settled = False
+        self.best_rows, self.best_rate = None, 0.0
+        ## (rows, seconds, bytes per row, rss) of every chunk so far
+        self.history = []
+
+    def record(self, rows, seconds, chunk_bytes):
+        '''Measure one finished chunk and pick the size of the next one'''
+        rss = current_rss()
+        self.history.append((rows, seconds, chunk_bytes / max(rows, 1), rss))
+        if rows == 0:
+            return self.rows
+
+        rate = rows / max(seconds, 1e-9)
+        bytes_per_row = chunk_bytes / rows
+
+        ## Hill-climb on rows/sec: keep growing while it improves, go back to the best size once it doesn't
+        if rate > self.best_rate:
+            self.best_rows, self.best_rate = rows, rate
+            target = rows if self.settled else int(rows * self.growth)
+        else:
+            self.settled = True
+            target = self.best_rows
+
+        ## Stay within the memory and latency bounds
+        if rss > self.max_rss_bytes:
+            target = min(target, rows // 2)
+            self.settled = False
+            self.best_rows, self.best_rate = None, 0.0
+        else:
+            target = min(target, int((self.max_rss_bytes - rss) / (bytes_per_row * self.overhead)))
+        target = min(target, int(self.max_chunk_seconds * rate))
+        target = max(self.min_rows, min(self.max_rows, target))
+
+        ## A partial last chunk doesn't mean smaller chunks would be faster
+        if target != self.rows and rows >= self.rows:
+            print(f'{self.name} chunk size {self.rows} -> {target} rows '
+                  f'(%.0f rows/sec, %.0f bytes/row, RSS %.0f MB)' % (rate, bytes_per_row, rss / 1024 ** 2))
+            self.rows = target
+
+        return self.rows
+
+    def summary(self):
+        '''One line for the run log: the chunk sizes used, and the rows/sec and peak RSS measured'''
+        sizes = [rows for rows, _, _, _ in self.history]
+        if not sizes:
+            return f'{self.name}: no chunks'
+        rows = sum(sizes)
+        seconds = sum(seconds for _, seconds, _, _ in self.history)
+        peak_rss = max(rss for _, _, _, rss in self.history)
+        return (f'{self.name}: {len(sizes)} chunks of {min(sizes)}-{max(sizes)} rows (settled on {self.rows}), '
+                f'%.0f rows/sec, peak RSS %.0f MB' % (rows / max(seconds, 1e-9), peak_rss / 1024 ** 2))
+
+
+def iter_adaptive_chunks(reader, sizer, transform=None):
+    '''
+    Yield chunks of a `pd.read_csv(..., iterator=True)` reader (optionally transformed, e.g. cleaned),
+        sized by `sizer`, timing each chunk from its read until the caller asks for the next one,
+        so the caller's load of the chunk is measured too
+    '''
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                df = reader.get_chunk(sizer.rows)
+            except StopIteration:
+                break
+            if transform is not None:
+                df = transform(df)
+            chunk_bytes = int(df.memory_usage(index=False, deep=True).sum())
+            rows = len(df.index)
+            yield df
+            ## Drop our reference before measuring RSS, so only the caller's copies count
+            del df
+            sizer.record(rows, time.perf_counter() - start, chunk_bytes)
+    finally:
+        reader.close()
+        if sizer.history:
+            print(f'Adaptive chunk sizes for {sizer.summary()}')
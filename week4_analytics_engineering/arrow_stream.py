@@ -0,0 +1,80 @@
+import pandas as pd
+## For Parquet manipulation
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.compute as pc
+## For the shared per-service schema, applied with Arrow compute kernels
+from taxi_schema import clean_batch
+
+'''
+Arrow-native streaming for the monthly Parquet files.
+
+`pq.read_table(...).to_pandas()` materializes the whole month twice (once as Arrow,
+once as pandas). Here we iterate the file's record batches with `ParquetFile.iter_batches()`,
+apply the same schema as `clean_data()` with Arrow compute kernels (`clean_batch()`), and
+hand each batch straight to a sink (Postgres COPY or a Parquet writer), so memory stays at
+about one batch no matter how big the file is.
+'''
+
+
+def iter_clean_batches(path, service, batch_size=100000):
+    '''Yield cleaned RecordBatches of a Parquet file, reading one batch at a time'''
+    parquet_file = pq.ParquetFile(path)
+
+    for batch in parquet_file.iter_batches(batch_size=batch_size):
+        ## NOTE: one FHV file has an out-of-bounds timestamp, drop it like the pandas path does
+        ## https://stackoverflow.com/questions/74467923/pandas-read-parquet-error-pyarrow-lib-arrowinvalid-casting-from-timestampus
+        if service == 'fhv':
+            batch = batch.filter(
+                pc.less_equal(batch.column('dropOff_datetime'), pa.scalar(pd.Timestamp.max))
+            )
+
+        yield clean_batch(batch, service)
+
+
+def write_batches(batches, path, row_group_size=None, schema=None, **writer_kwargs):
+    '''
+    Write a stream of RecordBatches to a Parquet file one row group at a time, returning the row count
+        - `path` can also be a writable file-like object, e.g. a stream to an object store
+        - With `row_group_size`, batches are buffered until there are that many rows for a row group
+          (so that's also about how much of the data is held in memory), otherwise each batch is one
+        - `writer_kwargs` go to the `ParquetWriter` (e.g. from `parquet_profiles.writer_options()`)
+        - Without any batches there's no schema to write, so nothing is written at all (not even an
+          empty file), unless a `schema` is given for an empty file
+    '''
+    rows = 0
+    writer = None
+    pending = []
+    pending_rows = 0
+
+    def write_group(table):
+        writer.write_table(table, row_group_size=max(table.num_rows, 1))
+
+    try:
+        for batch in batches:
+            if writer is None:
+                writer = pq.ParquetWriter(path, batch.schema, **writer_kwargs)
+            rows += batch.num_rows
+            if row_group_size is None:
+                write_group(pa.Table.from_batches([batch]))
+                continue
+
+            pending.append(batch)
+            pending_rows += batch.num_rows
+            if pending_rows >= row_group_size:
+                ## Write as many full row groups as we have, and keep the rest for the next one
+                table = pa.Table.from_batches(pending)
+                full = pending_rows - pending_rows % row_group_size
+                for start in range(0, full, row_group_size):
+                    write_group(table.slice(start, row_group_size))
+                pending = table.slice(full).to_batches()
+                pending_rows -= full
+        if pending_rows:
+            write_group(pa.Table.from_batches(pending))
+        if writer is None and schema is not None:
+            writer = pq.ParquetWriter(path, schema, **writer_kwargs)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    return rows
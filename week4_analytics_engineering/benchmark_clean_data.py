@@ -0,0 +1,94 @@
+import time
+import numpy as np
+import pandas as pd
+from taxi_schema import clean_data
+
+'''
+Micro-benchmark of the schema-driven `taxi_schema.clean_data()` against the old per-loader
+`clean_data()` (per-column `pd.array(..., Int64Dtype())` casts and `pd.to_datetime()` without
+a format string), on a synthetic yellow taxi chunk with the raw CSV column names and dtypes.
+
+Run with `python benchmark_clean_data.py [rows] [repeats]`
+'''
+
+
+def legacy_clean_data(df, service='yellow'):
+    '''The yellow branch of the clean_data() that used to be copy-pasted into every loader'''
+    df.rename({'VendorID':'vendor_id',
+               'PULocationID':'pu_location_id',
+               'DOLocationID':'do_location_id',
+               'RatecodeID':'rate_code_id'
+            },
+        axis='columns', inplace=True
+    )
+    df.tpep_pickup_datetime = pd.to_datetime(df.tpep_pickup_datetime)
+    df.tpep_dropoff_datetime = pd.to_datetime(df.tpep_dropoff_datetime)
+    df.vendor_id = pd.array(df.vendor_id, dtype=pd.Int64Dtype())
+    df.passenger_count = pd.array(df.passenger_count, dtype=pd.Int64Dtype())
+    df.payment_type = pd.array(df.payment_type, dtype=pd.Int64Dtype())
+    df.rate_code_id = pd.array(df.rate_code_id, dtype=pd.Int64Dtype())
+    df.loc[df['payment_type'] == 0, 'payment_type'] = 6
+
+    return df
+
+
+def make_yellow_chunk(rows, seed=42):
+    '''A chunk shaped like `pd.read_csv()` of a yellow CSV without dtypes (NaN-able INTs come in as floats)'''
+    rng = np.random.default_rng(seed)
+    pickup = pd.Timestamp('2019-01-01') + pd.to_timedelta(rng.integers(0, 31 * 24 * 3600, rows), unit='s')
+    dropoff = pickup + pd.to_timedelta(rng.integers(60, 3600, rows), unit='s')
+
+    def nullable(values, null_fraction=0.01):
+        values = values.astype(float)
+        values[rng.random(rows) < null_fraction] = np.nan
+        return values
+
+    return pd.DataFrame({
+        'VendorID': nullable(rng.integers(1, 3, rows)),
+        'tpep_pickup_datetime': pickup.strftime('%Y-%m-%d %H:%M:%S'),
+        'tpep_dropoff_datetime': dropoff.strftime('%Y-%m-%d %H:%M:%S'),
+        'passenger_count': nullable(rng.integers(0, 7, rows)),
+        'trip_distance': rng.gamma(2.0, 1.5, rows).round(2),
+        'RatecodeID': nullable(rng.integers(1, 7, rows)),
+        'store_and_fwd_flag': rng.choice(['N', 'Y'], rows, p=[0.99, 0.01]),
+        'PULocationID': rng.integers(1, 266, rows),
+        'DOLocationID': rng.integers(1, 266, rows),
+        'payment_type': nullable(rng.integers(0, 5, rows)),
+        'fare_amount': rng.gamma(2.0, 6.0, rows).round(2),
+        'extra': rng.choice([0.0, 0.5, 1.0], rows),
+        'mta_tax': np.full(rows, 0.5),
+        'tip_amount': rng.gamma(1.0, 2.0, rows).round(2),
+        'tolls_amount': np.zeros(rows),
+        'improvement_surcharge': np.full(rows, 0.3),
+        'total_amount': rng.gamma(2.0, 8.0, rows).round(2),
+        'congestion_surcharge': rng.choice([0.0, 2.5], rows)
+    })
+
+
+def time_it(function, df, repeats):
+    '''Best wall time of `repeats` runs, each on a fresh copy of the chunk'''
+    best = float('inf')
+    for _ in range(repeats):
+        chunk = df.copy()
+        start = time.perf_counter()
+        result = function(chunk, 'yellow')
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+if __name__ == '__main__':
+    import sys
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    df = make_yellow_chunk(rows)
+    legacy_time, legacy = time_it(legacy_clean_data, df, repeats)
+    schema_time, schema = time_it(clean_data, df, repeats)
+
+    ## Same values either way (the schema version also pins the location IDs/amounts to their target dtypes)
+    same = legacy.astype(schema.dtypes.to_dict()).equals(schema)
+
+    print(f'clean_data() on {rows} yellow rows (best of {repeats}):')
+    print(f'  legacy per-column casts: %.3f seconds' % legacy_time)
+    print(f'  schema-driven:           %.3f seconds (%.1fx faster)' % (schema_time, legacy_time / schema_time))
+    print(f'  identical output: {same}')
@@ -0,0 +1,54 @@
+import io
+import os
+import time
+import pandas as pd
+from benchmark_clean_data import make_yellow_chunk
+from taxi_schema import clean_data, read_csv_kwargs, expand_data, memory_report
+
+'''
+Per-column memory of a cleaned chunk with the default dtypes vs `compact=True` (see
+`taxi_schema.compact_data()`), read through `pd.read_csv()` the same way the loaders do, and how
+many rows per chunk each fits in a memory budget (e.g. to pick `chunksize` for a 2 vCPU container).
+
+Run with `python benchmark_compact_dtypes.py [rows] [budget MB] [path to a .csv.gz] [service]`,
+which uses a synthetic yellow chunk when no file is given.
+'''
+
+
+def read_chunk(source, service, rows, compact):
+    '''Read and clean the first `rows` rows, returning the chunk and the time it took'''
+    if not os.path.exists(source):
+        source = io.StringIO(source)
+    start = time.perf_counter()
+    df = clean_data(pd.read_csv(source, nrows=rows, **read_csv_kwargs(service, compact)), service, compact)
+    return df, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    import sys
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    budget = float(sys.argv[2]) * 1024 ** 2 if len(sys.argv) > 2 else 512 * 1024 ** 2
+    service = sys.argv[4] if len(sys.argv) > 4 else 'yellow'
+    if len(sys.argv) > 3:
+        source = sys.argv[3]
+    else:
+        buffer = io.StringIO()
+        make_yellow_chunk(rows).to_csv(buffer, index=False)
+        source = buffer.getvalue()
+
+    default, default_time = read_chunk(source, service, rows, compact=False)
+    compact, compact_time = read_chunk(source, service, rows, compact=True)
+    report = memory_report(default, compact)
+
+    print(f'Memory of {len(default.index)} cleaned {service} rows, default vs compact dtypes:')
+    print((report.assign(before=report['before'] / 1024 ** 2, after=report['after'] / 1024 ** 2)
+           .rename(columns={'before': 'default (MB)', 'after': 'compact (MB)'})
+           .to_string(float_format='{:.2f}'.format)))
+    print(f'read_csv() + clean_data(): default %.3f seconds, compact %.3f seconds' % (default_time, compact_time))
+
+    ## The written values don't change, only how they're held in memory
+    print(f'identical values once expanded: {expand_data(compact).astype(default.dtypes.to_dict()).equals(default)}')
+
+    for name, total in [('default', report.loc['TOTAL', 'before']), ('compact', report.loc['TOTAL', 'after'])]:
+        print(f'  {name}: {total / len(default.index):.0f} bytes/row, '
+              f'~{int(budget / (total / len(default.index)))} rows per chunk in {budget / 1024 ** 2:.0f} MB')
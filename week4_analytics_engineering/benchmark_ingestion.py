@@ -0,0 +1,424 @@
+import argparse
+import functools
+import inspect
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+import pandas as pd
+import pyarrow as pa
+from sqlalchemy import text
+from synthetic_taxi_data import write_month, write_zone_lookup
+from pg_engine import create_pg_engine
+
+'''
+Reproducible benchmark of every ingestion path against fixed local fixtures, instead of the
+ad-hoc "Time to insert ..." lines of each loader:
+    - week1's `load_data.py`
+    - `upload_all_data_postgres_csv.py` (plain, bulk, partitioned and dedup loads)
+    - `upload_all_data_postgres_parquet.py` (pandas and Arrow loads)
+    - the Parquet conversion + upload of `upload_all_data_gcs_parquet.py`
+
+Setup:
+    - Fixtures: 12 synthetic monthly yellow files (`.csv.gz` and `.parquet`, from
+        `synthetic_taxi_data.py`, so with the real files' quirks and a few duplicate rows) plus
+        the zones from dbt's seed, generated once per size under `--fixture_dir` and served over a
+        local HTTP server, so each loader goes through its real download (and download cache) code
+    - A local Postgres (e.g. `pgdatabase` from docker-compose.yml): the loaders write into a
+        `benchmark` schema that's dropped before each run (load_data.py into `benchmark_*` tables)
+    - A fake object store: the `fake-gcs` server from docker-compose.yml (`--gcs_endpoint`).
+        Without google-cloud-storage installed, the GCS configurations are reported as skipped.
+
+Each configuration runs in its own process (so its peak RSS is its own) and reports:
+    - rows/sec and bytes/sec (of the fixture files it read) over the whole run
+    - peak RSS
+    - wall time per stage (download, read, clean, load, ...). A stage's time excludes the stages
+        nested in it, and `other` is whatever isn't in any stage.
+    - its loader, function, chunk size, load method and sink mode
+The results are written as JSON (named after the git commit by default), and `--compare old.json`
+prints the change in rows/sec and peak RSS of each configuration since that run.
+
+Run with e.g. `python benchmark_ingestion.py --rows 100000 --only pg_csv`
+'''
+
+week1_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'week1_intro_prereqs_environment')
+
+year = '2019'
+service = 'yellow'
+fixture_seed = 42
+## The schema (and table name prefix for load_data.py) the benchmark loads into
+schema = 'benchmark'
+bucket_name = 'benchmark'
+
+## Wall time of each stage, keyed by the module functions that make it up
+stages = {
+    'load_data': {'download': ['cached_download'], 'load': ['insert_chunk']},
+    'pg_csv': {'download': ['download_month'], 'read': ['iter_clean_chunks'], 'clean': ['clean_data'],
+               'load': ['load_chunk', 'commit_chunk', 'append_partitioned', 'append_deduplicated'],
+               'finalize': ['delete_duplicates', 'swap_in_staging']},
+    'pg_parquet': {'download': ['download_month'], 'read': ['read_and_clean', 'iter_clean_batches'],
+                   'clean': ['clean_data', 'clean_batch'], 'load': ['load_month_once', 'load_chunk', 'commit_chunk']},
+    'gcs': {'download': ['download_month'], 'convert': ['csv_to_parquet', 'csv_to_partition'],
+            'upload': ['upload_many', 'upload_to_gcs']}
+}
+
+## name: (loader, function, kwargs, sink mode)
+configurations = {
+    'load_data/copy/chunk=100000': ('load_data', 'main', {'load_method': 'copy', 'chunksize': 100000}, 'replace'),
+    'load_data/copy/adaptive': ('load_data', 'main', {'load_method': 'copy', 'chunksize': None}, 'replace'),
+    'load_data/insert/chunk=100000': ('load_data', 'main', {'load_method': 'insert', 'chunksize': 100000}, 'replace'),
+    'pg_csv/copy/chunk=100000': ('pg_csv', 'web_to_pg', {'load_method': 'copy', 'chunksize': 100000}, 'append'),
+    'pg_csv/copy/adaptive': ('pg_csv', 'web_to_pg', {'load_method': 'copy', 'chunksize': None}, 'append'),
+    'pg_csv/copy/adaptive/compact': ('pg_csv', 'web_to_pg', {'load_method': 'copy', 'chunksize': None, 'compact': True},
+                                     'append'),
+    'pg_csv/insert/chunk=100000': ('pg_csv', 'web_to_pg', {'load_method': 'insert', 'chunksize': 100000}, 'append'),
+    'pg_csv/copy/adaptive/bulk': ('pg_csv', 'web_to_pg_bulk', {'load_method': 'copy', 'chunksize': None}, 'bulk'),
+    'pg_csv/copy/adaptive/partitioned': ('pg_csv', 'web_to_pg', {'load_method': 'copy', 'chunksize': None,
+                                                                 'partitioned': True}, 'partitioned'),
+    'pg_csv/copy/adaptive/dedup': ('pg_csv', 'web_to_pg', {'load_method': 'copy', 'chunksize': None, 'dedup': True},
+                                   'dedup'),
+    'pg_parquet/copy/month': ('pg_parquet', 'web_to_pg', {'load_method': 'copy'}, 'append'),
+    'pg_parquet/arrow/batch=100000': ('pg_parquet', 'web_to_pg_arrow', {'batch_size': 100000}, 'append'),
+    'gcs/snappy': ('gcs', 'web_to_gcs', {'profile': 'snappy'}, 'object store'),
+    'gcs/zstd_sorted': ('gcs', 'web_to_gcs', {'profile': 'zstd_sorted'}, 'object store'),
+    'gcs/dataset/zstd_sorted': ('gcs', 'web_to_gcs_dataset', {'profile': 'zstd_sorted'}, 'object store (hive dataset)')
+}
+
+
+def make_fixtures(fixture_dir, rows):
+    '''
+    Write the 12 monthly fixture files of `rows` rows each (in the layouts the loaders' URLs expect)
+        and the zones, unless they're there already, returning {'csv': [paths], 'parquet': [paths]}
+    '''
+    files = {'csv': [], 'parquet': []}
+    os.makedirs(os.path.join(fixture_dir, service), exist_ok=True)
+    os.makedirs(os.path.join(fixture_dir, 'misc'), exist_ok=True)
+
+    for month in range(1, 13):
+        csv_path = os.path.join(fixture_dir, service, f'{service}_tripdata_{year}-{month:02d}.csv.gz')
+        parquet_path = os.path.join(fixture_dir, service, f'{service}_tripdata_{year}-{month:02d}.parquet')
+        files['csv'].append(csv_path)
+        files['parquet'].append(parquet_path)
+        if os.path.isfile(csv_path) and os.path.isfile(parquet_path):
+            continue
+
+        ## The same trips in both formats
+        for path in [csv_path, parquet_path]:
+            write_month(path, service, rows, int(year), month, seed=fixture_seed)
+
+    ## The loaders expect the TLC's header
+    zones_path = os.path.join(fixture_dir, 'misc', 'taxi_zone_lookup.csv')
+    if not os.path.isfile(zones_path):
+        write_zone_lookup(zones_path)
+
+    return files
+
+
+def serve_fixtures(fixture_dir):
+    '''Serve the fixtures over HTTP from a background thread, returning the base URL'''
+
+    class QuietHandler(SimpleHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(QuietHandler, directory=fixture_dir))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_address[1]}'
+
+
+class StageTimer:
+    '''Accumulates the wall time spent in each stage, excluding the time of the stages nested in it'''
+
+    def __init__(self):
+        self.seconds = {}
+        self.stack = []
+
+    def enter(self):
+        self.stack.append(time.perf_counter())
+
+    def exit(self, stage):
+        elapsed = time.perf_counter() - self.stack.pop()
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + elapsed
+        if self.stack:
+            ## Don't count it again in the enclosing stage
+            self.stack[-1] += elapsed
+
+    def wrap(self, function, stage):
+        '''`function`, timed as `stage` (each step of a generator is timed on its own)'''
+
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            self.enter()
+            try:
+                result = function(*args, **kwargs)
+            finally:
+                self.exit(stage)
+            return self.wrap_generator(result, stage) if inspect.isgenerator(result) else result
+
+        return timed
+
+    def wrap_generator(self, generator, stage):
+        while True:
+            self.enter()
+            try:
+                item = next(generator)
+            except StopIteration:
+                return
+            finally:
+                self.exit(stage)
+            yield item
+
+    def instrument(self, module, loader):
+        '''Replace the stage functions of a loader's module with timed versions'''
+        for stage, names in stages[loader].items():
+            for name in names:
+                if hasattr(module, name):
+                    setattr(module, name, self.wrap(getattr(module, name), stage))
+
+
+def pg_kwargs(args):
+    return {'user': args.user, 'password': args.password, 'host': args.host, 'port': args.port,
+            'database': args.database}
+
+
+def reset_schema(args):
+    '''Start every run from an empty `benchmark` schema (and without load_data.py's tables)'''
+    engine = create_pg_engine(**pg_kwargs(args), pool_size=1)
+    with engine.begin() as connection:
+        connection.execute(text(f'DROP SCHEMA IF EXISTS {schema} CASCADE'))
+        connection.execute(text(f'CREATE SCHEMA {schema}'))
+        connection.execute(text(f'DROP TABLE IF EXISTS {schema}_yellow_taxi_data, {schema}_zones'))
+    engine.dispose()
+
+
+def rows_in(args, table_name):
+    '''Rows a run left in a table (None if it doesn't exist)'''
+    engine = create_pg_engine(**pg_kwargs(args), schema=schema, pool_size=1)
+    try:
+        with engine.connect() as connection:
+            if connection.execute(text('SELECT to_regclass(:table_name)'), {'table_name': table_name}).scalar() is None:
+                return None
+            return connection.execute(text(f'SELECT count(*) FROM {table_name}')).scalar()
+    finally:
+        engine.dispose()
+
+
+def load_zones_fixture(module, base_url):
+    '''A `load_zones()` for the Postgres loaders that loads the fixture zones instead of GitHub's'''
+
+    def load_zones():
+        df_zones = pd.read_csv(f'{base_url}/misc/taxi_zone_lookup.csv')
+        module.replace_table(df_zones, 'zones', module.engine, primary_key=['LocationID'])
+
+    return load_zones
+
+
+def run_configuration(name, args):
+    '''Run one configuration in this (child) process and return its result'''
+    loader, function_name, kwargs, sink = configurations[name]
+    timer = StageTimer()
+
+    if loader == 'load_data':
+        sys.path.insert(0, week1_dir)
+        import load_data as module
+        timer.instrument(module, loader)
+        function = functools.partial(module.main, argparse.Namespace(
+            **pg_kwargs(args), yellow_taxi_table_name=f'{schema}_yellow_taxi_data',
+            yellow_taxi_url=f'{args.base_url}/{service}/{service}_tripdata_{year}-01.csv.gz',
+            zones_table_name=f'{schema}_zones', zones_url=f'{args.base_url}/misc/taxi_zone_lookup.csv',
+            strict=False, max_memory_mb=1536, max_chunk_seconds=30, compact=False, cache_dir='./data/cache',
+            cache_max_gb=5, **kwargs))
+        table_name = f'public.{schema}_yellow_taxi_data'
+        input_files = [args.files['csv'][0]]
+    elif loader in ('pg_csv', 'pg_parquet'):
+        from pg_engine import get_pg_engine
+        if loader == 'pg_csv':
+            import upload_all_data_postgres_csv as module
+            module.init_url = f'{args.base_url}/'
+            input_files = args.files['csv']
+            pg_args = [pg_kwargs(args)[key] for key in ['user', 'password', 'host', 'port', 'database']]
+        else:
+            import upload_all_data_postgres_parquet as module
+            module.init_url = f'{args.base_url}/{service}'
+            input_files = args.files['parquet']
+            pg_args = []
+        module.engine = get_pg_engine(**pg_kwargs(args), schema=schema, pool_size=4)
+        module.load_zones = load_zones_fixture(module, args.base_url)
+        timer.instrument(module, loader)
+        function = getattr(module, function_name)
+        if function_name == 'web_to_pg_bulk':
+            function = functools.partial(function, [year], service, *pg_args, **kwargs)
+        else:
+            function = functools.partial(function, year, service, *pg_args, **kwargs)
+        table_name = f'{schema}.{service}_trip_data'
+    else:
+        os.environ.setdefault('STORAGE_EMULATOR_HOST', args.gcs_endpoint)
+        try:
+            from gcs_upload import get_client
+        except ImportError as e:
+            return {'skipped': f'{e} (the GCS uploader needs google-cloud-storage)'}
+        from google.api_core.exceptions import Conflict
+        try:
+            get_client().create_bucket(bucket_name)
+        except Conflict:
+            pass
+        ## The uploader reads its bucket from a `config.py`, here the fake object store's
+        if 'config' not in sys.modules:
+            sys.modules['config'] = types.SimpleNamespace(gcloud_creds=None, bucket_name=bucket_name)
+        import upload_all_data_gcs_parquet as module
+        module.init_url = f'{args.base_url}/'
+        timer.instrument(module, loader)
+        function = functools.partial(getattr(module, function_name), year, service, module.get_bucket(), **kwargs)
+        table_name = None
+        input_files = args.files['csv']
+
+    start = time.perf_counter()
+    try:
+        function()
+    except SystemExit:
+        ## load_data.py exits once it runs out of chunks
+        pass
+    seconds = time.perf_counter() - start
+
+    rows = args.rows * len(input_files)
+    input_bytes = sum(os.path.getsize(path) for path in input_files)
+    stage_seconds = {stage: round(timer.seconds.get(stage, 0.0), 3) for stage in stages[loader]}
+    stage_seconds['other'] = round(seconds - sum(timer.seconds.values()), 3)
+
+    return {
+        'loader': loader,
+        'function': function_name,
+        'chunksize': kwargs.get('chunksize', kwargs.get('batch_size')),
+        'load_method': kwargs.get('load_method'),
+        'sink': sink,
+        'options': kwargs,
+        'rows': rows,
+        'rows_loaded': rows_in(args, table_name) if table_name else None,
+        'input_bytes': input_bytes,
+        'seconds': round(seconds, 3),
+        'rows_per_sec': round(rows / seconds, 1),
+        'bytes_per_sec': round(input_bytes / seconds, 1),
+        ## Reported in KB on Linux
+        'peak_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        'stage_seconds': stage_seconds
+    }
+
+
+def run_in_child(name, args, fixture_files, base_url):
+    '''Run a configuration in a fresh Python process (in a scratch directory), returning its result'''
+    with tempfile.TemporaryDirectory() as work_dir:
+        result_path = os.path.join(work_dir, 'result.json')
+        command = [sys.executable, os.path.abspath(__file__), '--child', name, '--result', result_path,
+                   '--base_url', base_url, '--fixture_files', json.dumps(fixture_files), '--rows', str(args.rows),
+                   '--gcs_endpoint', args.gcs_endpoint] + \
+                  [f'--{key}={value}' for key, value in pg_kwargs(args).items()]
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join([os.path.dirname(os.path.abspath(__file__)),
+                                                           os.environ.get('PYTHONPATH', '')]))
+        process = subprocess.run(command, cwd=work_dir, env=env, capture_output=True, text=True)
+        if process.returncode != 0 or not os.path.isfile(result_path):
+            return {'error': (process.stderr or process.stdout).strip().splitlines()[-20:]}
+        with open(result_path) as f:
+            return json.load(f)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results):
+    print(f'\n  {"configuration":<34} {"rows/sec":>10} {"MB/sec":>8} {"peak RSS (MB)":>14}  stages (s)')
+    for name, result in results.items():
+        if 'rows_per_sec' not in result:
+            print(f'  {name:<34} {"skipped" if "skipped" in result else "failed":>10}  '
+                  f'{result.get("skipped") or result["error"][-1]}')
+            continue
+        stage_list = ', '.join(f'{stage} {seconds:.2f}' for stage, seconds in result['stage_seconds'].items())
+        print(f'  {name:<34} {result["rows_per_sec"]:>10.0f} {result["bytes_per_sec"] / 1024 ** 2:>8.2f} '
+              f'{result["peak_rss_bytes"] / 1024 ** 2:>14.0f}  {stage_list}')
+
+
+def compare_results(old, new):
+    '''Print the change in rows/sec and peak RSS of each configuration between two result files'''
+    print(f'\nChange since {old.get("commit")} ({old["created_at"]}):')
+    for name, result in new['results'].items():
+        before = old['results'].get(name, {})
+        if 'rows_per_sec' not in result or 'rows_per_sec' not in before:
+            continue
+        print(f'  {name:<34} rows/sec {result["rows_per_sec"] / before["rows_per_sec"] - 1:>+7.1%}   '
+              f'peak RSS {result["peak_rss_bytes"] / before["peak_rss_bytes"] - 1:>+7.1%}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the ingestion paths against local fixtures')
+    parser.add_argument('--rows', type=int, default=100000, help='Rows of each of the 12 monthly fixture files')
+    parser.add_argument('--only', nargs='*', default=[],
+                        help='Only run the configurations whose name starts with one of these (e.g. pg_csv)')
+    parser.add_argument('--fixture_dir', default='./data/benchmark/fixtures')
+    parser.add_argument('--output', help='JSON file to write (default ./data/benchmark/ingestion-<commit>.json)')
+    parser.add_argument('--compare', help='An earlier JSON result to compare with')
+    parser.add_argument('--user', default='root')
+    parser.add_argument('--password', default='root')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', default='5432')
+    parser.add_argument('--database', default='ny_taxi')
+    parser.add_argument('--gcs_endpoint', default='http://localhost:4443', help='The fake GCS server to upload to')
+    ## Used by the child processes
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--result', help=argparse.SUPPRESS)
+    parser.add_argument('--base_url', help=argparse.SUPPRESS)
+    parser.add_argument('--fixture_files', type=json.loads, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        args.files = args.fixture_files
+        result = run_configuration(args.child, args)
+        with open(args.result, 'w') as f:
+            json.dump(result, f)
+        sys.exit(0)
+
+    names = [name for name in configurations if not args.only or any(name.startswith(prefix) for prefix in args.only)]
+    fixture_dir = os.path.join(args.fixture_dir, f'rows={args.rows}-seed={fixture_seed}')
+    print(f'Generating/using the fixtures in {fixture_dir}...')
+    fixture_files = make_fixtures(fixture_dir, args.rows)
+    base_url = serve_fixtures(fixture_dir)
+
+    results = {}
+    for name in names:
+        print(f'Running {name}...')
+        if not name.startswith('gcs'):
+            reset_schema(args)
+        results[name] = run_in_child(name, args, fixture_files, base_url)
+    if any(not name.startswith('gcs') for name in names):
+        reset_schema(args)
+
+    commit = git_commit()
+    output = {
+        'commit': commit,
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'host': {'platform': platform.platform(), 'python': platform.python_version(), 'cpus': os.cpu_count(),
+                 'pandas': pd.__version__, 'pyarrow': pa.__version__},
+        'fixtures': {'rows_per_file': args.rows, 'files': 12, 'service': service, 'year': year},
+        'results': results
+    }
+    print_results(results)
+
+    output_path = args.output or os.path.join('./data/benchmark', f'ingestion-{commit or "unknown"}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with open(output_path, 'w') as f:
+        json.dump(output, f, indent=2)
+    print(f'\nWrote {output_path}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare_results(json.load(f), output)
@@ -0,0 +1,66 @@
+import os
+import tempfile
+import time
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from benchmark_clean_data import make_yellow_chunk
+from taxi_schema import clean_data
+from parquet_profiles import parquet_profiles, write_table
+
+'''
+Benchmark of the Parquet writer profiles in `parquet_profiles.py` on a synthetic (cleaned) month
+of yellow taxi data: file size, write time, and the time to read one day of pickups back with a
+filter that is pushed down to the row group statistics (like BigQuery's external tables and
+`pd.read_parquet(filters=...)` do).
+
+Run with `python benchmark_parquet_profiles.py [rows] [repeats]`
+'''
+
+
+def row_groups_read(path, column, start, end):
+    '''How many row groups' min/max statistics overlap [start, end), i.e. can't be skipped'''
+    metadata = pq.ParquetFile(path).metadata
+    index = metadata.schema.names.index(column)
+    overlapping = 0
+    for i in range(metadata.num_row_groups):
+        stats = metadata.row_group(i).column(index).statistics
+        if stats is None or not stats.has_min_max or (stats.min < end and stats.max >= start):
+            overlapping += 1
+    return overlapping, metadata.num_row_groups
+
+
+def best_of(function, repeats):
+    '''Best wall time of `repeats` runs, and the last result'''
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+if __name__ == '__main__':
+    import sys
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+
+    table = pa.Table.from_pandas(clean_data(make_yellow_chunk(rows), 'yellow'), preserve_index=False)
+    column = 'tpep_pickup_datetime'
+    start, end = pd.Timestamp('2019-01-15'), pd.Timestamp('2019-01-16')
+    filters = [(column, '>=', start), (column, '<', end)]
+
+    print(f'Parquet writer profiles on {rows} yellow rows (best of {repeats}), '
+          f'reading back pickups from {start.date()} to {end.date()}:')
+    print(f'  {"profile":<12} {"size (MB)":>10} {"write (s)":>10} {"read (s)":>10} {"row groups read":>16}')
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for profile in parquet_profiles:
+            path = os.path.join(tmp_dir, f'{profile}.parquet')
+            write_time, _ = best_of(lambda: write_table(table, path, 'yellow', profile), repeats)
+            read_time, result = best_of(lambda: pq.read_table(path, filters=filters), repeats)
+            read, total = row_groups_read(path, column, start.to_datetime64(), end.to_datetime64())
+            print(f'  {profile:<12} {os.path.getsize(path) / 1024 ** 2:>10.1f} {write_time:>10.3f} '
+                  f'{read_time:>10.3f} {f"{read} of {total}":>16}')
+
+    print(f'  ({result.num_rows} rows match the filter)')
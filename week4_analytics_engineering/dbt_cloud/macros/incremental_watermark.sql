@@ -0,0 +1,33 @@
+{#
+    This macro returns a WHERE condition for an incremental run that keeps the rows of `column`
+    from the month of the model's watermark onwards, i.e. the latest `watermark_column` already
+    in {{ this }}. Future-dated outliers (e.g. 2088 pickups) don't count for the watermark, and the
+    whole watermark month is processed again, since its file can arrive in several loads.
+
+    `partition_filters` are conditions on {{ this }} (e.g. "service_type = 'green'") that each
+    get their own watermark, the earliest of which is used, e.g. when a model unions sources
+    that are loaded separately and one of them can be behind the others. A partition that has
+    no rows in {{ this }} yet is processed from the start.
+#}
+
+{% macro incremental_watermark_filter(column, watermark_column=none, partition_filters=none) -%}
+
+    {%- set watermark_column = watermark_column or column -%}
+    {%- set partition_filters = partition_filters or [none] -%}
+    {{ column }} >= {% if partition_filters | length > 1 %}LEAST({% endif %}
+    {%- for partition_filter in partition_filters %}
+        (
+            SELECT COALESCE(
+                {{ dbt.date_trunc("month", "MAX(" ~ watermark_column ~ ")") }},
+                CAST('1900-01-01' AS TIMESTAMP)
+            )
+            FROM {{ this }}
+            WHERE {{ watermark_column }} <= {{ dbt.current_timestamp() }}
+            {%- if partition_filter %}
+                AND {{ partition_filter }}
+            {%- endif %}
+        ){% if not loop.last %},{% endif %}
+    {%- endfor %}
+    {% if partition_filters | length > 1 %}){% endif %}
+
+{%- endmacro %}
@@ -1,6 +1,22 @@
+-- Incremental: each run recomputes whole revenue months of each service, from the month of its latest one already
+--  built on, so the months it writes are the same as a full rebuild's (`--full-refresh` after a full refresh of fact_trips)
+{#
+    Like fact_trips, each service gets its own watermark, since one can be loaded behind the other. On BigQuery,
+    an overwritten month partition has to hold both services' rows, so both are recomputed from the earlier one.
+#}
+{%- set service_filters = ["service_type = 'green'", "service_type = 'yellow'"] -%}
 {{
     config(
-        materialized='table'
+        materialized='incremental',
+        on_schema_change='fail',
+        -- BigQuery: overwrite the recomputed months' partitions
+        -- Postgres/others: delete all rows of the recomputed months of each service, then insert them again
+        incremental_strategy=('insert_overwrite' if target.type == 'bigquery' else 'delete+insert'),
+        unique_key=['revenue_month', 'service_type'],
+        partition_by=({'field': 'revenue_month', 'data_type': 'timestamp', 'granularity': 'month'}
+                      if target.type == 'bigquery' else none),
+        cluster_by=(['service_type', 'revenue_zone'] if target.type == 'bigquery' else none),
+        indexes=([{'columns': ['revenue_month', 'service_type']}] if target.type == 'postgres' else none)
     )
 }}
 
@@ -34,6 +50,20 @@ WITH trips_data AS (
         payment_type,
         payment_type_description
     FROM {{ ref('fact_trips') }}
+    {% if is_incremental() %}
+    -- Every trip of the recomputed months (see macros/incremental_watermark.sql)
+    {% if target.type == 'bigquery' %}
+    WHERE {{ incremental_watermark_filter('pickup_datetime', watermark_column='revenue_month',
+                                          partition_filters=service_filters) }}
+    {% else %}
+    WHERE
+        {%- for service_filter in service_filters %}
+        {% if not loop.first %}OR {% endif %}({{ service_filter }} AND
+            {{ incremental_watermark_filter('pickup_datetime', watermark_column='revenue_month',
+                                            partition_filters=[service_filter]) }})
+        {%- endfor %}
+    {% endif %}
+    {% endif %}
 )
 
 SELECT
@@ -1,6 +1,30 @@
+-- Incremental: each run only processes the staging rows of each service from the month of its latest pickup already loaded
+-- Rebuild everything with `dbt build --select fact_trips --full-refresh`
+{#
+    Each service gets its own watermark, since one can be loaded behind the other. On BigQuery though,
+    insert_overwrite replaces whole monthly partitions, which then have to hold both services' rows, so
+    both services are processed from the earlier of the two watermarks.
+#}
+{%- set green_watermark = ["service_type = 'green'"] -%}
+{%- set yellow_watermark = ["service_type = 'yellow'"] -%}
+{%- if target.type == 'bigquery' -%}
+    {%- set green_watermark = green_watermark + yellow_watermark -%}
+    {%- set yellow_watermark = green_watermark -%}
+{%- endif %}
 {{
     config(
-        materialized='table'
+        materialized='incremental',
+        -- trip_id is only unique per service (it's a hash of vendor_id and pickup_datetime)
+        unique_key=['trip_id', 'service_type'],
+        on_schema_change='fail',
+        -- BigQuery: replace just the monthly partitions the new rows fall in (no scan of the whole table)
+        -- Postgres/others: delete the re-processed trips by key, then insert them again
+        incremental_strategy=('insert_overwrite' if target.type == 'bigquery' else 'delete+insert'),
+        partition_by=({'field': 'pickup_datetime', 'data_type': 'timestamp', 'granularity': 'month'}
+                      if target.type == 'bigquery' else none),
+        cluster_by=(['service_type', 'pickup_location_id'] if target.type == 'bigquery' else none),
+        indexes=([{'columns': ['trip_id', 'service_type'], 'unique': true}, {'columns': ['pickup_datetime']}]
+                 if target.type == 'postgres' else none)
     )
 }}
 
@@ -32,6 +56,10 @@ WITH green_data AS (
         -- Create new field
         'green' AS service_type
     FROM {{ ref('stg_green_trip_data') }}
+    {% if is_incremental() %}
+    -- Only the months from the watermark on (see macros/incremental_watermark.sql)
+    WHERE {{ incremental_watermark_filter('pickup_datetime', partition_filters=green_watermark) }}
+    {% endif %}
 )
 ,
 
@@ -62,6 +90,9 @@ yellow_data AS (
         -- Create new field
         'yellow' AS service_type
     FROM {{ ref('stg_yellow_trip_data') }}
+    {% if is_incremental() %}
+    WHERE {{ incremental_watermark_filter('pickup_datetime', partition_filters=yellow_watermark) }}
+    {% endif %}
 )
 ,
 
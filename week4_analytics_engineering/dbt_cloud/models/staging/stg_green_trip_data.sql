@@ -1,7 +1,19 @@
 -- Create a view so we don't have the need to refresh constantly but still have the latest data loaded
+-- Or, with `--vars '{'staging_materialization': 'incremental'}'`, a table that each run only rebuilds the newly
+--  arrived months of (deduplicated), so the dedup and trip_id are computed once instead of on every read
 {{
     config(
-        materialized = 'view'
+        materialized = var('staging_materialization', 'view'),
+        unique_key = 'trip_id',
+        on_schema_change = 'fail',
+        -- BigQuery: replace the monthly partitions of the re-processed months
+        -- Postgres/others: delete the re-processed trips by trip_id, then insert them again
+        incremental_strategy = ('insert_overwrite' if target.type == 'bigquery' else 'delete+insert'),
+        partition_by = ({'field': 'pickup_datetime', 'data_type': 'timestamp', 'granularity': 'month'}
+                        if target.type == 'bigquery' else none),
+        cluster_by = (['trip_id'] if target.type == 'bigquery' else none),
+        indexes = ([{'columns': ['trip_id'], 'unique': true}, {'columns': ['pickup_datetime']}]
+                   if target.type == 'postgres' else none)
     ) 
 }}
 
@@ -33,6 +45,10 @@ WITH trip_data AS (
     FROM {{ source('staging', 'green_trip_data') }}
     -- Remove null data
     WHERE vendor_id IS NOT NULL
+    {% if is_incremental() %}
+    -- Only the rows from the month of the latest pickup already loaded on (see macros/incremental_watermark.sql)
+    AND {{ incremental_watermark_filter('lpep_pickup_datetime', watermark_column='pickup_datetime') }}
+    {% endif %}
 )
 
 -- Use dbt.safe_case() function to make sure all INTEGER data fields are correct
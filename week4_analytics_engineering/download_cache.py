@@ -0,0 +1,207 @@
+## For the cache keys
+import hashlib
+import os
+import shutil
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from urllib.parse import urlparse
+import requests
+from downloader import download_file, get_session
+
+'''
+Local download cache for the monthly TLC files, shared by the Postgres loaders and GCS uploaders.
+
+Each file is stored under `<cache_dir>/<key>/<original file name>`, where the key is a hash of
+the source URL plus a validator for its content: the server's ETag (or Last-Modified +
+Content-Length when there's no ETag), or the expected MD5 if the caller knows it. So:
+    - re-running a backfill finds the same months in the cache and never downloads them again
+        (only a cheap HEAD request is made to get the validator)
+    - the validator of each URL is recorded in `<cache_dir>/<url key>.validator`, and trusted
+        without a HEAD request for `ttl` seconds after it was checked. If the HEAD request fails
+        (e.g. offline), the last recorded version is used as long as it's still cached.
+    - if a file is republished upstream, its validator changes and it's downloaded again
+        (once the recorded validator is older than `ttl`)
+    - downloads go through `download_file()`, which writes to a `.part` file and only renames it
+        once it is complete, so a half-written file is never treated as a cache hit
+    - once the cache is over `max_bytes`, the least recently used files are deleted, except the
+        ones that are pinned (in use by this process, see `get(pin=True)` and `using()`)
+
+The modification time of each cached file doubles as its "last used" time (it is touched on
+every hit), so there's no index file to keep in sync and several loaders can share a cache dir.
+'''
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+class DownloadCache:
+    '''URL + ETag keyed file cache with a size budget, LRU eviction and hit/miss counters'''
+
+    def __init__(self, cache_dir='./data/cache', max_bytes=10 * 1024 ** 3, session=None, timeout=60, ttl=24 * 3600):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.session = session or get_session()
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        ## Paths in use -> how many times they're pinned
+        self.pins = Counter()
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def validator(self, url):
+        '''Identify the current version of a remote file from a HEAD request'''
+        r = self.session.head(url, allow_redirects=True, timeout=self.timeout)
+        r.raise_for_status()
+        etag = r.headers.get('ETag')
+        if etag:
+            return f'etag:{etag}'
+        return f'modified:{r.headers.get("Last-Modified")}:{r.headers.get("Content-Length")}'
+
+    def path_for(self, url, validator):
+        '''Where a given version of a URL is (or would be) cached'''
+        key = hashlib.sha256(f'{url}\n{validator}'.encode()).hexdigest()[:32]
+        return os.path.join(self.cache_dir, key, os.path.basename(urlparse(url).path))
+
+    def record_path(self, url):
+        '''Where the last validator seen for a URL is recorded (its mtime is when it was checked)'''
+        key = hashlib.sha256(url.encode()).hexdigest()[:32]
+        return os.path.join(self.cache_dir, f'{key}.validator')
+
+    def recorded_validator(self, url):
+        '''(validator, seconds since it was checked) of the last version of `url` seen, if it's still cached'''
+        record = self.record_path(url)
+        try:
+            with open(record) as f:
+                validator = f.read()
+            age = time.time() - os.path.getmtime(record)
+        except FileNotFoundError:
+            return None, None
+        if not os.path.isfile(self.path_for(url, validator)):
+            return None, None
+        return validator, age
+
+    def current_validator(self, url):
+        '''The validator of `url`, from a HEAD request unless the recorded one was checked less than `ttl` seconds ago'''
+        validator, age = self.recorded_validator(url)
+        if validator is not None and age < self.ttl:
+            return validator
+
+        try:
+            current = self.validator(url)
+        except requests.RequestException as error:
+            if validator is None:
+                raise
+            print(f'Could not check {url} for a newer version ({error}), using the cached one')
+            return validator
+
+        ## Written to a temp file first, so other threads/processes never read a half-written record
+        record = self.record_path(url)
+        part = f'{record}.{os.getpid()}.{threading.get_ident()}.part'
+        with open(part, 'w') as f:
+            f.write(current)
+        os.replace(part, record)
+
+        return current
+
+    def get(self, url, expected_md5=None, pin=False):
+        '''
+        Return the local path of `url`, downloading it only if this version isn't cached yet
+            - `pin=True` keeps the file from being evicted until it's `release()`d
+        '''
+        validator = f'md5:{expected_md5}' if expected_md5 else self.current_validator(url)
+        path = self.path_for(url, validator)
+
+        ## Pinned before anything can be evicted, so another thread's download can't delete it
+        if pin:
+            with self.lock:
+                self.pins[os.path.normpath(path)] += 1
+
+        try:
+            if os.path.isfile(path):
+                ## Mark it as recently used
+                os.utime(path)
+                with self.lock:
+                    self.hits += 1
+                print(f'Using cached {path}')
+                return path
+
+            with self.lock:
+                self.misses += 1
+            download_file(url, path, session=self.session, expected_md5=expected_md5, timeout=self.timeout)
+            self.evict(keep=path)
+        except BaseException:
+            if pin:
+                self.release(path)
+            raise
+
+        return path
+
+    def release(self, path):
+        '''Unpin a path `get(pin=True)` returned (as is, or e.g. as a `Path`), so it can be evicted again'''
+        path = os.path.normpath(path)
+        with self.lock:
+            self.pins[path] -= 1
+            if self.pins[path] <= 0:
+                del self.pins[path]
+
+    @contextmanager
+    def using(self, url, expected_md5=None):
+        '''`get()` the path of `url`, pinned for the duration of the `with` block'''
+        path = self.get(url, expected_md5, pin=True)
+        try:
+            yield path
+        finally:
+            self.release(path)
+
+    def entries(self):
+        '''(last used, size, path) of every complete file in the cache'''
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            key_dir = os.path.join(self.cache_dir, key)
+            if not os.path.isdir(key_dir):
+                continue
+            for name in os.listdir(key_dir):
+                if not name.endswith('.part'):
+                    stat = os.stat(os.path.join(key_dir, name))
+                    entries.append((stat.st_mtime, stat.st_size, os.path.join(key_dir, name)))
+        return entries
+
+    def evict(self, keep=None):
+        '''Delete the least recently used files until the cache fits in `max_bytes` (except `keep` and pinned files)'''
+        with self.lock:
+            entries = sorted(self.entries())
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                if path == keep or os.path.normpath(path) in self.pins:
+                    continue
+                print(f'Evicting {path} from the download cache ({size} bytes)')
+                shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+                total -= size
+
+    def stats(self):
+        entries = self.entries()
+        return {'hits': self.hits, 'misses': self.misses, 'files': len(entries),
+                'bytes': sum(size for _, size, _ in entries), 'max_bytes': self.max_bytes}
+
+    def report(self):
+        stats = self.stats()
+        print(f'Download cache: {stats["hits"]} hits, {stats["misses"]} misses, {stats["files"]} files '
+              f'using %.2f of %.2f GB' % (stats['bytes'] / 1024 ** 3, stats['max_bytes'] / 1024 ** 3))
+
+
+def get_cache(cache_dir='./data/cache', max_bytes=10 * 1024 ** 3, ttl=24 * 3600):
+    '''Return the shared `DownloadCache` (the arguments only apply to the first call)'''
+    global _cache
+
+    ## The download stage of `run_months()` calls this from several threads
+    with _cache_lock:
+        if _cache is None:
+            _cache = DownloadCache(cache_dir, max_bytes, ttl=ttl)
+
+    return _cache
@@ -0,0 +1,115 @@
+## For checking downloaded files against a checksum
+import hashlib
+import os
+import requests
+from requests.adapters import HTTPAdapter
+
+'''
+Shared downloader for the monthly TLC files.
+
+Instead of `open(...).write(requests.get(url).content)`, which holds the whole
+multi-hundred-MB file in memory, this streams the response to a `.part` file in
+chunks, resumes a partial `.part` file with an HTTP Range request, checks the
+result against the Content-Length (or an MD5 checksum), and only then renames it
+to the final file name, so a half-downloaded file is never mistaken for a good one.
+
+All downloads share one `requests.Session`, so the 12 months reuse pooled
+keep-alive connections. Pass `session=` (or point `init_url` in the loaders at
+e.g. `http://localhost:8000/`) to download from a local HTTP server in tests.
+'''
+
+## Size of each chunk written to disk
+chunk_size = 1024 * 1024  # 1 MB
+
+_session = None
+
+
+def get_session(pool_size=10):
+    '''Return the shared `requests.Session` with a keep-alive connection pool'''
+    global _session
+
+    if _session is None:
+        _session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        _session.mount('http://', adapter)
+        _session.mount('https://', adapter)
+
+    return _session
+
+
+def _md5_of_file(path):
+    '''Hash an already-downloaded (partial) file'''
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(chunk_size), b''):
+            md5.update(block)
+    return md5
+
+
+def download_file(url, path, session=None, expected_md5=None, max_retries=3, timeout=60):
+    '''
+    Stream `url` to `path`, resuming from `path + '.part'` if a previous attempt was cut off
+        - Returns `path` straight away if the finished file is already there
+        - Raises an `IOError` if the file doesn't match the Content-Length or `expected_md5`
+    '''
+    if os.path.isfile(path):
+        return path
+
+    session = session or get_session()
+    part_path = f'{path}.part'
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+    for attempt in range(1, max_retries + 1):
+        ## Pick up where the last attempt (or run) stopped
+        offset = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+        headers = {'Range': f'bytes={offset}-'} if offset else {}
+
+        try:
+            with session.get(url, headers=headers, stream=True, timeout=timeout) as r:
+                if r.status_code == 416:
+                    ## The range is past the end of the file, so start again from scratch
+                    os.remove(part_path)
+                    continue
+                r.raise_for_status()
+
+                if r.status_code == 206:
+                    ## Content-Range: bytes <start>-<end>/<total>
+                    total = r.headers.get('Content-Range', '').rpartition('/')[2]
+                    mode = 'ab'
+                else:
+                    ## The server ignored the Range header and sent the whole file
+                    total = r.headers.get('Content-Length')
+                    offset = 0
+                    mode = 'wb'
+
+                ## The Content-Length is of the *encoded* body if the server compressed it
+                expected_size = int(total) if total and total.isdigit() \
+                    and 'Content-Encoding' not in r.headers else None
+
+                md5 = _md5_of_file(part_path) if expected_md5 and mode == 'ab' else hashlib.md5()
+
+                print(f'Downloading {url} ({"resuming at %d bytes" % offset if offset else "from the start"})...')
+                with open(part_path, mode) as f:
+                    for block in r.iter_content(chunk_size=chunk_size):
+                        f.write(block)
+                        if expected_md5:
+                            md5.update(block)
+
+        except (requests.ConnectionError, requests.Timeout,
+                requests.exceptions.ChunkedEncodingError) as e:
+            print(f'Download of {url} interrupted on attempt {attempt} of {max_retries}: {e}')
+            continue
+
+        ## Check the file is complete before giving it its real name
+        size = os.path.getsize(part_path)
+        if expected_size is not None and size != expected_size:
+            print(f'Expected {expected_size} bytes from {url} but have {size}, retrying...')
+            continue
+        if expected_md5 and md5.hexdigest() != expected_md5:
+            os.remove(part_path)
+            raise IOError(f'MD5 of {url} is {md5.hexdigest()}, expected {expected_md5}')
+
+        os.replace(part_path, path)
+        return path
+
+    raise IOError(f'Could not download {url} after {max_retries} attempts')
@@ -0,0 +1,156 @@
+## For comparing local files with the objects already in the bucket
+import base64
+import hashlib
+import os
+## For uploading several objects at once
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import google_crc32c
+from google.api_core.exceptions import NotFound
+from google.auth.credentials import AnonymousCredentials
+from google.cloud import storage
+from google.cloud.storage.retry import DEFAULT_RETRY
+
+'''
+Upload engine for the GCS uploaders.
+
+Replaces the plain `blob.upload_from_filename()` (and the commented-out `_MAX_MULTIPART_SIZE`
+timeout workaround) with:
+    - resumable uploads sent in `chunk_size` pieces, so a slow connection only has to get one
+      chunk through before each request's timeout, instead of the whole file
+    - retries with exponential backoff: a failed chunk is resent from the last byte GCS
+      confirmed, rather than restarting the file
+    - a CRC32C check of the uploaded object, and skipping the upload altogether when the object
+      in the bucket already has the same CRC32C/MD5 as the local file (e.g. on a rerun)
+    - `upload_many()` to upload several objects at once from a thread pool
+    - `stream_to_gcs()`, a file-like object that streams whatever is written to it to GCS
+      chunk by chunk (e.g. a `ParquetWriter`'s output), without a local file
+
+`get_client()` talks to a local fake GCS server (e.g. `fsouza/fake-gcs-server`, see the
+`fake-gcs` service in docker-compose.yml) when given an `endpoint` or when `STORAGE_EMULATOR_HOST`
+is set, so the uploaders can be tried out offline.
+'''
+
+## Size of each request of a resumable upload (must be a multiple of 256 KB)
+chunk_size = 8 * 1024 * 1024  # 8 MB
+
+
+def get_client(gcloud_creds=None, endpoint=None, project='test'):
+    '''
+    Return a storage client for the real GCS (from a service account key file if given), or for
+        a fake GCS server at `endpoint`/`STORAGE_EMULATOR_HOST` (e.g. 'http://localhost:4443')
+    '''
+    endpoint = endpoint or os.environ.get('STORAGE_EMULATOR_HOST')
+    if endpoint:
+        return storage.Client(project=project, credentials=AnonymousCredentials(),
+                              client_options={'api_endpoint': endpoint})
+    if gcloud_creds:
+        return storage.Client.from_service_account_json(gcloud_creds)
+    return storage.Client()
+
+
+def local_checksums(local_file):
+    '''Base64 MD5 and CRC32C of a local file, in the format GCS reports them in'''
+    md5 = hashlib.md5()
+    crc32c = google_crc32c.Checksum()
+    with open(local_file, 'rb') as f:
+        for block in iter(lambda: f.read(chunk_size), b''):
+            md5.update(block)
+            crc32c.update(block)
+    return base64.b64encode(md5.digest()).decode(), base64.b64encode(crc32c.digest()).decode()
+
+
+def is_uploaded(bucket, object_name, local_file):
+    '''Whether the bucket already has this exact file under `object_name`'''
+    blob = bucket.get_blob(object_name)
+    if blob is None or blob.size != os.path.getsize(local_file):
+        return False
+
+    md5, crc32c = local_checksums(local_file)
+    ## Composite objects only have a CRC32C
+    return blob.crc32c == crc32c or (blob.md5_hash is not None and blob.md5_hash == md5)
+
+
+def upload_to_gcs(bucket, object_name, local_file, chunk_size=chunk_size, skip_uploaded=True,
+                  initial_backoff=1.0, max_backoff=60.0, retry_deadline=600.0, timeout=120):
+    '''
+    Upload a local file as `object_name` in chunks, retrying failed chunks with exponential backoff
+        - Returns 'skipped' if the bucket already has the same file, otherwise 'uploaded'
+        - `timeout` is per request, i.e. per chunk
+
+    Ref: https://cloud.google.com/storage/docs/uploading-objects#storage-upload-object-python
+    Ref: https://cloud.google.com/storage/docs/retry-strategy#python
+    '''
+    if chunk_size % (256 * 1024):
+        raise ValueError(f'chunk_size must be a multiple of 256 KB, got {chunk_size}')
+
+    if skip_uploaded and is_uploaded(bucket, object_name, local_file):
+        print(f'Skipping {local_file}, gs://{bucket.name}/{object_name} already matches it')
+        return 'skipped'
+
+    ## Setting a chunk size makes this a resumable upload sent one chunk per request
+    blob = bucket.blob(object_name, chunk_size=chunk_size)  ## Basically the destination within the bucket
+
+    retry = _retry(initial_backoff, max_backoff, retry_deadline)
+    blob.upload_from_filename(local_file, checksum='crc32c', retry=retry, timeout=timeout)
+
+    return 'uploaded'
+
+
+def _retry(initial_backoff=1.0, max_backoff=60.0, retry_deadline=600.0):
+    '''Exponential backoff for (re)sending the chunks of a resumable upload'''
+    ## Uploads aren't retried by default since they aren't idempotent, but resending the
+    ##  same data to the same object name is safe here
+    return DEFAULT_RETRY.with_delay(initial=initial_backoff, maximum=max_backoff, multiplier=2.0) \
+        .with_deadline(retry_deadline)
+
+
+def open_blob_writer(bucket, object_name, chunk_size=chunk_size, timeout=120, **retry_kwargs):
+    '''
+    Open `object_name` for writing as a resumable upload: each `chunk_size` of data written is sent
+        as it fills up and the object is finalized on `close()`, so only about one chunk is buffered
+    '''
+    blob = bucket.blob(object_name, chunk_size=chunk_size)
+    ## `ignore_flush`: writers like pyarrow's call `flush()`, which a resumable upload can't honour
+    ##  mid-chunk (the data is still sent when the chunk fills up or on close)
+    return blob.open('wb', ignore_flush=True, retry=_retry(**retry_kwargs), timeout=timeout)
+
+
+@contextmanager
+def stream_to_gcs(bucket, object_name, **writer_kwargs):
+    '''
+    `with stream_to_gcs(bucket, object_name) as f:` streams what's written to `f` to GCS (see `open_blob_writer()`)
+        - It's written to `{object_name}.part` and only copied to `object_name` once everything was
+          written, so a failure half way never leaves a truncated object under the real name
+        - If nothing was written at all (e.g. `arrow_stream.write_batches()` got no batches), there's
+          no object to copy: a 0-byte object isn't a valid Parquet file and would break the external table
+    '''
+    part_name = f'{object_name}.part'
+    writer = open_blob_writer(bucket, part_name, **writer_kwargs)
+    try:
+        yield writer
+        written = writer.tell()
+        writer.close()
+        if written:
+            bucket.copy_blob(bucket.blob(part_name), bucket, object_name)
+    finally:
+        ## Closing finalizes whatever was uploaded so far, which is then deleted
+        if not writer.closed:
+            writer.close()
+        try:
+            bucket.delete_blob(part_name)
+        except NotFound:
+            pass
+
+
+def upload_many(bucket, uploads, max_workers=4, **upload_kwargs):
+    '''
+    Upload several `(object_name, local_file)` pairs at once with `upload_to_gcs()`
+        - Returns {object_name: 'uploaded'/'skipped'}, and re-raises the first failed upload's error
+          (after the other uploads have finished)
+    '''
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {object_name: executor.submit(upload_to_gcs, bucket, object_name, local_file, **upload_kwargs)
+                   for object_name, local_file in uploads}
+
+    return {object_name: future.result() for object_name, future in futures.items()}
@@ -0,0 +1,126 @@
+import os
+import pyarrow as pa
+import pyarrow.parquet as pq
+## For the per-service column types
+from taxi_schema import compile_schema
+## For the Parquet writer settings of each file
+from parquet_profiles import parquet_profiles, writer_options, sort_table
+
+'''
+Hive-partitioned Parquet dataset layout for the uploaders, instead of one flat file per month:
+
+    <root>/service=yellow/year=2019/_metadata
+    <root>/service=yellow/year=2019/_common_metadata
+    <root>/service=yellow/year=2019/month=1/part-00000.parquet
+    <root>/service=yellow/year=2019/month=1/part-00001.parquet
+    ...
+
+so readers can prune partitions from the paths alone instead of listing and opening every file:
+    - `pyarrow.dataset.dataset(root, partitioning='hive')` / `pd.read_parquet(root, filters=...)`
+    - BigQuery external tables with hive partitioning, e.g.
+        CREATE OR REPLACE EXTERNAL TABLE `<project>.<dataset>.external_yellow_tripdata`
+        WITH PARTITION COLUMNS
+        OPTIONS (
+            format = 'PARQUET',
+            uris = ['gs://<bucket-name>/dataset/service=yellow/year=*/month=*/part-*.parquet'],
+            hive_partition_uri_prefix = 'gs://<bucket-name>/dataset/service=yellow'
+        );
+      The URI has to match only the data files (`data_files_glob()`): a plain `service=yellow/*`
+      would also pick up the year's `_metadata`/`_common_metadata`, which aren't data files and
+      have no `month=` key, so BigQuery would reject the table.
+
+Each month is split into `files_per_partition` files of about the same number of rows (fewer when
+the month has fewer rows than that, and none for an empty month, so there are never empty files).
+The `_metadata` file of each service/year collects the footers (schema + row group statistics)
+of all of its files, so `pyarrow.dataset.parquet_dataset()` can plan a query from that one file.
+NOTE: the month partition is the *source file's* month, a few trips in each file have pickups
+outside of it.
+'''
+
+
+def partition_path(service, year, month=None):
+    '''Relative directory of a service/year (or service/year/month) partition'''
+    path = f'service={service}/year={int(year)}'
+    if month is not None:
+        path = f'{path}/month={int(month)}'
+    return path
+
+
+def data_files_glob(service):
+    '''Glob of a service's data files under the dataset root, leaving out the summaries (e.g. for BigQuery's `uris`)'''
+    return f'service={service}/year=*/month=*/part-*.parquet'
+
+
+def conform_table(table, service):
+    '''
+    Cast a cleaned table to the service's Arrow types, so every file of a dataset has the same schema
+        (e.g. an all-NULL column would otherwise come out of pandas as the `null` type)
+    '''
+    schema = compile_schema(service)
+    types = dict(schema['arrow_types'], **{column: pa.timestamp('us') for column in schema['datetime_columns']})
+    fields = [pa.field(name, types.get(name, table.schema.field(name).type)) for name in table.schema.names]
+    return table.cast(pa.schema(fields))
+
+
+def write_partition(table, root, service, year, month, files_per_partition=1, profile='zstd_sorted'):
+    '''
+    Write one month as `files_per_partition` Parquet files under `root`, replacing any earlier ones
+        - Returns a list of (path relative to `root`, file metadata) for `write_summary()`
+        - A month with fewer rows than `files_per_partition` gets one file per row, and an empty
+          month no files at all
+        - With a sorted profile, the month is sorted before it's split, so each file covers its
+          own time range
+    '''
+    table = sort_table(conform_table(table, service), profile, service)
+    options = writer_options(profile, service, table.schema.names)
+
+    directory = os.path.join(root, partition_path(service, year, month))
+    if os.path.isdir(directory):
+        for name in os.listdir(directory):
+            if name.startswith('part-'):
+                os.remove(os.path.join(directory, name))
+    ## An empty month doesn't even get a (empty) partition directory
+    if table.num_rows == 0:
+        if os.path.isdir(directory) and not os.listdir(directory):
+            os.rmdir(directory)
+        return []
+    os.makedirs(directory, exist_ok=True)
+
+    files = []
+    rows_per_file = -(-table.num_rows // files_per_partition)
+    ## Only as many files as there are non-empty slices
+    for i in range(-(-table.num_rows // rows_per_file)):
+        relative_path = f'{partition_path(service, year, month)}/part-{i:05d}.parquet'
+        path = os.path.join(root, relative_path)
+        pq.write_table(table.slice(i * rows_per_file, rows_per_file), path,
+                       row_group_size=parquet_profiles[profile]['row_group_size'], **options)
+
+        ## The service/year's `_metadata` refers to each file relative to its own directory
+        metadata = pq.read_metadata(path)
+        metadata.set_file_path(f'month={int(month)}/part-{i:05d}.parquet')
+        files.append((relative_path, metadata))
+
+    return files
+
+
+def write_summary(root, service, year, files):
+    '''
+    Write the `_metadata` (all files' footers) and `_common_metadata` (just the schema) of a
+        service/year from the months' `write_partition()` results, returning their relative paths
+        - Without any files (every month was empty) there's nothing to summarize, so an earlier
+          run's summary is removed and nothing is returned
+    '''
+    directory = os.path.join(root, partition_path(service, year))
+    if not files:
+        for name in ['_common_metadata', '_metadata']:
+            if os.path.exists(os.path.join(directory, name)):
+                os.remove(os.path.join(directory, name))
+        return []
+
+    schema = files[0][1].schema.to_arrow_schema()
+
+    pq.write_metadata(schema, os.path.join(directory, '_common_metadata'))
+    pq.write_metadata(schema, os.path.join(directory, '_metadata'),
+                      metadata_collector=[metadata for _, metadata in files])
+
+    return [f'{partition_path(service, year)}/_common_metadata', f'{partition_path(service, year)}/_metadata']
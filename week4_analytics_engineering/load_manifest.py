@@ -0,0 +1,187 @@
+import hashlib
+import pandas as pd
+from sqlalchemy import text
+
+'''
+Per-file load manifest, so (re)running a loader is idempotent and can resume where it stopped.
+
+Two small tables live next to the trip data tables:
+    - `load_manifest`: one row per source file, with its target table, content hash, status
+        ('loading' -> 'complete') and final row count
+    - `load_manifest_chunks`: one row per committed chunk, with the row offset it starts at in the
+        file, its row count and a hash of its content
+
+Each chunk is appended *and* recorded in the same transaction (`commit_chunk()`), so a crash
+either loses the whole chunk or keeps it together with its manifest row. On a rerun:
+    - files marked 'complete' are skipped (without downloading or reading them again)
+    - partially loaded files skip the rows that were already committed (`pending_rows()`) and
+        carry on from the next chunk. The resume point is a row offset, not a chunk number,
+        so a rerun doesn't have to use the same chunk size.
+'''
+
+manifest_table = 'load_manifest'
+chunks_table = 'load_manifest_chunks'
+
+
+def create_manifest(engine):
+    '''Create the manifest tables if they don't exist yet'''
+    with engine.begin() as connection:
+        connection.execute(text(f'''
+            CREATE TABLE IF NOT EXISTS {manifest_table} (
+                file_name TEXT PRIMARY KEY,
+                table_name TEXT NOT NULL,
+                content_hash TEXT,
+                status TEXT NOT NULL,
+                rows BIGINT,
+                started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                completed_at TIMESTAMP
+            )
+        '''))
+        connection.execute(text(f'''
+            CREATE TABLE IF NOT EXISTS {chunks_table} (
+                file_name TEXT NOT NULL REFERENCES {manifest_table} (file_name) ON DELETE CASCADE,
+                chunk_index INTEGER NOT NULL,
+                start_row BIGINT NOT NULL,
+                rows BIGINT NOT NULL,
+                content_hash TEXT NOT NULL,
+                loaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (file_name, chunk_index)
+            )
+        '''))
+
+
+def file_md5(path, block_size=1024 * 1024):
+    '''MD5 of a downloaded file, to notice when a source file changed between runs'''
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def df_hash(df):
+    '''Order-sensitive hash of a DataFrame chunk's values (vectorized per-row hashes, then MD5)'''
+    return hashlib.md5(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes()).hexdigest()
+
+
+def batch_hash(batch):
+    '''Hash of a pyarrow RecordBatch's column buffers'''
+    md5 = hashlib.md5()
+    for column in batch.columns:
+        for buffer in column.buffers():
+            if buffer is not None:
+                md5.update(buffer)
+    return md5.hexdigest()
+
+
+def is_complete(engine, file_name):
+    '''Whether a file has already been fully loaded (checked before downloading it again)'''
+    create_manifest(engine)
+    with engine.connect() as connection:
+        status = connection.execute(text(f'SELECT status FROM {manifest_table} WHERE file_name = :file_name'),
+                                    {'file_name': file_name}).scalar()
+    return status == 'complete'
+
+
+def begin_file(engine, file_name, table_name, content_hash=None):
+    '''
+    Register a file in the manifest (or pick up its earlier, partial load) and return its load state
+        - `content_hash` (e.g. `file_md5()`) is compared with the one recorded by the earlier load.
+            A different hash means the already loaded rows came from another version of the file,
+            so it raises a ValueError instead of resuming (delete those rows and the file's manifest
+            row to reload it).
+    '''
+    create_manifest(engine)
+    with engine.begin() as connection:
+        row = connection.execute(text(f'SELECT table_name, content_hash, status, rows FROM {manifest_table} '
+                                      'WHERE file_name = :file_name'),
+                                 {'file_name': file_name}).mappings().first()
+
+        if row is None:
+            connection.execute(text(f'INSERT INTO {manifest_table} (file_name, table_name, content_hash, status) '
+                                    "VALUES (:file_name, :table_name, :content_hash, 'loading')"),
+                               {'file_name': file_name, 'table_name': table_name, 'content_hash': content_hash})
+        elif content_hash and row['content_hash'] and row['content_hash'] != content_hash:
+            raise ValueError(f'{file_name} changed since it was loaded into {row["table_name"]} '
+                             f'(hash {row["content_hash"]}, now {content_hash})')
+
+        committed = connection.execute(text(f'SELECT COUNT(*), COALESCE(SUM(rows), 0) FROM {chunks_table} '
+                                            'WHERE file_name = :file_name'),
+                                       {'file_name': file_name}).first()
+
+    state = {
+        'file_name': file_name,
+        'table_name': table_name,
+        'complete': row is not None and row['status'] == 'complete',
+        'rows': row['rows'] if row is not None else None,
+        'next_chunk': int(committed[0]),
+        'committed_rows': int(committed[1]),
+        ## Rows of the file seen so far this run, committed or not
+        'row_offset': 0
+    }
+    if state['committed_rows'] and not state['complete']:
+        print(f'Resuming {file_name} after {state["committed_rows"]} committed rows ({state["next_chunk"]} chunks)')
+
+    return state
+
+
+def pending_rows(state, rows):
+    '''
+    Given the next chunk's row count, return how many of its leading rows were already committed
+        by an earlier run (i.e. slice those off before loading it)
+    '''
+    start = state['row_offset']
+    state['row_offset'] += rows
+    return min(max(state['committed_rows'] - start, 0), rows)
+
+
+def commit_chunk(state, engine, append, rows, content_hash):
+    '''
+    Append a chunk and record it in the manifest in one transaction
+        - `append(connection)` loads the rows through the open connection (e.g. `pg_bulk_load.append_chunk()`)
+    '''
+    with engine.begin() as connection:
+        result = append(connection)
+        connection.execute(text(f'INSERT INTO {chunks_table} (file_name, chunk_index, start_row, rows, content_hash) '
+                                'VALUES (:file_name, :chunk_index, :start_row, :rows, :content_hash)'),
+                           {'file_name': state['file_name'], 'chunk_index': state['next_chunk'],
+                            'start_row': state['committed_rows'], 'rows': rows, 'content_hash': content_hash})
+
+    state['next_chunk'] += 1
+    state['committed_rows'] += rows
+
+    return result
+
+
+def finish_file(state, engine):
+    '''Mark a file as completely loaded, so later runs skip it'''
+    with engine.begin() as connection:
+        connection.execute(text(f"UPDATE {manifest_table} SET status = 'complete', rows = :rows, "
+                                'completed_at = CURRENT_TIMESTAMP WHERE file_name = :file_name'),
+                           {'file_name': state['file_name'], 'rows': state['committed_rows']})
+    state['complete'] = True
+    state['rows'] = state['committed_rows']
+
+
+def forget_file(connection, file_name):
+    '''Remove a file (and its chunks) from the manifest, e.g. after deleting its rows to reload it'''
+    connection.execute(text(f'DELETE FROM {manifest_table} WHERE file_name = :file_name'), {'file_name': file_name})
+
+
+def replace_table_files(connection, table_name, files):
+    '''
+    Record that `table_name` now holds exactly these completely loaded files, e.g. after a bulk load
+        swapped in a new table (run it inside the swap's transaction)
+        - `files`: list of {'file_name', 'rows', 'content_hash'}
+    '''
+    ## The chunk rows go with them (ON DELETE CASCADE)
+    connection.execute(text(f'DELETE FROM {manifest_table} WHERE table_name = :table_name'),
+                       {'table_name': table_name})
+    for file in files:
+        connection.execute(text(f'DELETE FROM {manifest_table} WHERE file_name = :file_name'),
+                           {'file_name': file['file_name']})
+        connection.execute(text(f'INSERT INTO {manifest_table} (file_name, table_name, content_hash, status, rows, '
+                                "completed_at) VALUES (:file_name, :table_name, :content_hash, 'complete', :rows, "
+                                'CURRENT_TIMESTAMP)'),
+                           {'file_name': file['file_name'], 'table_name': table_name,
+                            'content_hash': file.get('content_hash'), 'rows': file['rows']})
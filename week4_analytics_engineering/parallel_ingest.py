@@ -0,0 +1,51 @@
+## For running the download, parse/clean and load stages of different months at once
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+'''
+Shared scheduler for ingesting several monthly files at once.
+
+Each month goes through three stages, and each stage has its own bounded pool:
+  1. download    -> I/O-bound, so a thread pool
+  2. transform   -> CPU-bound CSV/Parquet parsing + `clean_data()`, so a process pool
+                    (the function and its arguments must be picklable, i.e. defined at module level)
+  3. load        -> a small thread pool, one DB connection or GCS uploader per thread
+
+`max_in_flight` caps how many months can be between "download started" and "load finished"
+at the same time, which is what bounds peak memory: roughly `max_in_flight` times whatever
+`transform()` returns. So a transform should hand back something small (e.g. the paths of
+files it wrote) rather than a whole cleaned month, which would also be pickled back from its
+worker process in one piece.
+
+`release(downloaded)`, if given, is called once `transform()` is done with a month's download
+(also when it fails), e.g. to unpin the file from the download cache so it can be evicted.
+'''
+
+
+def run_months(months, download, transform, load,
+               download_workers=4, transform_workers=2, load_workers=2, max_in_flight=4, release=None):
+    '''
+    Run `download(month)` -> `transform(month, downloaded)` -> `load(month, transformed)`
+        for every month concurrently, and return the results of `load()` in month order
+    '''
+    ## Don't let more months than we can hold in memory be in progress at once
+    in_flight = threading.BoundedSemaphore(max_in_flight)
+
+    with ThreadPoolExecutor(max_workers=download_workers) as download_pool, \
+            ProcessPoolExecutor(max_workers=transform_workers) as transform_pool, \
+            ThreadPoolExecutor(max_workers=load_workers) as load_pool:
+
+        def run_month(month):
+            with in_flight:
+                downloaded = download_pool.submit(download, month).result()
+                try:
+                    transformed = transform_pool.submit(transform, month, downloaded).result()
+                finally:
+                    if release is not None:
+                        release(downloaded)
+                return load_pool.submit(load, month, transformed).result()
+
+        ## One lightweight coordinator thread per in-flight month, which just hands
+        ##  the month from one stage's pool to the next
+        with ThreadPoolExecutor(max_workers=max_in_flight) as coordinators:
+            return list(coordinators.map(run_month, months))
@@ -0,0 +1,83 @@
+import pyarrow as pa
+import pyarrow.parquet as pq
+## For the per-service dictionary and pickup datetime columns
+from taxi_schema import compile_schema
+
+'''
+Parquet writer profiles for the files the GCS uploaders write (and BigQuery's external tables scan).
+
+`df.to_parquet(path)` uses pyarrow's defaults: snappy, row groups of up to ~1M rows, every column
+dictionary encoded (falling back to plain encoding for high-cardinality ones once the dictionary
+gets too big), in whatever order the rows came in. Each profile here pins those choices:
+    - `compression` (and `compression_level`): zstd compresses noticeably smaller than snappy for
+        about the same decode speed
+    - `row_group_size`: the unit readers skip by their min/max statistics, so smaller row groups
+        mean finer-grained skipping but more metadata and less efficient column chunks
+    - `dictionary`: dictionary encode the low-cardinality columns (vendor_id, payment_type,
+        store_and_fwd_flag, the location IDs, ... but also the surcharge/tax amounts, which only
+        take a handful of values), but not the datetimes, which are nearly unique and only waste
+        time building a dictionary that gets abandoned. Encoding *only* the ID/flag columns made
+        the files bigger in the benchmark.
+    - `sort`: sort the whole file by the pickup datetime, so each row group covers a narrow time
+        range and a `WHERE pickup_datetime BETWEEN ...` can skip most of them. That needs the whole
+        month at once, so the streaming (batch by batch) writers don't take the sorted profiles:
+        sorting only within each row group would leave every row group spanning the whole month.
+
+Compare the profiles with `python benchmark_parquet_profiles.py`.
+'''
+
+parquet_profiles = {
+    ## What `df.to_parquet()` did before (pyarrow's defaults)
+    'default': {'compression': 'snappy', 'compression_level': None, 'row_group_size': None,
+                'dictionary': False, 'sort': False},
+    'snappy': {'compression': 'snappy', 'compression_level': None, 'row_group_size': 500000,
+               'dictionary': True, 'sort': False},
+    'zstd': {'compression': 'zstd', 'compression_level': 3, 'row_group_size': 500000,
+             'dictionary': True, 'sort': False},
+    'zstd_sorted': {'compression': 'zstd', 'compression_level': 3, 'row_group_size': 250000,
+                    'dictionary': True, 'sort': True}
+}
+
+
+def writer_options(profile, service, column_names):
+    '''`pq.ParquetWriter()`/`pq.write_table()` keyword arguments for a profile'''
+    options = parquet_profiles[profile]
+    kwargs = {'compression': options['compression'], 'write_statistics': True}
+    if options['compression_level'] is not None:
+        kwargs['compression_level'] = options['compression_level']
+    if options['dictionary']:
+        datetime_columns = compile_schema(service)['datetime_columns']
+        kwargs['use_dictionary'] = [column for column in column_names if column not in datetime_columns]
+    return kwargs
+
+
+def sort_table(table, profile, service):
+    '''Sort a table by its pickup datetime if the profile asks for it'''
+    pickup_column = compile_schema(service)['pickup_column']
+    if parquet_profiles[profile]['sort'] and pickup_column in table.schema.names:
+        return table.sort_by(pickup_column)
+    return table
+
+
+def write_table(table, path, service, profile='snappy'):
+    '''Write a whole (e.g. monthly) table to a Parquet file with a writer profile'''
+    table = sort_table(table, profile, service)
+    pq.write_table(table, path, row_group_size=parquet_profiles[profile]['row_group_size'],
+                   **writer_options(profile, service, table.schema.names))
+
+
+def batch_writer_options(profile, service):
+    '''`arrow_stream.write_batches()` keyword arguments for a profile, which mustn't be a sorted one'''
+    options = parquet_profiles[profile]
+    if options['sort']:
+        raise ValueError(f"The '{profile}' profile sorts whole files, which a stream of batches can't be "
+                         f"(write the whole table with `write_table()`, or use one of "
+                         f"{[name for name, options in parquet_profiles.items() if not options['sort']]})")
+    kwargs = writer_options(profile, service, list(compile_schema(service)['arrow_types']))
+    kwargs['row_group_size'] = options['row_group_size']
+    return kwargs
+
+
+def write_df(df, path, service, profile='snappy'):
+    '''Same as `write_table()` for a (cleaned) pandas DataFrame, in place of `df.to_parquet(path)`'''
+    write_table(pa.Table.from_pandas(df, preserve_index=False), path, service, profile)
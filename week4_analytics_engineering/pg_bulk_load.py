@@ -0,0 +1,244 @@
+## For the in-memory COPY buffer
+import io
+import time
+## For writing Arrow batches as CSV without going through pandas
+import pyarrow.csv as pa_csv
+from sqlalchemy import text
+
+'''
+Shared helpers for bulk loading pandas DataFrame chunks (or Arrow record batches) into Postgres.
+
+`to_sql(..., if_exists='append')` issues (batched) INSERT statements, which is the
+slowest part of loading 100M+ rows. Postgres' `COPY ... FROM STDIN` streams the rows
+in one go instead, so we write each chunk into an in-memory CSV buffer and hand that
+straight to psycopg2's `copy_expert()` (no temp files on disk).
+
+For full (re)loads there's also a bulk mode that loads into `<table>__staging` instead:
+    - the staging table is UNLOGGED (`prepare_staging()`), so the COPYs don't write WAL, and has no
+        indexes or constraints yet, so they aren't maintained row by row
+    - `swap_in_staging()` then makes it LOGGED (one sequential pass), builds its indexes and
+        constraints, and in ONE transaction drops the old table and renames the staging table
+        (and its indexes) to the final names, so readers see either the old or the new table, never
+        a half-loaded one. Finally it runs ANALYZE, so the planner has statistics for the new table.
+`replace_table()` does all of that for a small DataFrame (e.g. the zones).
+'''
+
+## Valid values for the `load_method` flag of the loaders
+load_methods = ['copy', 'insert']
+
+
+def copy_from_df(df, table_name, engine, index=True):
+    '''
+    Append a DataFrame to an existing Postgres table via COPY FROM STDIN (CSV format)
+
+    Ref: https://www.postgresql.org/docs/current/sql-copy.html
+    Ref: https://www.psycopg.org/docs/cursor.html#cursor.copy_expert
+    '''
+    ## Create the table from the DataFrame headers if it doesn't exist yet, like
+    ##  `to_sql(if_exists='append')` would (appending zero rows is a no-op otherwise)
+    df.head(n=0).to_sql(name=table_name, con=engine, if_exists='append', index=index)
+
+    buffer, columns = df_to_csv_buffer(df, index=index)
+    copy_from_buffer(buffer, table_name, columns, engine)
+
+
+def df_to_csv_buffer(df, index=True):
+    '''Write a DataFrame chunk to an in-memory CSV buffer, returning it with the columns to COPY into'''
+    ## Match the columns `to_sql()` creates, including the 'index' column it adds by default
+    columns = list(df.columns)
+    if index:
+        columns = [df.index.name or 'index'] + columns
+
+    ## NaN/NA values are written as unquoted empty strings, which COPY reads as NULL
+    buffer = io.StringIO()
+    df.to_csv(buffer, index=index, header=False)
+    buffer.seek(0)
+
+    return buffer, columns
+
+
+def copy_from_arrow(batch, table_name, engine):
+    '''
+    Append a pyarrow RecordBatch/Table to a Postgres table via COPY FROM STDIN, without
+        converting it to pandas first (no 'index' column is written)
+    '''
+    ## Create the table from the Arrow schema if it doesn't exist yet (only an empty frame goes through pandas)
+    batch.schema.empty_table().to_pandas().to_sql(name=table_name, con=engine, if_exists='append', index=False)
+
+    copy_from_buffer(batch_to_csv_buffer(batch), table_name, batch.schema.names, engine)
+
+
+def batch_to_csv_buffer(batch):
+    '''Write a pyarrow RecordBatch/Table to an in-memory CSV buffer (without a header row)'''
+    ## pyarrow's CSV writer leaves nulls as unquoted empty fields too, and quotes empty strings
+    buffer = io.BytesIO()
+    pa_csv.write_csv(batch, buffer, pa_csv.WriteOptions(include_header=False))
+    buffer.seek(0)
+
+    return buffer
+
+
+def copy_from_buffer(buffer, table_name, columns, engine):
+    '''Stream an in-memory CSV buffer (without a header row) into the given table columns'''
+    ## Use the raw DBAPI (psycopg2) connection from the SQLAlchemy engine's pool
+    raw_conn = engine.raw_connection()
+    try:
+        copy_with_cursor(raw_conn.cursor(), buffer, table_name, columns)
+        raw_conn.commit()
+    except Exception:
+        raw_conn.rollback()
+        raise
+    finally:
+        raw_conn.close()
+
+
+def supports_copy(engine):
+    '''Whether the engine's DBAPI connections can COPY FROM STDIN, i.e. have psycopg2's `copy_expert()`'''
+    raw_conn = engine.raw_connection()
+    try:
+        return hasattr(raw_conn.cursor(), 'copy_expert')
+    finally:
+        raw_conn.close()
+
+
+def copy_with_cursor(cursor, buffer, table_name, columns):
+    '''Run the COPY on a DBAPI cursor, leaving the commit to the caller'''
+    if not hasattr(cursor, 'copy_expert'):
+        raise TypeError(f'COPY FROM STDIN needs a psycopg2 cursor, not {type(cursor).__name__}')
+    column_list = ', '.join(f'"{column}"' for column in columns)
+    cursor.copy_expert(f'COPY "{table_name}" ({column_list}) FROM STDIN WITH (FORMAT CSV)', buffer)
+
+
+def append_chunk(df, table_name, connection, load_method='copy'):
+    '''
+    Append a chunk through an open SQLAlchemy connection, i.e. inside the caller's transaction
+        (`load_chunk()` commits each chunk on its own instead)
+    '''
+    if load_method not in load_methods:
+        raise ValueError(f'Unknown load_method {load_method!r}, expected one of {load_methods}')
+
+    if load_method == 'copy':
+        ## `connection.connection` is the DBAPI connection the transaction is running on
+        cursor = connection.connection.cursor()
+        if hasattr(cursor, 'copy_expert'):
+            df.head(n=0).to_sql(name=table_name, con=connection, if_exists='append')
+            buffer, columns = df_to_csv_buffer(df)
+            copy_with_cursor(cursor, buffer, table_name, columns)
+            return load_method
+        load_method = 'insert'
+
+    df.to_sql(name=table_name, con=connection, if_exists='append')
+    return load_method
+
+
+def append_batch(batch, table_name, connection):
+    '''Same as `append_chunk()` for a pyarrow RecordBatch, which always goes through COPY'''
+    batch.schema.empty_table().to_pandas().to_sql(name=table_name, con=connection, if_exists='append', index=False)
+    copy_with_cursor(connection.connection.cursor(), batch_to_csv_buffer(batch), table_name, batch.schema.names)
+    return 'copy'
+
+
+def load_chunk(df, table_name, engine, load_method='copy'):
+    '''Append a chunk to a Postgres table with COPY or `to_sql()` and report rows/sec'''
+
+    if load_method not in load_methods:
+        raise ValueError(f'Unknown load_method {load_method!r}, expected one of {load_methods}')
+
+    start = time.time()
+
+    if load_method == 'copy' and not supports_copy(engine):
+        ## Not a psycopg2 connection, so fall back to INSERTs (like `append_chunk()`)
+        print('COPY FROM STDIN needs a psycopg2 connection, falling back to to_sql()...')
+        load_method = 'insert'
+
+    if load_method == 'copy':
+        copy_from_df(df, table_name, engine)
+    else:
+        df.to_sql(name=table_name, con=engine, if_exists='append')
+
+    end = time.time()
+    elapsed = end - start
+    rows = len(df.index)
+    print(f'Inserted {rows} rows into {table_name} via {load_method} in %.3f seconds (%.0f rows/sec).'
+          % (elapsed, rows / elapsed if elapsed > 0 else float('inf')))
+
+    return rows, elapsed
+
+
+def staging_table_name(table_name):
+    '''Name of the table a bulk load of `table_name` goes into before it's swapped in'''
+    return f'{table_name}__staging'
+
+
+def drop_table(engine, table_name):
+    '''Drop a (e.g. leftover staging) table if it exists'''
+    with engine.begin() as connection:
+        connection.execute(text(f'DROP TABLE IF EXISTS "{table_name}"'))
+
+
+def prepare_staging(engine, table_name):
+    '''
+    Make a (still empty) staging table UNLOGGED and drop its indexes, i.e. the `ix_<table>_index`
+        that `to_sql()` creates on its 'index' column, so the load doesn't maintain any
+    '''
+    with engine.begin() as connection:
+        connection.execute(text(f'ALTER TABLE "{table_name}" SET UNLOGGED'))
+        index_names = connection.execute(text('SELECT indexname FROM pg_indexes '
+                                              'WHERE schemaname = current_schema() AND tablename = :table_name'),
+                                         {'table_name': table_name}).scalars().all()
+        for index_name in index_names:
+            connection.execute(text(f'DROP INDEX "{index_name}"'))
+
+
+def swap_in_staging(engine, table_name, indexes=None, primary_key=None, on_swap=None, unique_indexes=None):
+    '''
+    Finish a bulk load of `staging_table_name(table_name)` and atomically replace `table_name` with it
+        - `indexes`: {name suffix: [columns]}, built after the load as `{table_name}_{suffix}_idx`
+        - `unique_indexes`: the same for UNIQUE indexes
+        - `primary_key`: columns of the primary key constraint, also added after the load
+        - `on_swap(connection)` runs inside the swap transaction (e.g. to update the load manifest)
+    '''
+    staging = staging_table_name(table_name)
+    unique_indexes = unique_indexes or {}
+    indexes = dict(indexes or {}, **unique_indexes)
+
+    start = time.time()
+    with engine.begin() as connection:
+        ## Written to WAL once, in one sequential pass, so the table survives a crash from now on
+        connection.execute(text(f'ALTER TABLE "{staging}" SET LOGGED'))
+    with engine.begin() as connection:
+        for suffix, columns in indexes.items():
+            column_list = ', '.join(f'"{column}"' for column in columns)
+            unique = 'UNIQUE ' if suffix in unique_indexes else ''
+            connection.execute(text(f'CREATE {unique}INDEX "{staging}_{suffix}_idx" ON "{staging}" ({column_list})'))
+        if primary_key:
+            column_list = ', '.join(f'"{column}"' for column in primary_key)
+            connection.execute(text(f'ALTER TABLE "{staging}" ADD CONSTRAINT "{staging}_pkey" PRIMARY KEY ({column_list})'))
+    print(f'Built the indexes/constraints of {staging} in %.3f seconds' % (time.time() - start))
+
+    ## Readers of `table_name` wait for this transaction, then see the new table
+    with engine.begin() as connection:
+        connection.execute(text(f'DROP TABLE IF EXISTS "{table_name}"'))
+        connection.execute(text(f'ALTER TABLE "{staging}" RENAME TO "{table_name}"'))
+        for suffix in indexes:
+            connection.execute(text(f'ALTER INDEX "{staging}_{suffix}_idx" RENAME TO "{table_name}_{suffix}_idx"'))
+        if primary_key:
+            connection.execute(text(f'ALTER TABLE "{table_name}" RENAME CONSTRAINT "{staging}_pkey" TO "{table_name}_pkey"'))
+        if on_swap is not None:
+            on_swap(connection)
+
+    ## Fresh statistics for the planner (autovacuum would only get to it later)
+    with engine.begin() as connection:
+        connection.execute(text(f'ANALYZE "{table_name}"'))
+    print(f'Swapped {staging} in as {table_name} and analyzed it in %.3f seconds' % (time.time() - start))
+
+
+def replace_table(df, table_name, engine, index=True, indexes=None, primary_key=None):
+    '''Atomically replace a table with a DataFrame via an UNLOGGED staging table (see `swap_in_staging()`)'''
+    staging = staging_table_name(table_name)
+    drop_table(engine, staging)
+    df.head(n=0).to_sql(name=staging, con=engine, index=index)
+    prepare_staging(engine, staging)
+    buffer, columns = df_to_csv_buffer(df, index=index)
+    copy_from_buffer(buffer, staging, columns, engine)
+    swap_in_staging(engine, table_name, indexes, primary_key)
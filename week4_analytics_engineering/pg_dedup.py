@@ -0,0 +1,131 @@
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+## For the per-service columns that identify a trip (and the compact amounts' exact values)
+from taxi_schema import compile_schema, expand_data
+## For COPYing each chunk into its dedup staging table
+from pg_bulk_load import load_methods, df_to_csv_buffer, copy_with_cursor
+from pg_partitions import source_month_column, month_bounds, table_kind
+
+'''
+Set-based deduplication of the trip rows while loading them, the same idea as the Kestra flows
+(`week2_workflow_orchestration/homework/postgres_taxi_scheduled.yml`):
+
+    unique_row_id = md5(VendorID || pickup || dropoff || PULocationID || DOLocationID || fare || distance)
+    MERGE INTO final USING staging ON final.unique_row_id = staging.unique_row_id
+    WHEN NOT MATCHED THEN INSERT ...
+
+but without an md5 per row:
+    - `row_hash()` hashes a whole chunk at once (`pd.util.hash_pandas_object()`), into a 64-bit
+        `unique_row_id` BIGINT column, from the service's `unique_columns` (see `taxi_schema.py`)
+    - `append_deduplicated()` COPYs each chunk into a temp table, then runs
+        INSERT INTO final SELECT ... FROM staging ON CONFLICT (unique_row_id) DO NOTHING
+      against a unique index on `unique_row_id`, so a row that is already in the table (or
+      earlier in the same chunk) is skipped. Unlike MERGE, ON CONFLICT is safe with concurrent
+      loaders and also works on Postgres < 15.
+So loading a file twice (e.g. a reload without a manifest entry) doesn't add any rows, and the
+dbt staging models' ROW_NUMBER() dedup only has to deal with older tables.
+
+The values are canonicalized before hashing, so a chunk hashes the same whether it was read with
+the default or the compact dtypes. A partitioned table's unique index has to include its
+partition key, so there it's on (`unique_row_id`, pickup), which the pickup in the hash makes
+equivalent.
+'''
+
+## The BIGINT column each row's hash is stored in
+unique_row_id_column = 'unique_row_id'
+
+
+def row_hash(df, columns):
+    '''64-bit hash of each row's `columns`, as int64 (for a BIGINT column)'''
+    ## Compact float32 amounts as the float64 values they stand for (12.34, not 12.34000015...)
+    df = expand_data(df[columns])
+    canonical = {}
+    for column in columns:
+        values = df[column]
+        if pd.api.types.is_datetime64_any_dtype(values.dtype):
+            ## Microseconds since the epoch, also for e.g. the FHV files' year 3019 dropoffs
+            canonical[column] = values.astype('datetime64[us]').to_numpy().view('int64')
+        elif pd.api.types.is_numeric_dtype(values.dtype) and not pd.api.types.is_bool_dtype(values.dtype):
+            ## Int64, int8[pyarrow], float32, ... all hash as their float64 value (or NaN)
+            canonical[column] = values.to_numpy(dtype='float64', na_value=np.nan)
+        else:
+            ## object, string[pyarrow] and category values all hash as Python strings (or None)
+            canonical[column] = values.to_numpy(dtype=object, na_value=None)
+
+    hashes = pd.util.hash_pandas_object(pd.DataFrame(canonical, copy=False), index=False)
+    return hashes.to_numpy().view('int64')
+
+
+def add_unique_row_id(df, service):
+    '''A chunk with the `unique_row_id` column of its rows added'''
+    return df.assign(**{unique_row_id_column: row_hash(df, compile_schema(service)['unique_columns'])})
+
+
+def conflict_columns(connection, table_name, pickup_column):
+    '''The columns of the unique index ON CONFLICT checks against'''
+    if table_kind(connection, table_name) == 'p':
+        return [unique_row_id_column, pickup_column]
+    return [unique_row_id_column]
+
+
+def ensure_unique_index(connection, table_name, pickup_column):
+    '''Create the unique index on `unique_row_id` if it doesn't exist yet'''
+    columns = connection.execute(text('SELECT column_name FROM information_schema.columns '
+                                      'WHERE table_schema = current_schema() AND table_name = :table_name'),
+                                 {'table_name': table_name}).scalars().all()
+    if unique_row_id_column not in columns:
+        ## Its rows would all have a NULL hash, so nothing loaded into it could be checked against them
+        raise ValueError(f'{table_name} has no {unique_row_id_column} column, rebuild it (e.g. with '
+                         'web_to_pg_bulk(..., dedup=True)) to load it with dedup')
+
+    column_list = ', '.join(f'"{column}"' for column in conflict_columns(connection, table_name, pickup_column))
+    connection.execute(text(f'CREATE UNIQUE INDEX IF NOT EXISTS "{table_name}_{unique_row_id_column}_idx" '
+                            f'ON "{table_name}" ({column_list})'))
+
+
+def append_deduplicated(df, table_name, pickup_column, connection, load_method='copy', month=None):
+    '''
+    Append the rows of a chunk (with its `unique_row_id`s) that aren't in the table yet, inside
+        the caller's transaction, returning how many were inserted
+        - With a `month`, rows are tagged with it (see `pg_partitions.py`) and routed by the parent table
+    '''
+    if load_method not in load_methods:
+        raise ValueError(f'Unknown load_method {load_method!r}, expected one of {load_methods}')
+
+    if month is not None:
+        df = df.assign(**{source_month_column: month_bounds(month)[0]})
+
+    ## A fresh one for each chunk, matching the table's current columns
+    staging = f'{table_name}__dedup'
+    connection.execute(text(f'CREATE TEMP TABLE "{staging}" (LIKE "{table_name}" INCLUDING DEFAULTS) ON COMMIT DROP'))
+
+    cursor = connection.connection.cursor()
+    if load_method == 'copy' and hasattr(cursor, 'copy_expert'):
+        buffer, columns = df_to_csv_buffer(df)
+        copy_with_cursor(cursor, buffer, staging, columns)
+    else:
+        df.to_sql(name=staging, con=connection, if_exists='append')
+        columns = [df.index.name or 'index'] + list(df.columns)
+
+    column_list = ', '.join(f'"{column}"' for column in columns)
+    conflict_list = ', '.join(f'"{column}"' for column in conflict_columns(connection, table_name, pickup_column))
+    result = connection.execute(text(f'INSERT INTO "{table_name}" ({column_list}) SELECT {column_list} FROM "{staging}" '
+                                     f'ON CONFLICT ({conflict_list}) DO NOTHING'))
+    connection.execute(text(f'DROP TABLE "{staging}"'))
+
+    return result.rowcount
+
+
+def delete_duplicates(engine, table_name):
+    '''
+    Keep one row per `unique_row_id` of a (bulk load staging) table, before its unique index is built
+        - Returns how many rows were deleted
+    '''
+    with engine.begin() as connection:
+        result = connection.execute(text(f'DELETE FROM "{table_name}" a USING "{table_name}" b '
+                                         f'WHERE a."{unique_row_id_column}" = b."{unique_row_id_column}" '
+                                         'AND a.ctid > b.ctid'))
+    print(f'Deleted {result.rowcount} duplicate rows from {table_name}')
+
+    return result.rowcount
@@ -0,0 +1,76 @@
+import threading
+from sqlalchemy import create_engine, inspect
+
+'''
+One pooled SQLAlchemy engine per database for the Postgres loaders, shared by every loader
+function and worker thread instead of each building its own engine (or opening raw psycopg2
+connections on the side).
+
+`create_pg_engine()` configures:
+    - the connection pool: `pool_size` connections kept open (plus up to `max_overflow` extra
+        ones), checked with a `SELECT 1` before use (`pool_pre_ping`) and replaced after
+        `pool_recycle` seconds, so a long backfill survives a restarted database
+    - `executemany_mode='values_plus_batch'` + `insertmanyvalues_page_size`: `to_sql()` INSERTs
+        (i.e. `load_method='insert'`) are sent as multi-row `INSERT ... VALUES` pages instead of
+        one statement per row
+    - per-session settings for bulk loads, sent as libpq `options` when each connection opens:
+        - `search_path`: the schema to load into
+        - `synchronous_commit=off`: a COMMIT returns before its WAL is flushed to disk. A crash can
+            lose the last few commits, but never corrupts anything, and the load manifest re-loads
+            whatever wasn't committed
+        - `work_mem`: memory per sort/hash (e.g. for the index builds and the dedup queries)
+
+`get_pg_engine()` returns the shared engine for a set of connection arguments, creating it on
+the first call. Keep the number of threads that load at once (`load_workers`) <= `pool_size`.
+
+Ref: https://docs.sqlalchemy.org/en/20/core/pooling.html
+Ref: https://docs.sqlalchemy.org/en/20/dialects/postgresql.html#psycopg2-fast-execution-helpers
+Ref: https://www.postgresql.org/docs/current/wal-async-commit.html
+'''
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def create_pg_engine(user, password, host, port, database, schema='public', pool_size=5, max_overflow=5,
+                     pool_pre_ping=True, pool_recycle=1800, insertmanyvalues_page_size=10000,
+                     synchronous_commit='off', work_mem='256MB'):
+    '''Create a pooled engine for bulk loading into `database` (see the module docstring for the settings)'''
+    print('Creating the engine...')
+    ## Need to convert a DDL statement into something Postgres will understand
+    ##   - via create_engine([database_type]://[user]:[password]@[hostname]:[port]/[database], con=[engine])
+    ##   - `+psycopg2` since COPY FROM STDIN goes through psycopg2's `copy_expert()` (SQLAlchemy 2.1
+    ##     defaults to psycopg 3 otherwise)
+    ## https://stackoverflow.com/questions/9298296/sqlalchemy-support-of-postgres-schemas/49930672#49930672
+    options = [f'-c search_path={schema}']
+    if synchronous_commit is not None:
+        options.append(f'-c synchronous_commit={synchronous_commit}')
+    if work_mem is not None:
+        options.append(f'-c work_mem={work_mem}')
+
+    return create_engine(f'postgresql+psycopg2://{user}:{password}@{host}:{port}/{database}',
+                         connect_args={'options': ' '.join(options)},
+                         pool_size=pool_size,
+                         max_overflow=max_overflow,
+                         pool_pre_ping=pool_pre_ping,
+                         pool_recycle=pool_recycle,
+                         executemany_mode='values_plus_batch',
+                         insertmanyvalues_page_size=insertmanyvalues_page_size)
+
+
+def get_pg_engine(user, password, host, port, database, **engine_kwargs):
+    '''Return the shared engine for these arguments, creating it on the first call'''
+    key = (user, host, str(port), database, tuple(sorted(engine_kwargs.items())))
+
+    ## Worker threads can ask for it at the same time
+    with _engines_lock:
+        if key not in _engines:
+            _engines[key] = create_pg_engine(user, password, host, port, database, **engine_kwargs)
+
+    return _engines[key]
+
+
+def table_exists(engine, table_name):
+    '''Whether `table_name` exists in the engine's `search_path` schema'''
+    with engine.connect() as connection:
+        return inspect(connection).has_table(table_name)
@@ -0,0 +1,155 @@
+import pandas as pd
+from sqlalchemy import text
+## For writing each chunk to its partition via COPY FROM STDIN
+from pg_bulk_load import load_methods, df_to_csv_buffer, copy_with_cursor
+
+'''
+Native Postgres range partitioning of the trip data tables by pickup month, instead of one heap
+table that every query (and every dbt model) has to scan in full.
+
+    yellow_trip_data                  PARTITION BY RANGE (tpep_pickup_datetime)
+        yellow_trip_data_p2019_01     FOR VALUES FROM ('2019-01-01') TO ('2019-02-01')
+        yellow_trip_data_p2019_02     ...
+        yellow_trip_data_default      DEFAULT
+
+- `create_partitioned_table()` creates the parent from a chunk's columns (like `to_sql()` would,
+    including its 'index' column), with a DEFAULT partition and an index on `source_month`
+- `ensure_month_partition()` creates a month's partition the first time a file of that month is
+    loaded, as a standalone table that's then ATTACHed. Rows of that month that were already in
+    the DEFAULT partition are moved into it first, and a matching CHECK constraint lets ATTACH
+    skip its validation scan.
+- `append_partitioned()` COPYs a chunk's rows straight into the file's own month partition
+- `drop_month()` replaces the DELETE of a month's rows when re-loading it: DETACH + DROP of its
+    partition, then an empty partition for the reload
+
+Every file has a few trips with pickups outside its own month (clock errors like 2008/2088, or
+trips over a month boundary). Those go through the parent, so they land in whichever partition
+covers their pickup (or the DEFAULT one). So that a reload can still replace exactly the rows of
+one file, every row is tagged with its file's month in a `source_month` column.
+`drop_month()` keeps the other files' rows that were in the dropped partition and deletes the
+reloaded file's rows from the other partitions (through the `source_month` index).
+'''
+
+## The column every row gets with the month of the file it came from
+source_month_column = 'source_month'
+
+
+def month_bounds(month):
+    '''[start, end) of the month a date/timestamp/'YYYY-MM' string falls in'''
+    start = pd.Timestamp(month).to_period('M').to_timestamp()
+    return start, start + pd.offsets.MonthBegin(1)
+
+
+def partition_name(table_name, month):
+    '''Name of a month's partition, e.g. yellow_trip_data_p2019_01'''
+    start, _ = month_bounds(month)
+    return f'{table_name}_p{start.year}_{start.month:02d}'
+
+
+def table_kind(connection, table_name):
+    '''`relkind` of a table: 'p' for a partitioned table, 'r' for a plain one, None if it doesn't exist'''
+    return connection.execute(text('SELECT relkind FROM pg_class WHERE oid = to_regclass(:table_name)'),
+                              {'table_name': table_name}).scalar()
+
+
+def create_partitioned_table(connection, table_name, df, pickup_column):
+    '''
+    Create `table_name` partitioned by `pickup_column`, with the columns `to_sql(df)` would create
+        plus `source_month` (a no-op if it's already partitioned)
+    '''
+    kind = table_kind(connection, table_name)
+    if kind == 'p':
+        return
+    if kind is not None:
+        raise ValueError(f'{table_name} already exists as a plain table, rebuild it (e.g. DROP it and reload) '
+                         'to load it partitioned')
+
+    ## The same column types as `to_sql()`, including its 'index' column
+    header = df.head(n=0).assign(**{source_month_column: pd.Series(dtype='datetime64[ns]')})
+    ddl = pd.io.sql.get_schema(header.reset_index(), table_name, con=connection)
+    connection.execute(text(f'{ddl} PARTITION BY RANGE ("{pickup_column}")'))
+    ## Rows with a NULL pickup or one in a month without a partition (yet)
+    connection.execute(text(f'CREATE TABLE "{table_name}_default" PARTITION OF "{table_name}" DEFAULT'))
+    connection.execute(text(f'CREATE INDEX "{table_name}_{source_month_column}_idx" '
+                            f'ON "{table_name}" ("{source_month_column}")'))
+
+
+def ensure_month_partition(connection, table_name, pickup_column, month):
+    '''Create and ATTACH the partition of a month if it doesn't exist yet, returning its name'''
+    partition = partition_name(table_name, month)
+    if table_kind(connection, partition) is not None:
+        return partition
+
+    start, end = month_bounds(month)
+    bounds = {'start': start.to_pydatetime(), 'end': end.to_pydatetime()}
+    in_range = f'"{pickup_column}" >= :start AND "{pickup_column}" < :end'
+
+    connection.execute(text(f'CREATE TABLE "{partition}" (LIKE "{table_name}" INCLUDING DEFAULTS)'))
+    ## Lets ATTACH PARTITION see the rows already fit, instead of scanning them
+    connection.execute(text(f'ALTER TABLE "{partition}" ADD CONSTRAINT "{partition}_range" '
+                            f'CHECK ("{pickup_column}" IS NOT NULL AND "{pickup_column}" >= '
+                            f"'{start}' AND \"{pickup_column}\" < '{end}')"))
+    ## The DEFAULT partition can't keep rows in the new partition's range
+    connection.execute(text(f'WITH moved AS (DELETE FROM "{table_name}_default" WHERE {in_range} RETURNING *) '
+                            f'INSERT INTO "{partition}" SELECT * FROM moved'), bounds)
+    connection.execute(text(f'ALTER TABLE "{table_name}" ATTACH PARTITION "{partition}" '
+                            f"FOR VALUES FROM ('{start}') TO ('{end}')"))
+    connection.execute(text(f'ALTER TABLE "{partition}" DROP CONSTRAINT "{partition}_range"'))
+    print(f'Created partition {partition} of {table_name}')
+
+    return partition
+
+
+def append_partitioned(df, table_name, pickup_column, month, connection, load_method='copy'):
+    '''
+    Append a chunk of a monthly file inside the caller's transaction (like `pg_bulk_load.append_chunk()`)
+        - Rows picked up in the file's month go straight into its partition, the rest through
+          the parent table, which routes them by their pickup
+    '''
+    if load_method not in load_methods:
+        raise ValueError(f'Unknown load_method {load_method!r}, expected one of {load_methods}')
+
+    start, end = month_bounds(month)
+    df = df.assign(**{source_month_column: start})
+    in_month = ((df[pickup_column] >= start) & (df[pickup_column] < end)).to_numpy(dtype=bool, na_value=False)
+
+    cursor = connection.connection.cursor()
+    for target, rows in [(partition_name(table_name, month), df[in_month]), (table_name, df[~in_month])]:
+        if len(rows.index) == 0:
+            continue
+        if load_method == 'copy' and hasattr(cursor, 'copy_expert'):
+            buffer, columns = df_to_csv_buffer(rows)
+            copy_with_cursor(cursor, buffer, target, columns)
+        else:
+            load_method = 'insert'
+            rows.to_sql(name=target, con=connection, if_exists='append')
+
+    return load_method
+
+
+def drop_month(connection, table_name, pickup_column, month):
+    '''
+    Remove every row that came from a month's file before reloading it, without a DELETE over the
+        whole table: DETACH + DROP its partition (keeping other files' rows that were in it), delete
+        its rows from the other partitions and start over with an empty partition
+    '''
+    start, _ = month_bounds(month)
+    partition = partition_name(table_name, month)
+    kept = f'{partition}_kept'
+    source_month = {'source_month': start.to_pydatetime()}
+
+    if table_kind(connection, partition) is not None:
+        connection.execute(text(f'CREATE TEMP TABLE "{kept}" ON COMMIT DROP AS SELECT * FROM "{partition}" '
+                                f'WHERE "{source_month_column}" <> :source_month'), source_month)
+        connection.execute(text(f'ALTER TABLE "{table_name}" DETACH PARTITION "{partition}"'))
+        connection.execute(text(f'DROP TABLE "{partition}"'))
+        print(f'Dropped partition {partition} of {table_name}')
+    else:
+        kept = None
+
+    ## Only this file's few trips picked up in other months are left
+    connection.execute(text(f'DELETE FROM "{table_name}" WHERE "{source_month_column}" = :source_month'), source_month)
+
+    ensure_month_partition(connection, table_name, pickup_column, month)
+    if kept is not None:
+        connection.execute(text(f'INSERT INTO "{table_name}" SELECT * FROM "{kept}"'))
@@ -0,0 +1,211 @@
+## For running the download, decompress and parse stages at the same time
+import io
+import queue
+import threading
+import zlib
+import pandas as pd
+import pyarrow.csv as pa_csv
+from downloader import get_session, chunk_size
+## For sizing the parsed chunks from their measured rows/sec and memory
+from adaptive_chunks import ChunkSizer, iter_adaptive_chunks
+
+'''
+Pipelined "download -> gunzip -> parse" for the monthly `.csv.gz` files.
+
+Rather than downloading the whole file, then decompressing and parsing it, each stage
+runs in its own thread and hands its output to the next one through a bounded queue:
+
+    HTTP response --(compressed blocks)--> zlib decompressor --(CSV bytes)--> pd.read_csv(iterator=True)
+        --(DataFrame chunks)--> the caller (i.e. the loader)
+
+so loading starts as soon as the first chunk is parsed, and the total time approaches
+the slowest stage instead of the sum of all of them. Peak memory is bounded by the
+queue depths times the block/chunk sizes rather than by the size of the file.
+
+`stream_csv_batches()` is the same pipeline with `pyarrow.csv.open_csv()` as the parse stage,
+yielding Arrow RecordBatches instead of pandas DataFrames.
+'''
+
+## Marks the end of a stage's output
+_done = object()
+
+
+class _Failed:
+    '''Passes an exception from a stage thread on to the next stage'''
+    def __init__(self, error):
+        self.error = error
+
+
+def _put(q, item, stop):
+    '''Put onto a bounded queue, giving up if the pipeline has been stopped'''
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _get(q, stop):
+    '''Get the next item from the previous stage, re-raising its error if it failed'''
+    while True:
+        try:
+            item = q.get(timeout=0.1)
+            break
+        except queue.Empty:
+            ## Treat a stopped pipeline like the end of the data so every stage winds down
+            if stop.is_set():
+                return _done
+    if isinstance(item, _Failed):
+        raise item.error
+    return item
+
+
+def _download_stage(url, session, out_q, stop):
+    try:
+        with session.get(url, stream=True, timeout=60) as r:
+            r.raise_for_status()
+            for block in r.iter_content(chunk_size=chunk_size):
+                if not _put(out_q, block, stop):
+                    return
+        _put(out_q, _done, stop)
+    except Exception as e:
+        _put(out_q, _Failed(e), stop)
+
+
+def _decompress_stage(in_q, out_q, stop):
+    try:
+        ## `16 + MAX_WBITS` = expect a gzip header
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        while True:
+            block = _get(in_q, stop)
+            if block is _done:
+                break
+            data = decompressor.decompress(block)
+            ## A .gz file can be several gzip "members" back to back
+            while decompressor.eof and decompressor.unused_data:
+                leftover = decompressor.unused_data
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                data += decompressor.decompress(leftover)
+            if data and not _put(out_q, data, stop):
+                return
+        _put(out_q, decompressor.flush(), stop)
+        _put(out_q, _done, stop)
+    except Exception as e:
+        _put(out_q, _Failed(e), stop)
+
+
+class _QueueReader(io.RawIOBase):
+    '''File-like object that reads the decompressed bytes coming out of a queue'''
+
+    def __init__(self, in_q, stop):
+        self.in_q = in_q
+        self.stop = stop
+        self.buffer = b''
+        self.finished = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.buffer and not self.finished:
+            block = _get(self.in_q, self.stop)
+            if block is _done:
+                self.finished = True
+            else:
+                ## A memoryview so handing out the block piece by piece doesn't copy it
+                self.buffer = memoryview(block)
+        n = min(len(b), len(self.buffer))
+        b[:n] = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+        return n
+
+
+def _parse_stage(in_q, out_q, stop, chunksize, sizer, transform, read_csv_kwargs):
+    try:
+        reader = io.BufferedReader(_QueueReader(in_q, stop), buffer_size=chunk_size)
+        if sizer is not None:
+            ## Each chunk is timed until it's been put on the (bounded) queue, so once the queue is
+            ##  full, a slow loader downstream slows the measured rows/sec down too
+            chunks = iter_adaptive_chunks(pd.read_csv(reader, iterator=True, **read_csv_kwargs), sizer, transform)
+        else:
+            chunks = (df if transform is None else transform(df)
+                      for df in pd.read_csv(reader, chunksize=chunksize, **read_csv_kwargs))
+        try:
+            for df in chunks:
+                if not _put(out_q, df, stop):
+                    return
+        finally:
+            ## Closes the reader (and prints the chunk sizes) when the pipeline is stopped early, too
+            chunks.close()
+        _put(out_q, _done, stop)
+    except Exception as e:
+        _put(out_q, _Failed(e), stop)
+
+
+def _parse_arrow_stage(in_q, out_q, stop, read_options, convert_options):
+    try:
+        reader = io.BufferedReader(_QueueReader(in_q, stop), buffer_size=chunk_size)
+        for batch in pa_csv.open_csv(reader, read_options=read_options, convert_options=convert_options):
+            if not _put(out_q, batch, stop):
+                return
+        _put(out_q, _done, stop)
+    except Exception as e:
+        _put(out_q, _Failed(e), stop)
+
+
+def _run_stages(url, session, queue_depth, parse_stage, parse_args):
+    '''Start the download/decompress/parse threads and yield what the parse stage puts out'''
+    session = session or get_session()
+    stop = threading.Event()
+    compressed_q = queue.Queue(maxsize=queue_depth)
+    csv_q = queue.Queue(maxsize=queue_depth)
+    out_q = queue.Queue(maxsize=queue_depth)
+
+    stages = [
+        threading.Thread(target=_download_stage, args=(url, session, compressed_q, stop), daemon=True),
+        threading.Thread(target=_decompress_stage, args=(compressed_q, csv_q, stop), daemon=True),
+        threading.Thread(target=parse_stage, args=(csv_q, out_q, stop, *parse_args), daemon=True),
+    ]
+    for stage in stages:
+        stage.start()
+
+    try:
+        while True:
+            item = _get(out_q, stop)
+            if item is _done:
+                break
+            yield item
+    finally:
+        ## Also stops the other stages if the caller fails or stops early
+        stop.set()
+
+
+def stream_csv_chunks(url, chunksize=None, queue_depth=4, transform=None, session=None, sizer=None, **read_csv_kwargs):
+    '''
+    Yield (optionally transformed) DataFrame chunks of a remote `.csv.gz` file while it's still downloading
+        - By default the chunks are sized adaptively by a `ChunkSizer` (see `adaptive_chunks.py`, or
+          pass your own `sizer`), or pass a fixed `chunksize`
+        - `queue_depth` is how many blocks/chunks each stage can get ahead of the next one
+        - `transform` (e.g. `clean_data`) is applied to each chunk in the parse thread
+    '''
+    if chunksize is None and sizer is None:
+        ## Each file gets its own sizer, like `iter_clean_chunks()`'s
+        sizer = ChunkSizer(name=url.rsplit('/', 1)[-1])
+    elif chunksize is not None:
+        sizer = None
+    yield from _run_stages(url, session, queue_depth, _parse_stage, (chunksize, sizer, transform, read_csv_kwargs))
+
+
+def stream_csv_batches(url, block_size=16 * 1024 * 1024, queue_depth=4, column_types=None, session=None):
+    '''
+    Yield Arrow RecordBatches of a remote `.csv.gz` file while it's still downloading
+        - Each batch is parsed from about `block_size` bytes of CSV
+        - `column_types` pins column types (e.g. `compile_schema(service)['read_arrow_types']`), since
+          otherwise each block's types are inferred on their own and can disagree
+    '''
+    read_options = pa_csv.ReadOptions(block_size=block_size)
+    ## Empty strings are NULLs, like `pd.read_csv()` reads them (by default Arrow keeps them as '')
+    convert_options = pa_csv.ConvertOptions(column_types=column_types or {}, strings_can_be_null=True)
+    yield from _run_stages(url, session, queue_depth, _parse_arrow_stage, (read_options, convert_options))
@@ -0,0 +1,452 @@
+import argparse
+import gzip
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+
+'''
+Synthetic monthly yellow, green and FHV files, so the loaders can be tested (and load tested at
+10M-100M rows per file) without downloading the TLC's files from GitHub releases/CloudFront.
+
+The files have the raw layout of the DataTalksClub CSVs/the TLC's Parquet files, including the
+quirks `taxi_schema.clean_data()` handles:
+    - the raw column names (VendorID, RatecodeID, PULocationID, PUlocationID, dropOff_datetime, SR_Flag, ...)
+    - NaN-able INTs: the trips without a vendor have no passenger_count/RatecodeID/
+        store_and_fwd_flag either, so those columns are written as e.g. '1.0' in the CSVs (and
+        are doubles in the Parquet files). Green trips also have no payment_type/trip_type then,
+        yellow ones a payment_type of 0, and ehail_fee is always empty.
+    - pickups outside the file's month (the previous month's last day, 2008, 2088)
+    - FHV files: mostly empty PUlocationID/SR_Flag, and dropOff_datetime typos 1000 years ahead
+        (e.g. 3019), at least one per file
+    - duplicate (VendorID, pickup) rows (dispatching_base_num for FHV), half of them exact copies
+        of another trip, half only sharing its key
+
+Zones are drawn from dbt's `seeds/taxi_zone_lookup.csv`: a fixed share of trips per borough for
+each service (yellow trips mostly in Manhattan, green ones in the outer boroughs), and within a
+borough a Zipf-like popularity over a seeded shuffle of its zones, so every month has the same
+"busy" zones. Distances, durations and amounts are drawn to be consistent with each other.
+
+Everything is generated a chunk (`chunk_rows`) at a time with vectorized NumPy, from a generator
+seeded by (seed, service, year, month, chunk number), so a file is the same on every run and
+machine for the same arguments. Each chunk is turned into an Arrow table and written by a
+background thread while the next one is generated:
+    - .csv.gz/.csv: `pyarrow.csv.write_csv()` (~8x faster than `to_csv()`), gzipped at
+        `compresslevel` 1 by default (level 9 is ~7x slower for ~30% smaller files)
+    - .parquet: one row group per chunk, with the TLC's types (timestamps, NaN-able INTs as doubles)
+
+Generate e.g. a year of 10M row files in 4 processes with
+    python synthetic_taxi_data.py --services yellow green fhv --year 2019 --rows 10000000 --workers 4
+and serve --output_dir over HTTP (`python -m http.server`) in place of the release URLs.
+'''
+
+zones_seed = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dbt_cloud', 'seeds', 'taxi_zone_lookup.csv')
+
+services = ['yellow', 'green', 'fhv']
+formats = ['csv.gz', 'csv', 'parquet']
+
+## The raw columns of each service's files in their order, with how they're written:
+##  - int: always set, int64 in Parquet
+##  - nullable_int: NaN-able INTs, '1.0' or empty in the CSVs, doubles in Parquet
+##  - float, datetime, string
+raw_columns = {
+    'yellow': {
+        'VendorID': 'nullable_int',
+        'tpep_pickup_datetime': 'datetime',
+        'tpep_dropoff_datetime': 'datetime',
+        'passenger_count': 'nullable_int',
+        'trip_distance': 'float',
+        'RatecodeID': 'nullable_int',
+        'store_and_fwd_flag': 'string',
+        'PULocationID': 'int',
+        'DOLocationID': 'int',
+        'payment_type': 'int',
+        'fare_amount': 'float',
+        'extra': 'float',
+        'mta_tax': 'float',
+        'tip_amount': 'float',
+        'tolls_amount': 'float',
+        'improvement_surcharge': 'float',
+        'total_amount': 'float',
+        'congestion_surcharge': 'float'
+    },
+    'green': {
+        'VendorID': 'nullable_int',
+        'lpep_pickup_datetime': 'datetime',
+        'lpep_dropoff_datetime': 'datetime',
+        'store_and_fwd_flag': 'string',
+        'RatecodeID': 'nullable_int',
+        'PULocationID': 'int',
+        'DOLocationID': 'int',
+        'passenger_count': 'nullable_int',
+        'trip_distance': 'float',
+        'fare_amount': 'float',
+        'extra': 'float',
+        'mta_tax': 'float',
+        'tip_amount': 'float',
+        'tolls_amount': 'float',
+        'ehail_fee': 'float',
+        'improvement_surcharge': 'float',
+        'total_amount': 'float',
+        'payment_type': 'nullable_int',
+        'trip_type': 'nullable_int',
+        'congestion_surcharge': 'float'
+    },
+    'fhv': {
+        'dispatching_base_num': 'string',
+        'pickup_datetime': 'datetime',
+        'dropOff_datetime': 'datetime',
+        'PUlocationID': 'nullable_int',
+        'DOlocationID': 'nullable_int',
+        'SR_Flag': 'nullable_int',
+        'Affiliated_base_number': 'string'
+    }
+}
+
+_parquet_types = {
+    'int': pa.int64(),
+    'nullable_int': pa.float64(),
+    'float': pa.float64(),
+    'datetime': pa.timestamp('us'),
+    'string': pa.string()
+}
+
+## Share of each service's trips picked up (or dropped off) in each borough
+borough_shares = {
+    'yellow': {'Manhattan': 0.88, 'Queens': 0.07, 'Brooklyn': 0.03, 'Bronx': 0.005, 'Staten Island': 0.0005,
+               'EWR': 0.002, 'Unknown': 0.0125},
+    'green': {'Manhattan': 0.2, 'Brooklyn': 0.38, 'Queens': 0.3, 'Bronx': 0.1, 'Staten Island': 0.002,
+              'EWR': 0.001, 'Unknown': 0.017},
+    'fhv': {'Manhattan': 0.3, 'Brooklyn': 0.28, 'Queens': 0.2, 'Bronx': 0.16, 'Staten Island': 0.04,
+            'EWR': 0.005, 'Unknown': 0.015}
+}
+
+## Share of the trips per hour of the day (quiet nights, morning and evening peaks)
+_hourly = np.array([3, 2, 1.5, 1, 1, 1.5, 3, 4.5, 5, 5, 5, 5, 5.5, 5.5, 5.5, 5.5, 5.5, 6, 6.5, 6.5, 6, 5.5, 5, 4])
+hourly_shares = _hourly / _hourly.sum()
+
+## Where the quirks come from in the real files
+missing_fraction = 0.01          ## Trips without a vendor (and passenger_count, RatecodeID, ...)
+duplicate_fraction = 0.001       ## Rows with the (VendorID, pickup) of another row
+outside_month_fraction = 0.0001  ## Pickups outside the file's month
+out_of_bounds_fraction = 0.00001 ## FHV dropoffs 1000 years ahead
+
+## FHV bases, and how often a trip's dispatching/affiliated bases and locations are missing
+fhv_bases = 800
+fhv_missing = {'PUlocationID': 0.8, 'DOlocationID': 0.15, 'Affiliated_base_number': 0.05}
+fhv_shared_ride_fraction = 0.05
+
+
+def file_name(service, year, month, file_format):
+    '''The TLC's name of a monthly file, e.g. yellow_tripdata_2019-01.csv.gz'''
+    return f'{service}_tripdata_{year}-{month:02d}.{file_format}'
+
+
+def file_format_of(path):
+    '''csv.gz, csv or parquet, from a file's name'''
+    for file_format in formats:
+        if path.endswith(f'.{file_format}'):
+            return file_format
+    raise ValueError(f'Unknown file format of {path}, expected one of {formats}')
+
+
+@lru_cache(maxsize=None)
+def zone_distribution(service, seed):
+    '''(LocationIDs, probabilities) of a service's pickups/dropoffs, the same for every month of a seed'''
+    zones = pd.read_csv(zones_seed)
+    rng = np.random.default_rng([seed, services.index(service)])
+    ids, weights = [], []
+    for borough, share in borough_shares[service].items():
+        borough_ids = zones.loc[zones['borough'] == borough, 'locationid'].to_numpy()
+        ## Zipf-like popularity over a seeded shuffle of the borough's zones
+        popularity = 1.0 / np.arange(1, len(borough_ids) + 1) ** 1.1
+        ids.append(rng.permutation(borough_ids))
+        weights.append(share * popularity / popularity.sum())
+    weights = np.concatenate(weights)
+    return np.concatenate(ids), weights / weights.sum()
+
+
+def chunk_rng(seed, service, year, month, chunk):
+    '''A chunk's own generator, so each chunk is the same whatever order they're generated in'''
+    return np.random.default_rng([seed, services.index(service), year, month, chunk])
+
+
+def pickup_times(rng, rows, year, month):
+    '''Pickups over the month by hour of the day, with a few outside it (datetime64[s])'''
+    start = np.datetime64(f'{year}-{month:02d}', 'M')
+    days = ((start + 1).astype('datetime64[D]') - start.astype('datetime64[D]')).astype(int)
+    seconds = (rng.integers(0, days, rows) * 86400 + rng.choice(24, rows, p=hourly_shares) * 3600
+               + rng.integers(0, 3600, rows))
+    pickup = start.astype('datetime64[s]') + seconds
+
+    ## The previous month's last day and clock errors in 2008/2088
+    outside = np.flatnonzero(rng.random(rows) < outside_month_fraction)
+    days_before = np.array([start.astype('datetime64[D]') - 1, np.datetime64('2008-12-31'), np.datetime64('2088-01-01')])
+    pickup[outside] = (days_before[rng.integers(0, 3, len(outside))].astype('datetime64[s]')
+                       + rng.integers(0, 86400, len(outside)))
+    return pickup
+
+
+def nullable(values, missing):
+    '''Integer codes as floats, NaN where `missing`'''
+    return np.where(missing, np.nan, values)
+
+
+def duplicate_rows(columns, rng, key_columns):
+    '''
+    Give a `duplicate_fraction` of the rows the key (and dropoff) of another row, and copy every
+        other column of half of them as well
+    '''
+    rows = len(next(iter(columns.values())))
+    duplicates = np.flatnonzero(rng.random(rows) < duplicate_fraction)
+    originals = rng.integers(0, rows, len(duplicates))
+    exact = rng.random(len(duplicates)) < 0.5
+    for column, values in columns.items():
+        if column in key_columns:
+            values[duplicates] = values[originals]
+        else:
+            values[duplicates[exact]] = values[originals[exact]]
+
+
+def make_trips(service, rows, rng, year, month, seed):
+    '''A chunk of yellow or green trips, as {raw column: NumPy array}'''
+    prefix = 'tpep' if service == 'yellow' else 'lpep'
+    zone_ids, zone_p = zone_distribution(service, seed)
+    missing = rng.random(rows) < missing_fraction
+
+    pickup = pickup_times(rng, rows, year, month)
+    distance = np.where(rng.random(rows) < 0.01, 0.0, rng.gamma(1.6, 1.9, rows).round(2))
+    ## Minutes at 3-45 mph, plus a minute to get going
+    speed = np.clip(rng.gamma(6.0, 2.0, rows), 3.0, 45.0)
+    minutes = distance / speed * 60 + 1 + rng.exponential(2.0, rows)
+    dropoff = pickup + (minutes * 60).astype('int64')
+
+    rate_code = rng.choice([1, 2, 3, 4, 5, 6], rows, p=[0.97, 0.015, 0.002, 0.003, 0.009, 0.001])
+    ## Metered fares in $0.50 steps, except the JFK flat fare
+    fare = np.where(rate_code == 2, 52.0, np.round((2.5 + 2.5 * distance + 0.25 * minutes) * 2) / 2)
+    hour = (pickup.astype('datetime64[h]') - pickup.astype('datetime64[D]')).astype(int)
+    extra = np.where((hour >= 20) | (hour < 6), 0.5, np.where((hour >= 16) & (hour < 20), 1.0, 0.0))
+    payment_type = rng.choice([1, 2, 3, 4], rows, p=[0.7, 0.28, 0.012, 0.008])
+    tip = np.where(payment_type == 1, (fare * rng.uniform(0.1, 0.3, rows)).round(2), 0.0)
+    tolls = np.where(rng.random(rows) < 0.05, 5.76, 0.0)
+    mta_tax = np.full(rows, 0.5)
+    improvement_surcharge = np.full(rows, 0.3)
+    congestion = np.where(rng.random(rows) < (0.9 if service == 'yellow' else 0.1), 2.5, 0.0)
+    total = (fare + extra + mta_tax + tip + tolls + improvement_surcharge + congestion).round(2)
+
+    columns = {
+        'VendorID': nullable(rng.integers(1, 3, rows), missing),
+        f'{prefix}_pickup_datetime': pickup,
+        f'{prefix}_dropoff_datetime': dropoff,
+        'passenger_count': nullable(rng.choice(7, rows, p=[0.02, 0.7, 0.14, 0.04, 0.02, 0.05, 0.03]), missing),
+        'trip_distance': distance,
+        'RatecodeID': nullable(rate_code, missing),
+        ## Codes into ['N', 'Y'], -1 = NULL
+        'store_and_fwd_flag': np.where(missing, -1, (rng.random(rows) < 0.01).astype('int64')),
+        'PULocationID': rng.choice(zone_ids, rows, p=zone_p),
+        'DOLocationID': rng.choice(zone_ids, rows, p=zone_p),
+        'fare_amount': fare,
+        'extra': extra,
+        'mta_tax': mta_tax,
+        'tip_amount': tip,
+        'tolls_amount': tolls,
+        'improvement_surcharge': improvement_surcharge,
+        'total_amount': total,
+        'congestion_surcharge': congestion
+    }
+    if service == 'yellow':
+        ## Unknown payment types are 0 in the yellow files...
+        columns['payment_type'] = np.where(missing, 0, payment_type)
+    else:
+        ## ... and NULL in the green ones
+        columns['payment_type'] = nullable(payment_type, missing)
+        columns['trip_type'] = nullable(np.where(rng.random(rows) < 0.02, 2, 1), missing)
+        columns['ehail_fee'] = np.full(rows, np.nan)
+
+    duplicate_rows(columns, rng, ['VendorID', f'{prefix}_pickup_datetime', f'{prefix}_dropoff_datetime'])
+    return columns
+
+
+def make_fhv_trips(rows, rng, year, month, seed, chunk=0):
+    '''A chunk of FHV trips, as {raw column: NumPy array}'''
+    zone_ids, zone_p = zone_distribution('fhv', seed)
+
+    ## A few big bases dispatch most trips
+    base_p = 1.0 / np.arange(1, fhv_bases + 1)
+    base = rng.choice(fhv_bases, rows, p=base_p / base_p.sum())
+    affiliated = np.where(rng.random(rows) < 0.85, base, rng.choice(fhv_bases, rows, p=base_p / base_p.sum()))
+
+    pickup = pickup_times(rng, rows, year, month)
+    dropoff = pickup + (rng.gamma(2.0, 9.0, rows) * 60 + 60).astype('int64')
+    ## Typos like 3019 for 2019 (at least one per file), out of bounds for datetime64[ns]
+    typos = np.flatnonzero(rng.random(rows) < out_of_bounds_fraction)
+    if rows and not typos.size and chunk == 0:
+        typos = np.array([0])
+    years = dropoff[typos].astype('datetime64[Y]')
+    dropoff[typos] = (years + 1000).astype('datetime64[s]') + (dropoff[typos] - years.astype('datetime64[s]'))
+
+    columns = {
+        ## Codes into the 'B00000'... bases, -1 = NULL
+        'dispatching_base_num': base,
+        'pickup_datetime': pickup,
+        'dropOff_datetime': dropoff,
+        'PUlocationID': nullable(rng.choice(zone_ids, rows, p=zone_p), rng.random(rows) < fhv_missing['PUlocationID']),
+        'DOlocationID': nullable(rng.choice(zone_ids, rows, p=zone_p), rng.random(rows) < fhv_missing['DOlocationID']),
+        'SR_Flag': np.where(rng.random(rows) < fhv_shared_ride_fraction, 1.0, np.nan),
+        'Affiliated_base_number': np.where(rng.random(rows) < fhv_missing['Affiliated_base_number'], -1, affiliated)
+    }
+
+    duplicate_rows(columns, rng, ['dispatching_base_num', 'pickup_datetime', 'dropOff_datetime'])
+    return columns
+
+
+def string_categories(service, column):
+    '''The strings a string column's codes stand for'''
+    if service == 'fhv':
+        return [f'B{base:05d}' for base in range(fhv_bases)]
+    return ['N', 'Y']
+
+
+def nullable_int_strings(values):
+    '''A NaN-able INT column as the strings the CSVs have ('1.0', NULL), dictionary-encoded'''
+    missing = np.isnan(values)
+    codes = np.where(missing, 0, values).astype('int32')
+    dictionary = pa.array([f'{value}.0' for value in range(int(codes.max(initial=0)) + 1)])
+    return pa.DictionaryArray.from_arrays(pa.array(codes, mask=missing), dictionary)
+
+
+def to_arrow(columns, service, file_format):
+    '''A chunk's columns as an Arrow table in the raw layout, with the CSV or Parquet types'''
+    arrays = {}
+    for column, kind in raw_columns[service].items():
+        values = columns[column]
+        if kind == 'string':
+            dictionary = pa.array(string_categories(service, column))
+            array = pa.DictionaryArray.from_arrays(pa.array(values.astype('int32'), mask=values < 0), dictionary)
+        elif kind == 'nullable_int' and file_format != 'parquet':
+            array = nullable_int_strings(values)
+        elif kind in ('nullable_int', 'float'):
+            ## NaN -> NULL
+            array = pa.array(values, mask=np.isnan(values))
+        else:
+            array = pa.array(values)
+        if file_format == 'parquet':
+            array = array.cast(_parquet_types[kind])
+        arrays[column] = array
+    return pa.table(arrays)
+
+
+def make_chunk(service, rows, year, month, seed=42, chunk=0):
+    '''One chunk of a service's file as {raw column: NumPy array} (see `to_arrow()`)'''
+    rng = chunk_rng(seed, service, year, month, chunk)
+    if service == 'fhv':
+        return make_fhv_trips(rows, rng, year, month, seed, chunk)
+    return make_trips(service, rows, rng, year, month, seed)
+
+
+class ChunkWriter:
+    '''Writes Arrow tables to a .csv.gz, .csv or .parquet file'''
+
+    def __init__(self, path, service, file_format, compresslevel=1):
+        self.file_format = file_format
+        self.service = service
+        if self.file_format == 'parquet':
+            schema = pa.schema([(column, _parquet_types[kind]) for column, kind in raw_columns[service].items()])
+            self.writer = pq.ParquetWriter(path, schema)
+        else:
+            self.writer = gzip.open(path, 'wb', compresslevel=compresslevel) if self.file_format == 'csv.gz' \
+                else open(path, 'wb')
+            ## Arrow would quote the header
+            self.writer.write((','.join(raw_columns[service]) + '\n').encode())
+
+    def write(self, table):
+        if self.file_format == 'parquet':
+            self.writer.write_table(table)
+        else:
+            buffer = pa.BufferOutputStream()
+            pa_csv.write_csv(table, buffer, pa_csv.WriteOptions(include_header=False, quoting_style='none'))
+            self.writer.write(buffer.getvalue())
+
+    def close(self):
+        self.writer.close()
+
+
+def write_month(path, service, rows, year, month, seed=42, chunk_rows=1000000, compresslevel=1):
+    '''
+    Write a monthly file of `rows` synthetic trips, its format picked by the extension of `path`
+        - Returns how many rows were written
+    '''
+    if service not in services:
+        raise ValueError(f'Unknown service {service!r}, expected one of {services}')
+    file_format = file_format_of(path)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    start = time.perf_counter()
+    ## Written to a .part file first, so an interrupted run never leaves a truncated file behind
+    writer = ChunkWriter(f'{path}.part', service, file_format, compresslevel=compresslevel)
+    ## One chunk is written in the background while the next one is generated
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        pending = None
+        for chunk, offset in enumerate(range(0, rows, chunk_rows)):
+            table = to_arrow(make_chunk(service, min(chunk_rows, rows - offset), year, month, seed, chunk),
+                             service, file_format)
+            if pending is not None:
+                pending.result()
+            pending = pool.submit(writer.write, table)
+        if pending is not None:
+            pending.result()
+    writer.close()
+    os.replace(f'{path}.part', path)
+
+    end = time.perf_counter()
+    print(f'Wrote {rows} rows to {path} in %.3f seconds (%.0f rows/sec)' % (end - start, rows / (end - start)))
+    return rows
+
+
+def write_zone_lookup(path):
+    '''The zones from dbt's seed, with the TLC's header (as the loaders download them)'''
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    pd.read_csv(zones_seed).rename(columns={'locationid': 'LocationID', 'borough': 'Borough', 'zone': 'Zone'}) \
+        .to_csv(path, index=False)
+
+
+def write_file(args, service, month, file_format):
+    '''Write one of the CLI's files (in a worker process)'''
+    path = os.path.join(args.output_dir, service, file_name(service, args.year, month, file_format))
+    return write_month(path, service, args.rows, args.year, month, seed=args.seed, chunk_rows=args.chunk_rows,
+                       compresslevel=args.compresslevel)
+
+
+def main(args):
+    start = time.perf_counter()
+    write_zone_lookup(os.path.join(args.output_dir, 'misc', 'taxi_zone_lookup.csv'))
+
+    files = [(service, month, file_format) for service in args.services for month in args.months
+             for file_format in args.formats]
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        rows = sum(pool.map(write_file, [args] * len(files), *zip(*files)))
+
+    end = time.perf_counter()
+    print(f'Wrote {rows} rows in {len(files)} files in %.3f seconds' % (end - start))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate synthetic NYC taxi trip files')
+    parser.add_argument('--services', nargs='+', choices=services, default=services)
+    parser.add_argument('--year', type=int, default=2019)
+    parser.add_argument('--months', nargs='+', type=int, default=list(range(1, 13)))
+    parser.add_argument('--rows', type=int, default=1000000, help='Rows of each monthly file')
+    parser.add_argument('--formats', nargs='+', choices=formats, default=['csv.gz'])
+    parser.add_argument('--output_dir', default='./data/synthetic')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--chunk_rows', type=int, default=1000000)
+    parser.add_argument('--compresslevel', type=int, default=1, help='gzip level of the .csv.gz files')
+    parser.add_argument('--workers', type=int, default=1, help='Files generated in parallel')
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,353 @@
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+'''
+One declarative schema per taxi service, shared by every loader's `clean_data()`.
+
+Each schema lists:
+    - `renames`: source column names -> database/data warehouse column names
+    - `dtypes`: the target data type of each (renamed) column
+    - `datetime_columns` and the `datetime_format` they're written in
+    - `voided_payment_types`: payment_type values to replace with 6 (= voided trip, according to the
+        data dictionary), where `None` means NULL
+        https://www.nyc.gov/assets/tlc/downloads/pdf/data_dictionary_trip_records_green.pdf
+
+`compile_schema()` turns that into the arguments for one rename, one `astype()` pass and one
+explicit-format datetime parse per datetime column, which `clean_data()` (pandas DataFrames)
+and `clean_batch()` (pyarrow RecordBatches) both apply. `read_csv_kwargs()` gives the matching
+`dtype=` for `pd.read_csv()`, keyed by the *source* column names as well, and `read_arrow_types`
+the matching `column_types=` for `pyarrow.csv`.
+
+`compact=True` (see `compact_data()`) keeps a chunk in the smallest dtypes that hold its values
+losslessly instead, so a loader can read bigger chunks in the same memory:
+    - `compact_dtypes`: Arrow-backed int8/int16 for the IDs and codes, a categorical for the Y/N
+        flag and Arrow strings for the other strings, all read with `dtype_backend='pyarrow'`
+    - the amounts become float32 when every value of the chunk round-trips through float32 at
+        2 decimals (they're dollars and cents), and `expand_data()` widens them back to the exact
+        float64 values before a chunk is written out
+Compare the memory per column with `python benchmark_compact_dtypes.py`.
+'''
+
+## Nullable INTs, since files can have NAN values in INT fields
+## https://pandas.pydata.org/pandas-docs/stable/user_guide/integer_na.html#integer-na
+_int = pd.Int64Dtype()
+
+## Compact dtypes, for `compact_data()`
+##  - The ints are Arrow-backed, which `to_sql()` still creates as BIGINT columns
+_int8 = pd.ArrowDtype(pa.int8())
+_int16 = pd.ArrowDtype(pa.int16())
+_string = pd.ArrowDtype(pa.string())
+_flag = 'category'
+
+## Amounts are written with (at most) this many decimals
+_amount_decimals = 2
+
+## Every parsed datetime column, whichever way it's read: the unit of the Parquet files' timestamps,
+##  which also holds e.g. the FHV files' year 3019 dropoffs (out of bounds for nanoseconds)
+datetime_dtype = 'datetime64[us]'
+
+_trip_renames = {
+    'VendorID': 'vendor_id',
+    'PULocationID': 'pu_location_id',
+    'DOLocationID': 'do_location_id',
+    'RatecodeID': 'rate_code_id'
+}
+
+_trip_amounts = {
+    'fare_amount': float,
+    'extra': float,
+    'mta_tax': float,
+    'tip_amount': float,
+    'tolls_amount': float,
+    'improvement_surcharge': float,
+    'total_amount': float,
+    'congestion_surcharge': float
+}
+
+taxi_schemas = {
+    'yellow': {
+        'renames': _trip_renames,
+        'dtypes': {
+            'vendor_id': _int,
+            'passenger_count': _int,
+            'trip_distance': float,
+            'rate_code_id': _int,
+            'store_and_fwd_flag': str,
+            'pu_location_id': _int,
+            'do_location_id': _int,
+            'payment_type': _int,
+            **_trip_amounts
+        },
+        'compact_dtypes': {
+            'vendor_id': _int8,
+            'passenger_count': _int16,
+            'rate_code_id': _int16,
+            'store_and_fwd_flag': _flag,
+            'pu_location_id': _int16,
+            'do_location_id': _int16,
+            'payment_type': _int8
+        },
+        'datetime_columns': ['tpep_pickup_datetime', 'tpep_dropoff_datetime'],
+        'datetime_format': '%Y-%m-%d %H:%M:%S',
+        ## What identifies a trip for deduplication, the same columns as the Kestra flows' `unique_row_id`
+        'unique_columns': ['vendor_id', 'tpep_pickup_datetime', 'tpep_dropoff_datetime', 'pu_location_id',
+                           'do_location_id', 'fare_amount', 'trip_distance'],
+        'voided_payment_types': [0]
+    },
+    'green': {
+        'renames': _trip_renames,
+        'dtypes': {
+            'vendor_id': _int,
+            'passenger_count': _int,
+            'trip_distance': float,
+            'rate_code_id': _int,
+            'store_and_fwd_flag': str,
+            'pu_location_id': _int,
+            'do_location_id': _int,
+            'payment_type': _int,
+            **_trip_amounts,
+            'ehail_fee': float,
+            'trip_type': _int
+        },
+        'compact_dtypes': {
+            'vendor_id': _int8,
+            'passenger_count': _int16,
+            'rate_code_id': _int16,
+            'store_and_fwd_flag': _flag,
+            'pu_location_id': _int16,
+            'do_location_id': _int16,
+            'payment_type': _int8,
+            'trip_type': _int8
+        },
+        'datetime_columns': ['lpep_pickup_datetime', 'lpep_dropoff_datetime'],
+        'datetime_format': '%Y-%m-%d %H:%M:%S',
+        'unique_columns': ['vendor_id', 'lpep_pickup_datetime', 'lpep_dropoff_datetime', 'pu_location_id',
+                           'do_location_id', 'fare_amount', 'trip_distance'],
+        'voided_payment_types': [None]
+    },
+    'fhv': {
+        ## Both spellings of the SR flag show up in the source files
+        'renames': {
+            'dropOff_datetime': 'dropoff_datetime',
+            'PUlocationID': 'pu_location_id',
+            'DOlocationID': 'do_location_id',
+            'SR_Flag': 'sr_flag',
+            'SR_flag': 'sr_flag',
+            'Affiliated_base_number': 'affiliated_base_number'
+        },
+        'dtypes': {
+            'dispatching_base_num': str,
+            'pu_location_id': _int,
+            'do_location_id': _int,
+            ## A DOUBLE in the source files that should be an INT
+            'sr_flag': _int,
+            'affiliated_base_number': str
+        },
+        'compact_dtypes': {
+            'dispatching_base_num': _string,
+            'pu_location_id': _int16,
+            'do_location_id': _int16,
+            'sr_flag': _int8,
+            'affiliated_base_number': _string
+        },
+        'datetime_columns': ['pickup_datetime', 'dropoff_datetime'],
+        'datetime_format': '%Y-%m-%d %H:%M:%S',
+        ## No fare/distance (or vendor) columns, so every column
+        'unique_columns': ['dispatching_base_num', 'pickup_datetime', 'dropoff_datetime', 'pu_location_id',
+                           'do_location_id', 'sr_flag', 'affiliated_base_number'],
+        'voided_payment_types': []
+    }
+}
+
+## pandas target dtype -> Arrow type, for `clean_batch()`
+_arrow_types = {
+    _int: pa.int64(),
+    float: pa.float64(),
+    str: pa.string()
+}
+
+
+@lru_cache(maxsize=None)
+def compile_schema(service):
+    '''Pre-compute everything `clean_data()`/`clean_batch()`/`read_csv_kwargs()` need for a service'''
+    schema = taxi_schemas[service]
+
+    ## `pd.read_csv()` applies dtypes *before* our renames, so key them by every source name too
+    read_dtypes = {column: dtype for column, dtype in schema['dtypes'].items()}
+    read_dtypes.update({old: schema['dtypes'][new] for old, new in schema['renames'].items() if new in schema['dtypes']})
+
+    ## Same for `pyarrow.csv`, which also parses these datetimes natively while reading
+    ##  - NaN-able INTs are written as e.g. '1.0' in the CSVs, which Arrow only reads as a float
+    ##    (`clean_batch()` casts them back, failing if anything was not a whole number)
+    read_arrow_types = {column: pa.float64() if dtype is _int else _arrow_types[dtype]
+                        for column, dtype in read_dtypes.items()}
+    read_arrow_types.update({column: pa.timestamp('us') for column in schema['datetime_columns']})
+    read_arrow_types.update({old: pa.timestamp('us') for old, new in schema['renames'].items()
+                             if new in schema['datetime_columns']})
+
+    ## With `compact=True`, pin the strings/flags/datetimes (still parsed by `clean_data()`) and let
+    ##  `dtype_backend='pyarrow'` infer the numbers, which `compact_data()` then downcasts
+    compact_read_dtypes = {column: _string for column in schema['datetime_columns']}
+    compact_read_dtypes.update({column: schema['compact_dtypes'].get(column, _string)
+                                for column, dtype in schema['dtypes'].items() if dtype is str})
+    compact_read_dtypes.update({old: compact_read_dtypes[new] for old, new in schema['renames'].items()
+                                if new in compact_read_dtypes})
+
+    return {
+        'renames': schema['renames'],
+        ## Strings are left as read, only numeric columns go through `astype()`
+        'astype': {column: dtype for column, dtype in schema['dtypes'].items() if dtype is not str},
+        'arrow_types': {column: _arrow_types[dtype] for column, dtype in schema['dtypes'].items()},
+        'datetime_columns': schema['datetime_columns'],
+        ## The first datetime column is always the pickup time
+        'pickup_column': schema['datetime_columns'][0],
+        'datetime_format': schema['datetime_format'],
+        'voided_payment_types': [value for value in schema['voided_payment_types'] if value is not None],
+        'void_null_payment_types': None in schema['voided_payment_types'],
+        'read_dtypes': read_dtypes,
+        'read_arrow_types': read_arrow_types,
+        'compact_astype': schema['compact_dtypes'],
+        'float_columns': [column for column, dtype in schema['dtypes'].items() if dtype is float],
+        'unique_columns': schema['unique_columns'],
+        'compact_read_dtypes': compact_read_dtypes
+    }
+
+
+def read_csv_kwargs(service, compact=False):
+    '''
+    `dtype=` argument for reading a service's CSV files
+        - The datetimes are left as strings, `clean_data()` parses them faster with the explicit format
+        - `compact=True` reads Arrow-backed columns instead, for `clean_data(..., compact=True)`
+    '''
+    schema = compile_schema(service)
+    if compact:
+        return {'dtype': schema['compact_read_dtypes'], 'dtype_backend': 'pyarrow'}
+    return {'dtype': schema['read_dtypes']}
+
+
+def parse_datetimes(values, schema):
+    '''
+    Parse a column of datetime strings in the schema's `datetime_format` into `datetime_dtype`,
+        failing on anything that isn't in exactly that format
+    '''
+    try:
+        ## Arrow's strptime is strict and much faster than `pd.to_datetime()`, and zero-copy for
+        ##  Arrow-backed strings (pandas' default `str` dtype, or `dtype_backend='pyarrow'`).
+        ##  NULLs/NaN become NaT.
+        parsed = pc.strptime(pa.array(values, type=pa.large_string(), from_pandas=True),
+                             format=schema['datetime_format'], unit='us')
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        ## Something that isn't in the expected format, so let pandas say what's wrong with it
+        return pd.to_datetime(values, format=schema['datetime_format']).astype(datetime_dtype)
+    return pd.Series(parsed.to_numpy(zero_copy_only=False), index=values.index, name=values.name).astype(datetime_dtype)
+
+
+def clean_data(df, service, compact=False):
+    '''Fix datatype issues (into the compact dtypes of `compact_data()` with `compact=True`)'''
+    schema = compile_schema(service)
+
+    ## Rename columns to be better suited for a database/data warehouse table
+    df = df.rename(columns=schema['renames'])
+
+    ## Fix datetimes (Parquet files already have timestamps)
+    for column in schema['datetime_columns']:
+        if column in df.columns and not pd.api.types.is_datetime64_any_dtype(df[column]):
+            df[column] = parse_datetimes(df[column], schema)
+
+    ## Cast every numeric column in one pass, only touching columns that aren't already the right type
+    if compact:
+        df = compact_data(df, service)
+    else:
+        casts = {column: dtype for column, dtype in schema['astype'].items()
+                 if column in df.columns and df[column].dtype != dtype}
+        if casts:
+            df = df.astype(casts)
+
+    ## Replace voided payment_type values with 6
+    if 'payment_type' in df.columns and (schema['voided_payment_types'] or schema['void_null_payment_types']):
+        voided = df['payment_type'].isin(schema['voided_payment_types'])
+        if schema['void_null_payment_types']:
+            voided = voided | df['payment_type'].isna()
+        df['payment_type'] = df['payment_type'].mask(voided.fillna(False).astype(bool), 6)
+
+    return df
+
+
+def compact_data(df, service):
+    '''
+    Downcast a chunk to the service's compact dtypes, without losing any values
+        - IDs/codes/flags/strings get the schema's `compact_dtypes`
+        - Each amount column becomes float32 if all of its values survive the round trip at
+          2 decimals, otherwise float64
+    '''
+    schema = compile_schema(service)
+
+    for column in schema['float_columns']:
+        if column in df.columns and df[column].dtype != np.float32:
+            values = df[column].to_numpy(dtype='float64', na_value=np.nan)
+            compact = values.astype('float32')
+            lossless = np.array_equal(np.round(compact.astype('float64'), _amount_decimals), values, equal_nan=True)
+            df[column] = compact if lossless else values
+
+    casts = {column: dtype for column, dtype in schema['compact_astype'].items()
+             if column in df.columns and df[column].dtype != dtype}
+    if casts:
+        df = df.astype(casts)
+
+    return df
+
+
+def expand_data(df):
+    '''
+    Widen `compact_data()`'s float32 columns back to their exact float64 values before writing a chunk
+        (`to_sql()` would create them as REAL columns, and `to_csv()` writes float32 12.34 as
+        12.34000015258789)
+    '''
+    float32_columns = [column for column in df.columns if df[column].dtype == np.float32]
+    if float32_columns:
+        df = df.assign(**{column: df[column].astype('float64').round(_amount_decimals) for column in float32_columns})
+    return df
+
+
+def memory_report(before, after):
+    '''Per-column memory (in bytes) of the same cleaned chunk without/with `compact=True`, plus a TOTAL row'''
+    report = pd.DataFrame({
+        'before': before.memory_usage(index=False, deep=True),
+        'after': after.memory_usage(index=False, deep=True)
+    })
+    report.loc['TOTAL'] = report.sum()
+    report['after_dtype'] = pd.Series({column: str(dtype) for column, dtype in after.dtypes.items()}).reindex(report.index, fill_value='')
+    report['saved'] = (1 - report['after'] / report['before']).map('{:.0%}'.format)
+    return report
+
+
+def clean_batch(batch, service):
+    '''Same fixes as `clean_data()`, but on a pyarrow RecordBatch using Arrow compute kernels'''
+    schema = compile_schema(service)
+
+    ## Rename columns
+    batch = batch.rename_columns([schema['renames'].get(name, name) for name in batch.schema.names])
+    columns = {name: batch.column(name) for name in batch.schema.names}
+
+    ## Fix datetimes
+    for column in schema['datetime_columns']:
+        if column in columns and not pa.types.is_timestamp(columns[column].type):
+            columns[column] = pc.strptime(columns[column], format=schema['datetime_format'], unit='us')
+
+    ## Fix data types
+    for column, arrow_type in schema['arrow_types'].items():
+        if column in columns and columns[column].type != arrow_type:
+            columns[column] = pc.cast(columns[column], arrow_type)
+
+    ## Replace voided payment_type values with 6
+    if 'payment_type' in columns:
+        payment_type = columns['payment_type']
+        voided = pc.is_in(payment_type, value_set=pa.array(schema['voided_payment_types'], payment_type.type))
+        if schema['void_null_payment_types']:
+            voided = pc.or_(voided, pc.is_null(payment_type))
+        columns['payment_type'] = pc.if_else(voided, pa.scalar(6, payment_type.type), payment_type)
+
+    return pa.RecordBatch.from_arrays(list(columns.values()), names=list(columns.keys()))
@@ -0,0 +1,91 @@
+import functools
+import http.server
+import os
+import sys
+import threading
+import uuid
+import pytest
+
+## The week4 modules are scripts next to this directory rather than a package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from synthetic_taxi_data import write_month
+
+'''
+Shared fixtures: small synthetic monthly files (see `synthetic_taxi_data.py`), a local HTTP
+server for the downloaders, so the tests run offline, and a throwaway schema in Postgres.
+
+The Postgres tests use the database from docker-compose.yml (root/root@localhost:5432/ny_taxi),
+or the one the libpq environment variables (PGUSER, PGPASSWORD, PGHOST, PGPORT, PGDATABASE) point
+at, and are skipped when it isn't reachable.
+'''
+
+## Enough rows for the synthetic files' NULLs, duplicates and out-of-month pickups to show up
+rows = 2000
+
+
+@pytest.fixture(scope='session')
+def month_file(tmp_path_factory):
+    '''`month_file(service, file_format='csv.gz', month=1)`: path of a synthetic 2019 file, written once per session'''
+    directory = tmp_path_factory.mktemp('synthetic')
+
+    @functools.lru_cache(maxsize=None)
+    def make(service, file_format='csv.gz', month=1):
+        path = str(directory / f'{service}_tripdata_2019-{month:02d}.{file_format}')
+        write_month(path, service, rows, 2019, month)
+        return path
+
+    return make
+
+
+class _QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture(scope='session')
+def http_server(tmp_path_factory):
+    '''(directory, base URL) of a local HTTP server, serving whatever is written to the directory'''
+    directory = tmp_path_factory.mktemp('http')
+    handler = functools.partial(_QuietHandler, directory=str(directory))
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    yield directory, f'http://127.0.0.1:{server.server_address[1]}'
+
+    server.shutdown()
+    server.server_close()
+
+
+def pg_settings():
+    '''Connection arguments of the Postgres to test against'''
+    return {'user': os.environ.get('PGUSER', 'root'), 'password': os.environ.get('PGPASSWORD', 'root'),
+            'host': os.environ.get('PGHOST', 'localhost'), 'port': os.environ.get('PGPORT', '5432'),
+            'database': os.environ.get('PGDATABASE', 'ny_taxi')}
+
+
+@pytest.fixture
+def pg_engine():
+    '''A pooled engine (see `pg_engine.py`) whose `search_path` is a fresh schema, dropped after the test'''
+    from sqlalchemy import text
+    from sqlalchemy.exc import OperationalError
+    from pg_engine import create_pg_engine
+
+    schema = f'test_{uuid.uuid4().hex[:12]}'
+    admin = create_pg_engine(**pg_settings(), pool_size=1)
+    try:
+        with admin.begin() as connection:
+            connection.execute(text(f'CREATE SCHEMA {schema}'))
+    except OperationalError as e:
+        admin.dispose()
+        pytest.skip(f'No Postgres to test against: {e.orig}')
+
+    engine = create_pg_engine(**pg_settings(), schema=schema, pool_size=2)
+    try:
+        yield engine
+    finally:
+        engine.dispose()
+        with admin.begin() as connection:
+            connection.execute(text(f'DROP SCHEMA {schema} CASCADE'))
+        admin.dispose()
@@ -0,0 +1,36 @@
+import io
+import pyarrow as pa
+import pyarrow.parquet as pq
+from arrow_stream import write_batches
+
+schema = pa.schema([('trip_distance', pa.float64())])
+
+
+def batch(rows):
+    return pa.RecordBatch.from_pylist([{'trip_distance': float(i)} for i in range(rows)], schema=schema)
+
+
+def test_write_batches_buffers_full_row_groups():
+    f = io.BytesIO()
+
+    assert write_batches([batch(3), batch(3), batch(3)], f, row_group_size=4) == 9
+
+    metadata = pq.read_metadata(io.BytesIO(f.getvalue()))
+    assert [metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)] == [4, 4, 1]
+
+
+def test_write_batches_writes_nothing_without_batches():
+    ## Not even a 0-byte file's worth: there's no schema for a valid Parquet file
+    f = io.BytesIO()
+
+    assert write_batches(iter([]), f) == 0
+    assert f.getvalue() == b''
+
+
+def test_write_batches_writes_an_empty_file_with_a_schema():
+    f = io.BytesIO()
+
+    assert write_batches(iter([]), f, schema=schema) == 0
+
+    table = pq.read_table(io.BytesIO(f.getvalue()))
+    assert table.num_rows == 0 and table.schema == schema
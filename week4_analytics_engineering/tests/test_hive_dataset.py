@@ -0,0 +1,94 @@
+import fnmatch
+import os
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import pytest
+from hive_dataset import partition_path, data_files_glob, write_partition, write_summary
+from taxi_schema import read_csv_kwargs, clean_data
+from conftest import rows
+
+pickup_column = 'tpep_pickup_datetime'
+
+
+def read_table(month_file, month=1):
+    df = clean_data(pd.read_csv(month_file('yellow', month=month), **read_csv_kwargs('yellow')), 'yellow')
+    return pa.Table.from_pandas(df, preserve_index=False)
+
+
+def part_files(root, month):
+    return sorted(os.listdir(os.path.join(root, partition_path('yellow', 2019, month))))
+
+
+def test_partition_path():
+    assert partition_path('yellow', 2019) == 'service=yellow/year=2019'
+    ## Months aren't zero-padded, like pyarrow's hive partitioning writes them
+    assert partition_path('green', '2019', '03') == 'service=green/year=2019/month=3'
+
+
+@pytest.mark.parametrize('profile', ['zstd', 'zstd_sorted'])
+def test_write_partition_splits_a_month_evenly(tmp_path, month_file, profile):
+    table = read_table(month_file)
+
+    files = write_partition(table, str(tmp_path), 'yellow', 2019, 1, files_per_partition=3, profile=profile)
+
+    assert [path for path, _ in files] == [f'service=yellow/year=2019/month=1/part-{i:05d}.parquet' for i in range(3)]
+    assert [metadata.num_rows for _, metadata in files] == [667, 667, 666]
+    written = pq.read_table(os.path.join(tmp_path, partition_path('yellow', 2019, 1)))
+    assert written.num_rows == rows
+    if profile == 'zstd_sorted':
+        ## Sorted before it's split, so the files are in pickup order too
+        pickups = pd.concat([pq.read_table(os.path.join(tmp_path, path)).column(pickup_column).to_pandas()
+                             for path, _ in files], ignore_index=True)
+        assert pickups.dropna().is_monotonic_increasing
+
+
+def test_write_partition_never_writes_empty_files(tmp_path, month_file):
+    table = read_table(month_file)
+    root = str(tmp_path)
+    write_partition(table, root, 'yellow', 2019, 1, files_per_partition=4)
+
+    ## Fewer rows than files: one file per row, and the earlier run's extra files are gone
+    files = write_partition(table.slice(0, 2), root, 'yellow', 2019, 1, files_per_partition=4)
+    assert [metadata.num_rows for _, metadata in files] == [1, 1]
+    assert part_files(root, 1) == ['part-00000.parquet', 'part-00001.parquet']
+
+    ## An empty month removes its partition altogether
+    assert write_partition(table.slice(0, 0), root, 'yellow', 2019, 1, files_per_partition=4) == []
+    assert not os.path.exists(os.path.join(root, partition_path('yellow', 2019, 1)))
+
+
+def test_write_summary_plans_the_whole_year_from_metadata(tmp_path, month_file):
+    root = str(tmp_path)
+    files = write_partition(read_table(month_file, 1), root, 'yellow', 2019, 1, files_per_partition=2) \
+        + write_partition(read_table(month_file, 2), root, 'yellow', 2019, 2, files_per_partition=3)
+
+    assert write_summary(root, 'yellow', 2019, files) == ['service=yellow/year=2019/_common_metadata',
+                                                          'service=yellow/year=2019/_metadata']
+
+    dataset = ds.parquet_dataset(os.path.join(root, partition_path('yellow', 2019), '_metadata'), partitioning='hive')
+    assert len(dataset.files) == 5
+    assert dataset.count_rows() == 2 * rows
+    assert dataset.count_rows(filter=ds.field('month') == 2) == rows
+
+    ## Every month empty: the earlier summary goes too
+    assert write_summary(root, 'yellow', 2019, []) == []
+    assert not os.path.exists(os.path.join(root, partition_path('yellow', 2019), '_metadata'))
+
+
+def test_data_files_leave_out_the_summaries(tmp_path, month_file):
+    root = str(tmp_path)
+    files = write_partition(read_table(month_file, 1), root, 'yellow', 2019, 1, files_per_partition=2)
+    summary = write_summary(root, 'yellow', 2019, files)
+    written = [os.path.relpath(os.path.join(directory, name), root).replace(os.sep, '/')
+               for directory, _, names in os.walk(root) for name in names]
+    data_files = [path for path, _ in files]
+
+    ## What the BigQuery external table's URI picks up
+    assert sorted(fnmatch.filter(written, data_files_glob('yellow'))) == data_files
+    assert not fnmatch.filter(summary, data_files_glob('yellow'))
+    ## and a hive partitioned `pyarrow.dataset` of the service
+    dataset = ds.dataset(os.path.join(root, 'service=yellow'), partitioning='hive')
+    assert sorted(os.path.relpath(path, root).replace(os.sep, '/') for path in dataset.files) == data_files
+    assert dataset.count_rows() == rows
@@ -0,0 +1,77 @@
+import pandas as pd
+import pytest
+from sqlalchemy import text
+import upload_all_data_postgres_csv as loader
+from load_manifest import begin_file, is_complete, pending_rows, manifest_table, chunks_table
+from taxi_schema import read_csv_kwargs, clean_data
+from conftest import rows
+
+file_name = 'green_tripdata_2019-01.csv.gz'
+
+
+@pytest.fixture
+def engine(pg_engine, monkeypatch):
+    ## `load_chunks()` uses the module's engine, like `benchmark_ingestion.py` sets it
+    monkeypatch.setattr(loader, 'engine', pg_engine, raising=False)
+    return pg_engine
+
+
+def chunks(path, chunksize, fail_after=None):
+    '''The file's cleaned chunks, raising a RuntimeError instead of the chunk after `fail_after`'''
+    for i, df in enumerate(pd.read_csv(path, chunksize=chunksize, **read_csv_kwargs('green'))):
+        if i == fail_after:
+            raise RuntimeError('connection lost')
+        yield clean_data(df, 'green')
+
+
+def loaded_index(engine):
+    '''The `index` column (the row number in the file) of every loaded row, in order'''
+    with engine.connect() as connection:
+        return connection.execute(text('SELECT index FROM green_trip_data ORDER BY index')).scalars().all()
+
+
+def test_pending_rows_skips_committed_rows_whatever_the_chunk_size():
+    state = {'committed_rows': 1000, 'row_offset': 0}
+
+    assert [pending_rows(state, 700) for _ in range(3)] == [700, 300, 0]
+
+
+def test_load_chunks_resumes_a_partial_load(engine, month_file):
+    path = month_file('green')
+
+    with pytest.raises(RuntimeError):
+        loader.load_chunks(chunks(path, 500, fail_after=2), 'green', file_name, content_hash='abc')
+    assert loaded_index(engine) == list(range(1000))
+    assert not is_complete(engine, file_name)
+
+    ## The rerun reads the file in other chunks, starting in the middle of the second one
+    stats = loader.load_chunks(chunks(path, 700), 'green', file_name, content_hash='abc')
+
+    assert stats['rows'] == rows
+    assert loaded_index(engine) == list(range(rows))
+    assert is_complete(engine, file_name)
+    with engine.connect() as connection:
+        assert connection.execute(text(f'SELECT rows FROM {manifest_table}')).scalar() == rows
+        committed = connection.execute(text(f'SELECT start_row, rows FROM {chunks_table} ORDER BY chunk_index')).all()
+    assert [tuple(row) for row in committed] == [(0, 500), (500, 500), (1000, 400), (1400, 600)]
+
+
+def test_load_chunks_skips_a_complete_file(engine, month_file):
+    path = month_file('green')
+    loader.load_chunks(chunks(path, 500), 'green', file_name)
+
+    ## Failing on the first chunk shows it isn't read at all
+    stats = loader.load_chunks(chunks(path, 500, fail_after=0), 'green', file_name)
+
+    assert stats['skipped'] and stats['rows'] == rows
+    assert loaded_index(engine) == list(range(rows))
+
+
+def test_begin_file_refuses_to_resume_a_changed_file(engine, month_file):
+    with pytest.raises(RuntimeError):
+        loader.load_chunks(chunks(month_file('green'), 500, fail_after=1), 'green', file_name, content_hash='abc')
+
+    with pytest.raises(ValueError):
+        begin_file(engine, file_name, 'green_trip_data', 'def')
+    ## Without a hash to compare, it resumes
+    assert begin_file(engine, file_name, 'green_trip_data')['committed_rows'] == 500
@@ -0,0 +1,41 @@
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine, text
+from pg_bulk_load import supports_copy, copy_with_cursor, load_chunk, df_to_csv_buffer
+
+df = pd.DataFrame({'vendor_id': pd.array([1, None], dtype='Int64'), 'store_and_fwd_flag': ['N', None]})
+
+
+def table_rows(engine, table_name):
+    with engine.connect() as connection:
+        return connection.execute(text(f'SELECT vendor_id, store_and_fwd_flag FROM "{table_name}" ORDER BY "index"')).all()
+
+
+def test_load_chunk_copies_into_postgres(pg_engine):
+    assert supports_copy(pg_engine)
+
+    assert load_chunk(df, 'trips', pg_engine, 'copy')[0] == 2
+    assert load_chunk(df, 'trips', pg_engine, 'copy')[0] == 2
+
+    ## Each chunk's 'index' starts at 0 again
+    assert table_rows(pg_engine, 'trips') == [(1, 'N'), (1, 'N'), (None, None), (None, None)]
+
+
+def test_load_chunk_falls_back_to_inserts_without_psycopg2(tmp_path, capsys):
+    engine = create_engine(f'sqlite:///{tmp_path / "trips.db"}')
+    assert not supports_copy(engine)
+
+    assert load_chunk(df, 'trips', engine, 'copy')[0] == 2
+
+    assert 'via insert' in capsys.readouterr().out
+    assert table_rows(engine, 'trips') == [(1, 'N'), (None, None)]
+
+
+def test_copy_with_cursor_needs_a_psycopg2_cursor(tmp_path):
+    engine = create_engine(f'sqlite:///{tmp_path / "trips.db"}')
+    raw_conn = engine.raw_connection()
+    buffer, columns = df_to_csv_buffer(df)
+
+    with pytest.raises(TypeError):
+        copy_with_cursor(raw_conn.cursor(), buffer, 'trips', columns)
+    raw_conn.close()
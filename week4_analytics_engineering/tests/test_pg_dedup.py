@@ -0,0 +1,85 @@
+import numpy as np
+import pandas as pd
+import pytest
+from sqlalchemy import text
+from pg_dedup import row_hash, add_unique_row_id, ensure_unique_index, append_deduplicated, unique_row_id_column
+from pg_partitions import create_partitioned_table, ensure_month_partition
+from taxi_schema import compile_schema, read_csv_kwargs, clean_data
+
+services = ['yellow', 'green', 'fhv']
+table_name = 'green_trip_data'
+pickup_column = 'lpep_pickup_datetime'
+
+
+def read_clean(path, service, compact=False):
+    return clean_data(pd.read_csv(path, **read_csv_kwargs(service, compact)), service, compact)
+
+
+@pytest.mark.parametrize('service', services)
+def test_row_hash_is_the_same_for_default_and_compact_dtypes(month_file, service):
+    columns = compile_schema(service)['unique_columns']
+
+    hashes = row_hash(read_clean(month_file(service), service), columns)
+
+    assert hashes.dtype == np.int64
+    assert np.array_equal(hashes, row_hash(read_clean(month_file(service), service, compact=True), columns))
+
+
+@pytest.mark.parametrize('service', services)
+def test_row_hash_tells_rows_apart(month_file, service):
+    columns = compile_schema(service)['unique_columns']
+    df = read_clean(month_file(service), service)
+
+    hashes = row_hash(df, columns)
+
+    ## One hash per distinct trip, the synthetic files' duplicates included
+    assert len(set(hashes)) == len(df.drop_duplicates(subset=columns).index) < len(df.index)
+    ## Any of the columns changes it
+    for column in columns:
+        changed = df.head(1).copy()
+        changed[column] = df[column].dropna().iloc[0] if changed[column].isna().all() else None
+        assert row_hash(changed, columns)[0] != hashes[0], column
+
+
+def table_rows(connection):
+    return connection.execute(text(f'SELECT COUNT(*) FROM "{table_name}"')).scalar()
+
+
+@pytest.mark.parametrize('load_method', ['copy', 'insert'])
+def test_append_deduplicated_skips_rows_already_loaded(pg_engine, month_file, load_method):
+    df = add_unique_row_id(read_clean(month_file('green'), 'green'), 'green')
+    distinct = df[unique_row_id_column].nunique()
+
+    with pg_engine.begin() as connection:
+        df.head(n=0).to_sql(name=table_name, con=connection)
+        ensure_unique_index(connection, table_name, pickup_column)
+
+        ## The file's own duplicates are skipped the first time
+        assert append_deduplicated(df, table_name, pickup_column, connection, load_method) == distinct
+        assert append_deduplicated(df, table_name, pickup_column, connection, load_method) == 0
+        ## and a reload in other chunks adds nothing either
+        for start in range(0, len(df.index), 700):
+            assert append_deduplicated(df.iloc[start:start + 700], table_name, pickup_column, connection,
+                                       load_method) == 0
+        assert table_rows(connection) == distinct
+
+
+def test_append_deduplicated_into_a_partitioned_table(pg_engine, month_file):
+    df = add_unique_row_id(read_clean(month_file('green'), 'green'), 'green')
+
+    with pg_engine.begin() as connection:
+        create_partitioned_table(connection, table_name, df, pickup_column)
+        ensure_month_partition(connection, table_name, pickup_column, '2019-01')
+        ensure_unique_index(connection, table_name, pickup_column)
+
+        inserted = append_deduplicated(df, table_name, pickup_column, connection, month='2019-01')
+        assert append_deduplicated(df, table_name, pickup_column, connection, month='2019-01') == 0
+        assert table_rows(connection) == inserted == df[unique_row_id_column].nunique()
+
+
+def test_ensure_unique_index_needs_the_hash_column(pg_engine, month_file):
+    df = read_clean(month_file('green'), 'green')
+
+    with pg_engine.begin() as connection, pytest.raises(ValueError):
+        df.head(n=0).to_sql(name=table_name, con=connection)
+        ensure_unique_index(connection, table_name, pickup_column)
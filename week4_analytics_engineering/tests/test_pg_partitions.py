@@ -0,0 +1,124 @@
+import os
+import shutil
+from functools import partial
+import pandas as pd
+import pytest
+from sqlalchemy import text
+from pg_partitions import month_bounds, partition_name, table_kind, create_partitioned_table, ensure_month_partition, \
+    append_partitioned, drop_month, source_month_column
+from taxi_schema import read_csv_kwargs, clean_data
+from conftest import rows
+
+table_name = 'yellow_trip_data'
+pickup_column = 'tpep_pickup_datetime'
+
+
+def read_month(month_file, month):
+    return clean_data(pd.read_csv(month_file('yellow', month=month), **read_csv_kwargs('yellow')), 'yellow')
+
+
+def rows_per_partition(connection):
+    '''{partition: row count} of the table's partitions that have rows'''
+    counts = connection.execute(text(f'SELECT tableoid::regclass::text, COUNT(*) FROM "{table_name}" GROUP BY 1'))
+    return dict(counts.all())
+
+
+def load_month(connection, df, month):
+    ensure_month_partition(connection, table_name, pickup_column, month)
+    append_partitioned(df, table_name, pickup_column, month, connection)
+
+
+def test_month_bounds_and_partition_name():
+    assert month_bounds('2019-12-31 23:59:59') == (pd.Timestamp('2019-12-01'), pd.Timestamp('2020-01-01'))
+    assert partition_name(table_name, '2019-03') == 'yellow_trip_data_p2019_03'
+
+
+def test_ensure_month_partition_moves_rows_out_of_the_default_partition(pg_engine, month_file):
+    january, february = read_month(month_file, 1), read_month(month_file, 2)
+    in_february = february[pickup_column].between('2019-02-01', '2019-02-28 23:59:59')
+
+    with pg_engine.begin() as connection:
+        create_partitioned_table(connection, table_name, january, pickup_column)
+        assert table_kind(connection, table_name) == 'p'
+        load_month(connection, january, '2019-01')
+        ## February's rows before it has a partition, like an earlier file's trips over the month boundary
+        february.assign(**{source_month_column: pd.Timestamp('2019-02-01')}) \
+            .to_sql(name=table_name, con=connection, if_exists='append')
+        before = rows_per_partition(connection)
+
+        assert ensure_month_partition(connection, table_name, pickup_column, '2019-02') == 'yellow_trip_data_p2019_02'
+        after = rows_per_partition(connection)
+        ## Idempotent
+        assert ensure_month_partition(connection, table_name, pickup_column, '2019-02') == 'yellow_trip_data_p2019_02'
+        assert rows_per_partition(connection) == after
+
+    assert after['yellow_trip_data_p2019_02'] == in_february.sum() > 0
+    assert after.get('yellow_trip_data_default', 0) == before['yellow_trip_data_default'] - in_february.sum()
+    assert after['yellow_trip_data_p2019_01'] == before['yellow_trip_data_p2019_01']
+    assert sum(after.values()) == len(january.index) + len(february.index)
+
+
+def test_drop_month_removes_exactly_one_files_rows(pg_engine, month_file):
+    january, february = read_month(month_file, 1), read_month(month_file, 2)
+
+    with pg_engine.begin() as connection:
+        create_partitioned_table(connection, table_name, january, pickup_column)
+        load_month(connection, january, '2019-01')
+        load_month(connection, february, '2019-02')
+
+        drop_month(connection, table_name, pickup_column, '2019-01')
+
+        ## February's file rows are all kept, including the ones picked up in January
+        assert connection.execute(text(f'SELECT COUNT(*), MIN("{source_month_column}"), MAX("{source_month_column}") '
+                                       f'FROM "{table_name}"')).one() \
+            == (len(february.index), pd.Timestamp('2019-02-01'), pd.Timestamp('2019-02-01'))
+        assert table_kind(connection, 'yellow_trip_data_p2019_01') == 'r'
+
+        ## Reloading the month brings it back to what it was
+        append_partitioned(january, table_name, pickup_column, '2019-01', connection)
+        assert connection.execute(text(f'SELECT COUNT(*) FROM "{table_name}"')).scalar() \
+            == len(january.index) + len(february.index)
+
+
+def test_create_partitioned_table_refuses_a_plain_table(pg_engine, month_file):
+    january = read_month(month_file, 1)
+    january.head(n=0).to_sql(name=table_name, con=pg_engine)
+
+    with pg_engine.begin() as connection, pytest.raises(ValueError):
+        create_partitioned_table(connection, table_name, january, pickup_column)
+
+
+@pytest.fixture
+def green_year(http_server, month_file, tmp_path, monkeypatch):
+    '''`web_to_pg()` set up to download a year of synthetic green files from the local server into its own cache'''
+    import download_cache
+    import upload_all_data_postgres_csv as loader
+
+    directory, base_url = http_server
+    os.makedirs(directory / 'green', exist_ok=True)
+    for month in range(1, 13):
+        shutil.copy(month_file('green', month=month), directory / 'green')
+    monkeypatch.setattr(loader, 'init_url', f'{base_url}/')
+    monkeypatch.setattr(download_cache, '_cache', download_cache.DownloadCache(str(tmp_path / 'cache')))
+    return loader
+
+
+def test_web_to_pg_reloads_a_two_digit_month(pg_engine, green_year, monkeypatch):
+    monkeypatch.setattr(green_year, 'engine', pg_engine, raising=False)
+    ## Already loaded, so `load_zones()` doesn't download it
+    pd.DataFrame({'LocationID': [1]}).to_sql(name='zones', con=pg_engine)
+    load = partial(green_year.web_to_pg, 2019, 'green', None, None, None, None, None, partitioned=True)
+    october = {'source_month': pd.Timestamp('2019-10-01').to_pydatetime()}
+
+    total = load()
+    ## Lose some of October's rows, which only a reload brings back
+    with pg_engine.begin() as connection:
+        connection.execute(text(f'DELETE FROM green_trip_data WHERE "{source_month_column}" = :source_month '
+                                'AND index < 500'), october)
+    assert load() == total
+
+    assert load(reload_months=['10']) == total
+    with pg_engine.connect() as connection:
+        assert connection.execute(text('SELECT COUNT(*) FROM green_trip_data')).scalar() == total == 12 * rows
+        assert connection.execute(text(f'SELECT COUNT(*) FROM green_trip_data '
+                                       f'WHERE "{source_month_column}" = :source_month'), october).scalar() == rows
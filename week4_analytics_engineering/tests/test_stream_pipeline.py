@@ -0,0 +1,81 @@
+import gzip
+import pandas as pd
+import pytest
+import requests
+import pyarrow as pa
+from adaptive_chunks import ChunkSizer
+from stream_pipeline import stream_csv_chunks, stream_csv_batches
+from taxi_schema import read_csv_kwargs, clean_data, compile_schema, clean_batch
+
+
+def write_members(path, csv_path, members):
+    '''Write a CSV as a .csv.gz of several gzip members back to back (like `cat a.gz b.gz`), returning its rows'''
+    with open(csv_path, 'rb') as f:
+        header, *lines = f.read().splitlines(keepends=True)
+    size = -(-len(lines) // members)
+    with open(path, 'wb') as f:
+        for i in range(members):
+            f.write(gzip.compress((header if i == 0 else b'') + b''.join(lines[i * size:(i + 1) * size])))
+    return len(lines)
+
+
+def test_stream_csv_chunks_reads_every_gzip_member(month_file, http_server):
+    directory, base_url = http_server
+    rows = write_members(directory / 'green_members.csv.gz', month_file('green', 'csv'), members=3)
+
+    chunks = list(stream_csv_chunks(f'{base_url}/green_members.csv.gz', chunksize=500,
+                                    transform=lambda df: clean_data(df, 'green'), **read_csv_kwargs('green')))
+
+    ## Nothing after the first member is dropped, and nothing is parsed twice
+    expected = clean_data(pd.read_csv(month_file('green', 'csv'), **read_csv_kwargs('green')), 'green')
+    pd.testing.assert_frame_equal(pd.concat(chunks, ignore_index=True), expected)
+    assert sum(len(df.index) for df in chunks) == rows
+
+
+def test_stream_csv_chunks_sizes_chunks_adaptively(month_file, http_server):
+    directory, base_url = http_server
+    rows = write_members(directory / 'green_adaptive.csv.gz', month_file('green', 'csv'), members=2)
+    sizer = ChunkSizer(initial_rows=300, min_rows=100, name='green_adaptive.csv.gz')
+
+    chunks = list(stream_csv_chunks(f'{base_url}/green_adaptive.csv.gz', sizer=sizer,
+                                    transform=lambda df: clean_data(df, 'green'), **read_csv_kwargs('green')))
+
+    ## The sizer picked each chunk's rows (after the first one) from its measurements
+    assert len(chunks[0].index) == 300
+    assert [len(df.index) for df in chunks] == [rows for rows, _, _, _ in sizer.history]
+    expected = clean_data(pd.read_csv(month_file('green', 'csv'), **read_csv_kwargs('green')), 'green')
+    pd.testing.assert_frame_equal(pd.concat(chunks, ignore_index=True), expected)
+    assert sum(len(df.index) for df in chunks) == rows
+
+
+def test_stream_csv_batches_reads_every_gzip_member(month_file, http_server):
+    directory, base_url = http_server
+    rows = write_members(directory / 'yellow_members.csv.gz', month_file('yellow', 'csv'), members=2)
+
+    batches = list(stream_csv_batches(f'{base_url}/yellow_members.csv.gz', block_size=64 * 1024,
+                                      column_types=compile_schema('yellow')['read_arrow_types']))
+
+    assert sum(batch.num_rows for batch in batches) == rows
+
+
+@pytest.mark.parametrize('service', ['yellow', 'green', 'fhv'])
+def test_stream_csv_batches_clean_like_clean_data(month_file, http_server, service):
+    directory, base_url = http_server
+    write_members(directory / f'{service}_batches.csv.gz', month_file(service, 'csv'), members=1)
+
+    batches = stream_csv_batches(f'{base_url}/{service}_batches.csv.gz', block_size=64 * 1024,
+                                 column_types=compile_schema(service)['read_arrow_types'])
+    table = pa.Table.from_batches([clean_batch(batch, service) for batch in batches])
+
+    ## The same values (and NULLs, e.g. for empty strings) as the pandas path, whatever the dtypes
+    expected = clean_data(pd.read_csv(month_file(service, 'csv'), **read_csv_kwargs(service)), service)
+    assert table.column_names == list(expected.columns)
+    for column in expected.columns:
+        values = table.column(column).to_pylist()
+        assert values == expected[column].astype(object).where(expected[column].notna(), None).tolist(), column
+
+
+def test_stream_csv_chunks_raises_download_errors(http_server):
+    _, base_url = http_server
+    with pytest.raises(requests.HTTPError, match='404'):
+        list(stream_csv_chunks(f'{base_url}/missing.csv.gz'))
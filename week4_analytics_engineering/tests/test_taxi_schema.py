@@ -0,0 +1,99 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pytest
+from taxi_schema import (compile_schema, read_csv_kwargs, clean_data, parse_datetimes, datetime_dtype, compact_data,
+                         expand_data)
+
+services = ['yellow', 'green', 'fhv']
+
+
+def read_clean(path, service, compact=False):
+    return clean_data(pd.read_csv(path, **read_csv_kwargs(service, compact)), service, compact)
+
+
+def values(series):
+    '''A column's values as Python objects with None for every kind of NULL, to compare across dtypes'''
+    return series.astype(object).where(series.notna(), None).tolist()
+
+
+@pytest.mark.parametrize('service', services)
+def test_clean_data_applies_the_schema(month_file, service):
+    schema = compile_schema(service)
+    df = read_clean(month_file(service), service)
+
+    assert not set(schema['renames']) & set(df.columns)
+    for column in schema['datetime_columns']:
+        assert df[column].dtype == datetime_dtype
+    for column, dtype in schema['astype'].items():
+        if column in df.columns:
+            assert df[column].dtype == dtype, column
+
+
+## FHV trips have no payment_type
+@pytest.mark.parametrize('service', ['yellow', 'green'])
+def test_clean_data_voids_payment_types(month_file, service):
+    schema = compile_schema(service)
+    raw = pd.read_csv(month_file(service), **read_csv_kwargs(service))
+    df = clean_data(raw, service)
+
+    voided = raw['payment_type'].isin(schema['voided_payment_types'])
+    if schema['void_null_payment_types']:
+        voided |= raw['payment_type'].isna()
+    ## The synthetic files have some of each
+    assert voided.any()
+    assert (df['payment_type'][voided] == 6).all()
+    assert not df['payment_type'].isin(schema['voided_payment_types']).any()
+    ## The other values are kept as they were
+    pd.testing.assert_series_equal(df['payment_type'][~voided], raw['payment_type'][~voided].astype(df['payment_type'].dtype))
+
+
+@pytest.mark.parametrize('dtype', [object, 'str', pd.ArrowDtype(pa.string())])
+def test_parse_datetimes_returns_microseconds(dtype):
+    values = pd.Series(['2019-01-01 00:00:00', None, '3019-02-01 01:02:03'], dtype=dtype)
+
+    parsed = parse_datetimes(values, compile_schema('fhv'))
+
+    assert parsed.dtype == datetime_dtype
+    ## The FHV files' year 3019 typos are out of bounds for nanoseconds
+    assert parsed.tolist()[0] == pd.Timestamp('2019-01-01') and parsed.tolist()[2] == pd.Timestamp('3019-02-01 01:02:03')
+    assert pd.isna(parsed.iloc[1])
+
+
+@pytest.mark.parametrize('dtype', [object, 'str', pd.ArrowDtype(pa.string())])
+@pytest.mark.parametrize('value', ['2019-01-01', '2019-01-01T00:00:00', '2019-13-01 00:00:00', '01/02/2019 00:00:00'])
+def test_parse_datetimes_rejects_other_formats(dtype, value):
+    with pytest.raises(ValueError):
+        parse_datetimes(pd.Series(['2019-01-01 00:00:00', value], dtype=dtype), compile_schema('yellow'))
+
+
+def test_parse_datetimes_keeps_the_index():
+    values = pd.Series(['2019-01-01 00:00:00', '2019-01-02 00:00:00'], index=[5, 3], name='pickup_datetime')
+
+    parsed = parse_datetimes(values, compile_schema('yellow'))
+
+    assert parsed.index.tolist() == [5, 3] and parsed.name == 'pickup_datetime'
+    assert np.array_equal(parsed.to_numpy(), np.array(['2019-01-01', '2019-01-02'], dtype=datetime_dtype))
+
+
+@pytest.mark.parametrize('service', services)
+def test_compact_data_round_trips(month_file, service):
+    df = read_clean(month_file(service), service)
+    compact = read_clean(month_file(service), service, compact=True)
+
+    assert compact.memory_usage(deep=True).sum() < df.memory_usage(deep=True).sum()
+    expanded = expand_data(compact)
+    assert list(expanded.columns) == list(df.columns)
+    for column in df.columns:
+        assert values(expanded[column]) == values(df[column]), column
+
+
+def test_compact_data_keeps_float64_when_float32_would_lose_cents():
+    df = clean_data(pd.DataFrame({'fare_amount': [12.34, 0.1], 'tip_amount': [16777217.0, 1.25]}), 'yellow')
+
+    compact = compact_data(df.copy(), 'yellow')
+
+    assert compact['fare_amount'].dtype == np.float32
+    ## 16777217 is the first integer float32 can't hold
+    assert compact['tip_amount'].dtype == np.float64
+    pd.testing.assert_frame_equal(expand_data(compact), df)
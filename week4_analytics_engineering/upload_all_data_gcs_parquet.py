@@ -1,11 +1,28 @@
 # import io
 import os
-import requests
 import pandas as pd
-from google.cloud import storage
 from config import gcloud_creds, bucket_name
+## For chunked, retried and skipped-if-unchanged uploads (to GCS or a local fake GCS server)
+from gcs_upload import get_client, upload_to_gcs, upload_many, stream_to_gcs
+## For converting straight from the HTTP response to a GCS upload, without local files
+from stream_pipeline import stream_csv_batches
+from arrow_stream import write_batches
+## For the Parquet writer settings (codec, row groups, dictionary encoding, sorting)
+from parquet_profiles import write_df, batch_writer_options
+## For writing Hive-partitioned (service=/year=/month=) datasets
+import pyarrow as pa
+from hive_dataset import write_partition, write_summary, data_files_glob
 from pathlib import Path
 # import shutil
+## For the shared per-service schema and clean_data()
+from taxi_schema import clean_data, read_csv_kwargs, clean_batch, compile_schema
+## For downloading each file once and keeping it in a size-capped local cache
+from download_cache import get_cache
+## For converting and uploading several months at once
+from functools import partial
+from parallel_ingest import run_months
+## For uploading each month while the next one is converted
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 
 
 '''
@@ -21,173 +38,231 @@ Pre-reqs:
 # services = ['fhv','green','yellow']
 ## Set the download directory URL from the course repo
 init_url = 'https://github.com/DataTalksClub/nyc-tlc-data/releases/download/'
-## Switch out the GCP credentials and GCS bucketname that were imported from config.py
-storage_client = storage.Client.from_service_account_json(gcloud_creds)
 # BUCKET = os.environ.get('GCP_GCS_BUCKET', 'dtc-data-lake-bucketname')
-gcs_bucket = storage_client.get_bucket(bucket_name)
+_gcs_bucket = None
 
 
-def upload_to_gcs(bucket, object_name, local_file):
+def get_bucket():
     '''
-    Ref: https://cloud.google.com/storage/docs/uploading-objects#storage-upload-object-python
+    Return the GCS bucket from config.py, creating its storage client on the first call
+        (rather than on import, so importing this module needs neither credentials nor a network)
+        - Set STORAGE_EMULATOR_HOST=http://localhost:4443 to use the `fake-gcs` server from docker-compose.yml instead
     '''
-    # # WORKAROUND to prevent timeout for files > 6 MB on 800 kbps upload speed.
-    # # (Ref: https://github.com/googleapis/python-storage/issues/74)
-    # storage.blob._MAX_MULTIPART_SIZE = 5 * 1024 * 1024  # 5 MB
-    # storage.blob._DEFAULT_CHUNKSIZE = 5 * 1024 * 1024  # 5 MB
-
-    # client = storage.Client()
-    # bucket = client.bucket(bucket)
-    blob = bucket.blob(object_name)  ## Basically the destination within the bucket
-    blob.upload_from_filename(local_file)
-
-
-def remove_files():
-    print('Removing files...')
-    # https://stackoverflow.com/questions/32834731/how-to-delete-a-file-by-extension-in-python
-    dir_name = './data'
-    local_data = os.listdir(dir_name)
-
-    ## Remove the local compressed and uncompressed CSV's and any Parquet files
-    for item in local_data:
-        if item.endswith('.csv.gz'):
-            os.remove(os.path.join(dir_name, item))
-        elif item.endswith('.csv'):
-            os.remove(os.path.join(dir_name, item))
-        elif item.endswith('.parquet'):
-            os.remove(os.path.join(dir_name, item))
-
-    # # Remove all other the local files in the 'data' directory
-    # # https://stackoverflow.com/questions/48892772/how-to-remove-a-directory-is-os-removedirs-and-os-rmdir-only-used-to-delete-emp
-    # shutil.rmtree('./data/')
-
-
-def clean_data(df, service):
-    '''Fix datatype issues'''
-
-    if service == 'yellow':           
-        ## Rename columns to be better suited for a database/data warehouse table
-        df.rename({'VendorID':'vendor_id',
-                   'PULocationID':'pu_location_id',
-                   'DOLocationID':'do_location_id',
-                   'RatecodeID':'rate_code_id'
-                },
-            axis='columns', inplace=True
-        )
-        
-        ## Fix datetimes
-        df.tpep_pickup_datetime = pd.to_datetime(df.tpep_pickup_datetime)
-        df.tpep_dropoff_datetime = pd.to_datetime(df.tpep_dropoff_datetime)
-
-        ## This fixes fields for files that have NAN values and thus aren't INTs
-        ##   when they should be INTs
-        ## https://pandas.pydata.org/pandas-docs/stable/user_guide/integer_na.html#integer-na
-        df.vendor_id = pd.array(df.vendor_id, dtype=pd.Int64Dtype())
-        df.passenger_count = pd.array(df.passenger_count, dtype=pd.Int64Dtype())
-        df.payment_type = pd.array(df.payment_type, dtype=pd.Int64Dtype())
-        df.rate_code_id = pd.array(df.rate_code_id, dtype=pd.Int64Dtype())
-
-    elif service == 'green':
-        ## Rename columns to be better suited for a database/data warehouse table
-        df.rename({'VendorID':'vendor_id',
-                    'PULocationID':'pu_location_id',
-                    'DOLocationID':'do_location_id',
-                    'RatecodeID':'rate_code_id'
-                }, 
-            axis='columns', inplace=True
-        )
-
-        ## Fix datetimes
-        df.lpep_pickup_datetime = pd.to_datetime(df.lpep_pickup_datetime)
-        df.lpep_dropoff_datetime = pd.to_datetime(df.lpep_dropoff_datetime)
-
-        ## This fixes fields for files that have NAN values and thus aren't INTs
-        ##   when they should be INTs
-        ## https://pandas.pydata.org/pandas-docs/stable/user_guide/integer_na.html#integer-na
-        df.vendor_id = pd.array(df.vendor_id, dtype=pd.Int64Dtype())
-        df.passenger_count = pd.array(df.passenger_count, dtype=pd.Int64Dtype())
-        df.payment_type = pd.array(df.payment_type, dtype=pd.Int64Dtype())
-        df.trip_type = pd.array(df.trip_type, dtype=pd.Int64Dtype())
-        df.rate_code_id = pd.array(df.rate_code_id, dtype=pd.Int64Dtype())
-
-    # elif service == 'fhv':
-    else:
-        ## Rename columns to be better suited for a database/data warehouse table
-        df.rename({'dropOff_datetime':'dropoff_datetime',
-                    'PUlocationID':'pu_location_id',
-                    'DOlocationID':'do_location_id',
-                    'SR_flag':'sr_flag',
-                    'Affiliated_base_number':'affiliated_base_number'
-                }, 
-            axis='columns', inplace=True
-        )
-
-        ## Fix datetimes
-        df.pickup_datetime = pd.to_datetime(df.pickup_datetime)
-        df.dropoff_datetime = pd.to_datetime(df.dropoff_datetime)
-
-        ## This fixes fields for files that have NAN values and thus aren't INTs
-        ##   when they should be INTs
-        ## https://pandas.pydata.org/pandas-docs/stable/user_guide/integer_na.html#integer-na
-        df.pu_location_id = pd.array(df.pu_location_id, dtype=pd.Int64Dtype())
-        df.do_location_id = pd.array(df.do_location_id, dtype=pd.Int64Dtype())
-
-    return df
-
-
-def web_to_gcs(year, service, gcs_bucket):
-
-    ## Loop through the months
-    for i in range(1, 13):
-    # for i in range(3):
-        
-        ## Set the month part of the file_name string
-        if len(str(i)) == 1:
-            # print(f'Single digit: {i}')
-            month = '0' + str(i)
-        else:
-            # print(f'Double digit: {i}')
-            month = i
-        # print(month)
+    global _gcs_bucket
+    ## Switch out the GCP credentials and GCS bucketname that were imported from config.py
+    if _gcs_bucket is None:
+        _gcs_bucket = get_client(gcloud_creds).get_bucket(bucket_name)
+    return _gcs_bucket
 
-        ## Create CSV file_name to download
-        file_name = f'{service}_tripdata_{year}-{month}.csv.gz'
-        
-        ## Create the path to write the eventual parquet file to
-        path = Path(f'./data/{service}_tripdata_{year}-{month}.parquet').as_posix()
 
-        ## Make the directory to hold the parquet file if it doesn't already exist
-        os.makedirs(os.path.dirname(path), exist_ok=True)
+def download_month(year, service, month, pin=False):
+    '''
+    Download a monthly source CSV file into the download cache if it isn't cached yet, and return its path
+        - `pin=True` keeps it from being evicted until it's released (see `download_cache.py`)
+    '''
+    ## Create CSV file_name to download
+    file_name = f'{service}_tripdata_{year}-{month}.csv.gz'
 
-        ## Download the source CSV file using `requests` library
-        print(f'\nDownloading {file_name}...')
-        request_url = f'{init_url}{service}/{file_name}'
-        r = requests.get(request_url)
-        open(f'./data/{file_name}', 'wb').write(r.content)
+    ## Stream the source CSV file to disk if it's not in the cache (resuming a partial download from an earlier run)
+    request_url = f'{init_url}{service}/{file_name}'
+    csv_path = get_cache().get(request_url, pin=pin)
+
+    return csv_path
 
-        ## Uncompress the CSV and read data into a pandas DataFrame
-        print(f'Saving {file_name} to {path}...')
-        df = pd.read_csv(f'./data/{file_name}', compression='gzip')
 
-        ## Clean the data and fix the data types
-        print(f'Cleaning {path}...')
-        df = clean_data(df, service)
+def csv_to_parquet(month, csv_path, service, profile='snappy'):
+    '''Read, clean and write a monthly CSV out as Parquet (runs in a worker process when parallel)'''
+    ## Create the path to write the eventual parquet file to (in ./data/, not in the download cache)
+    os.makedirs('./data', exist_ok=True)
+    path = Path('./data', Path(csv_path).name.replace('.csv.gz', '.parquet')).as_posix()
 
-        ## Replace the extension of the file name and read DataFrame into a
-        ##      Parquet file using `pyarrow` engine
-        file_name = file_name.replace('.csv.gz', '.parquet')
-        df.to_parquet(f'./data/{file_name}', engine='pyarrow')
+    ## Uncompress the CSV and read data into a pandas DataFrame
+    print(f'Saving {csv_path} to {path}...')
+    df = pd.read_csv(csv_path, compression='gzip', **read_csv_kwargs(service))
+
+    ## Clean the data and fix the data types
+    print(f'Cleaning {path}...')
+    df = clean_data(df, service)
+
+    ## Read DataFrame into a Parquet file using `pyarrow`, with the given writer profile
+    write_df(df, path, service, profile)
+
+    return path
+
+
+def web_to_gcs(year, service, gcs_bucket, upload_workers=4, profile='snappy'):
+    '''
+    Convert each month to Parquet and upload it to `data/{service}/` in GCS
+        - Each month's upload starts as soon as it's converted, while the next month is converted,
+          with at most `upload_workers` uploads (and so converted files on disk) at once
+    '''
+    ## Upload future -> local Parquet file of each month in progress
+    uploads = {}
+    results = []
+
+    with ThreadPoolExecutor(max_workers=upload_workers) as executor:
+        ## Loop through the months
+        for i in range(1, 13):
+        # for i in range(3):
         
-        ## Upload the resulting Parquet file to the GCS Bucket, whilst
-        ##      creating a `data/` directory in GCS
+            ## Set the month part of the file_name string
+            if len(str(i)) == 1:
+                # print(f'Single digit: {i}')
+                month = '0' + str(i)
+            else:
+                # print(f'Double digit: {i}')
+                month = i
+            # print(month)
+
+            ## Don't convert more months than can be uploading at once
+            while len(uploads) >= upload_workers:
+                done, _ = wait(uploads, return_when=FIRST_COMPLETED)
+                results += finish_uploads(done, uploads)
+
+            csv_path = download_month(year, service, month)
+            path = csv_to_parquet(month, csv_path, service, profile)
+
+            ## Upload the Parquet file to the GCS Bucket in the background, whilst creating a `data/`
+            ##      directory in GCS (months that are already there are skipped)
+            print(f'Uploading {path} to GCS...')
+            uploads[executor.submit(upload_to_gcs, gcs_bucket, f'data/{service}/{Path(path).name}', path)] = path
+
+        results += finish_uploads(uploads, uploads)
+
+    print(f'Uploaded {results.count("uploaded")} files for {service} in {year} '
+          f'({results.count("skipped")} were already in GCS)')
+
+
+def finish_uploads(futures, uploads):
+    '''Wait for some of `web_to_gcs()`'s uploads, delete their local files and return their results'''
+    results = []
+    for future in list(futures):
+        ## The source CSVs stay in the download cache, but the converted files aren't needed anymore
+        path = uploads.pop(future)
+        try:
+            results.append(future.result())
+        finally:
+            os.remove(path)
+    return results
+
+
+def web_to_gcs_parallel(year, service, gcs_bucket, download_workers=4, transform_workers=2, upload_workers=4,
+                        max_in_flight=4, profile='snappy'):
+    '''
+    Same as `web_to_gcs()`, but downloads, converts and uploads different months at the same time
+        - `upload_workers` is the number of concurrent GCS uploads
+        - `max_in_flight` caps how many months are being processed at once (and so peak memory)
+    '''
+
+    def upload(month, path):
         print(f'Uploading {path} to GCS...')
-        upload_to_gcs(gcs_bucket, f'data/{service}/{file_name}', f'data/{file_name}')
+        object_name = f'data/{service}/{Path(path).name}'
+        status = upload_to_gcs(gcs_bucket, object_name, path)
+        os.remove(path)
+        return status
+
+    months = [f'{i:02d}' for i in range(1, 13)]
+    statuses = run_months(months,
+                          download=partial(download_month, year, service, pin=True),
+                          transform=partial(csv_to_parquet, service=service, profile=profile),
+                          load=upload,
+                          download_workers=download_workers,
+                          transform_workers=transform_workers,
+                          load_workers=upload_workers,
+                          max_in_flight=max_in_flight,
+                          release=get_cache().release)
+
+    print(f'Uploaded {statuses.count("uploaded")} files for {service} in {year} '
+          f'({statuses.count("skipped")} were already in GCS)')
+
+
+def csv_to_partition(month, csv_path, service, year, dataset_dir, files_per_partition=1, profile='zstd_sorted'):
+    '''Read and clean a monthly CSV and write it as a month partition of a local Hive-partitioned dataset'''
+    df = clean_data(pd.read_csv(csv_path, compression='gzip', **read_csv_kwargs(service)), service)
+    return write_partition(pa.Table.from_pandas(df, preserve_index=False), dataset_dir, service, year, month,
+                           files_per_partition, profile)
+
+
+def web_to_gcs_dataset(year, service, gcs_bucket, files_per_partition=1, profile='zstd_sorted',
+                       dataset_dir='./data/dataset', upload_workers=4):
+    '''
+    Same as `web_to_gcs()`, but uploads a Hive-partitioned dataset (see `hive_dataset.py`) under
+        `dataset/` in GCS, i.e. `dataset/service={service}/year={year}/month={month}/part-*.parquet`
+        plus a `_metadata` summary file of the year, instead of one flat file per month
+        - Each month is written as `files_per_partition` files (fewer if it has fewer rows, see `write_partition()`)
+    '''
+    files = []
+
+    for i in range(1, 13):
+        month = f'{i:02d}'
+        csv_path = download_month(year, service, month)
+        month_files = csv_to_partition(month, csv_path, service, year, dataset_dir, files_per_partition, profile)
+
+        ## Upload the month's files, then only keep their footers for the `_metadata` file
+        upload_many(gcs_bucket, [(f'dataset/{path}', os.path.join(dataset_dir, path)) for path, _ in month_files],
+                    max_workers=upload_workers)
+        for path, _ in month_files:
+            os.remove(os.path.join(dataset_dir, path))
+        files += month_files
+
+    ## Only written once every month is there, so readers never see a summary of missing files
+    summary = write_summary(dataset_dir, service, year, files)
+    upload_many(gcs_bucket, [(f'dataset/{path}', os.path.join(dataset_dir, path)) for path in summary],
+                max_workers=upload_workers)
+
+    print(f'Uploaded {len(files)} files{" and the _metadata" if summary else ""} for {service} in {year} '
+          f'to gs://{gcs_bucket.name}/dataset/')
+    ## Not `service={service}/*`, which would also match the `_metadata` summaries
+    print(f'External table uris: gs://{gcs_bucket.name}/dataset/{data_files_glob(service)}')
+
+
+def web_to_gcs_streaming(year, service, gcs_bucket, profile='snappy', block_size=16 * 1024 * 1024):
+    '''
+    Same as `web_to_gcs()`, but without any local files:
+        HTTP download -> gunzip -> `pyarrow.csv` batches -> `clean_batch()` -> ParquetWriter row groups
+            -> resumable (chunked) upload to GCS
+        - Memory is bounded by about one row group of the writer `profile` (plus the pipeline's
+          queues and one upload chunk), no matter how big the file is
+        - Sorted profiles (e.g. 'zstd_sorted') need the whole month at once, so they're rejected
+          here: use `web_to_gcs()` or `web_to_gcs_dataset()` for those
+        - A month without any rows isn't uploaded at all, rather than as an invalid 0-byte object
+    '''
+    column_types = compile_schema(service)['read_arrow_types']
+    ## Before anything is downloaded, so a sorted profile fails straight away
+    options = batch_writer_options(profile, service)
+
+    for i in range(1, 13):
+        month = f'{i:02d}'
+        file_name = f'{service}_tripdata_{year}-{month}.csv.gz'
+        request_url = f'{init_url}{service}/{file_name}'
+        object_name = f'data/{service}/{file_name.replace(".csv.gz", ".parquet")}'
+
+        print(f'\nConverting {file_name} to gs://{gcs_bucket.name}/{object_name}...')
+        batches = stream_csv_batches(request_url, block_size=block_size, column_types=column_types)
+        with stream_to_gcs(gcs_bucket, object_name) as f:
+            rows = write_batches((clean_batch(batch, service) for batch in batches), f, **options)
+        if rows:
+            print(f'Uploaded {rows} rows to {object_name}')
+        else:
+            print(f'No rows in {file_name}, so there is no {object_name}')
 
 
 if __name__ == '__main__':
+    gcs_bucket = get_bucket()
+
     # web_to_gcs('2019', 'green', gcs_bucket)
     # web_to_gcs('2020', 'green', gcs_bucket)
     # web_to_gcs('2019', 'yellow', gcs_bucket)
     # web_to_gcs('2020', 'yellow', gcs_bucket)
     # web_to_gcs('2019', 'fhv', gcs_bucket)
-    remove_files()
+    ## Or several months at once
+    # web_to_gcs_parallel('2019', 'yellow', gcs_bucket, download_workers=4, upload_workers=4)
+    ## Or stream each month from the source straight into GCS as Parquet (no local files)
+    # web_to_gcs_streaming('2019', 'yellow', gcs_bucket, profile='zstd')
+    ## Or as a Hive-partitioned dataset (service=/year=/month=) with a _metadata file
+    # web_to_gcs_dataset('2019', 'yellow', gcs_bucket, files_per_partition=2)
+    ## NOTE: the Parquet writer profiles ('default', 'snappy', 'zstd', 'zstd_sorted') are in
+    ##  parquet_profiles.py, compare them with `python benchmark_parquet_profiles.py`
+
+    ## The downloaded CSVs stay in ./data/cache/ (least recently used first out) for the next run
+    get_cache().report()
@@ -1,10 +1,9 @@
 # import sys
-import requests
 import pandas as pd
-## For removing files from a directory
+## For the cleaned chunks the parallel loader's workers spill to disk
 import os
-# import shutil
-from sqlalchemy import create_engine
+import shutil
+import tempfile
 import time
 ## For checking if file exists
 from pathlib import Path
@@ -14,8 +13,31 @@ import time
 # import pyarrow as pa
 # import pyarrow.parquet as pq
 # import pyarrow.compute as pc
-## For checking if Postgres table exists already
-import psycopg2
+## For the shared, pooled engine (and checking if Postgres tables exist already)
+from pg_engine import get_pg_engine, table_exists
+## For the shared per-service schema and clean_data()
+from taxi_schema import clean_data, read_csv_kwargs, expand_data
+## For downloading each file once and keeping it in a size-capped local cache
+from download_cache import get_cache
+## For bulk loading chunks via COPY FROM STDIN
+from pg_bulk_load import load_chunk, append_chunk, replace_table, staging_table_name, drop_table, prepare_staging, \
+    swap_in_staging
+## For skipping files that are already loaded and resuming partial loads
+from load_manifest import is_complete, begin_file, pending_rows, commit_chunk, finish_file, file_md5, df_hash, \
+    create_manifest, replace_table_files, forget_file
+## For loading each month into its own partition of a table partitioned by pickup month
+from pg_partitions import create_partitioned_table, ensure_month_partition, append_partitioned, drop_month
+## For skipping rows that are already loaded, via a hash of each row
+from pg_dedup import add_unique_row_id, ensure_unique_index, append_deduplicated, delete_duplicates, \
+    unique_row_id_column
+## For loading several months at once
+import threading
+from functools import partial
+from parallel_ingest import run_months
+## For loading while the file is still downloading
+from stream_pipeline import stream_csv_chunks
+## For sizing the chunks from their measured rows/sec and memory
+from adaptive_chunks import ChunkSizer, iter_adaptive_chunks
 
 '''
 Pre-reqs: 
@@ -28,370 +50,446 @@ init_url = 'https://github.com/DataTalksClub/nyc-tlc-data/releases/download/'
 # init_url = 'https://d37ci6vzurychx.cloudfront.net/trip-data'
 
 
-def create_pg_engine(user, password, host, port, database):
-    ## Upload CSV to Postgres
-    print('Creating the engine...')
-    ## Need to convert a DDL statement into something Postgres will understand
-    ##   - via create_engine([database_type]://[user]:[password]@[hostname]:[port]/[database], con=[engine])
-    ## https://stackoverflow.com/questions/9298296/sqlalchemy-support-of-postgres-schemas/49930672#49930672
-    # dbschema = 'dev'
-    dbschema = 'public'
-    engine = create_engine(f'postgresql://{user}:{password}@{host}:{port}/{database}',
-                            connect_args={'options': '-csearch_path={}'.format(dbschema)}
-                        )
-
-    return engine
-
-
-def remove_files():
-    print('Removing files...')
-    ## https://stackoverflow.com/questions/32834731/how-to-delete-a-file-by-extension-in-python
-    dir_name = './data'
-    local_data = os.listdir(dir_name)
-
-    ## Remove the local compressed and uncompressed CSV's
-    for item in local_data:
-        if item.endswith('.csv.gz'):
-            os.remove(os.path.join(dir_name, item))
-        elif item.endswith('.csv'):
-            os.remove(os.path.join(dir_name, item))
-
-    # ## Remove all other the local files in the 'data' directory
-    # ## https://stackoverflow.com/questions/48892772/how-to-remove-a-directory-is-os-removedirs-and-os-rmdir-only-used-to-delete-emp
-    # shutil.rmtree('./data/')
-
-
-def clean_data(df, service):
-    '''Fix datatype issues'''
-
-    if service == 'yellow':
-        ## Rename columns
-        df.rename({'VendorID':'vendor_id',
-                   'PULocationID':'pu_location_id',
-                   'DOLocationID':'do_location_id',
-                   'RatecodeID':'rate_code_id'
-                }, 
-            axis='columns', inplace=True
-        )
-                
-        ## Fix datetimes
-        df.tpep_pickup_datetime = pd.to_datetime(df.tpep_pickup_datetime)
-        df.tpep_dropoff_datetime = pd.to_datetime(df.tpep_dropoff_datetime)
-
-        ## Fix fields for files that have NAN values and thus aren't INTs
-        ##   when they should be INTs
-        ## https://pandas.pydata.org/pandas-docs/stable/user_guide/integer_na.html#integer-na
-        df.vendor_id = pd.array(df.vendor_id, dtype=pd.Int64Dtype())
-        df.passenger_count = pd.array(df.passenger_count, dtype=pd.Int64Dtype())
-        df.payment_type = pd.array(df.payment_type, dtype=pd.Int64Dtype())
-        df.rate_code_id = pd.array(df.rate_code_id, dtype=pd.Int64Dtype())
-
-        ## Replace payment_type of 0 or NULL with correct voided value of 6, according to data dictionary
-        ## https://www.nyc.gov/assets/tlc/downloads/pdf/data_dictionary_trip_records_green.pdf
-        ## https://stackoverflow.com/questions/31511997/pandas-dataframe-replace-all-values-in-a-column-based-on-condition
-        df.loc[df['payment_type'] == 0, 'payment_type'] = 6        
-
-    elif service == 'green':
-        ## Rename columns
-        df.rename({'VendorID':'vendor_id',
-                   'PULocationID':'pu_location_id',
-                   'DOLocationID':'do_location_id',
-                   'RatecodeID':'rate_code_id'
-                }, 
-            axis='columns', inplace=True
-        )
-                
-        ## Fix datetimes
-        df.lpep_pickup_datetime = pd.to_datetime(df.lpep_pickup_datetime)
-        df.lpep_dropoff_datetime = pd.to_datetime(df.lpep_dropoff_datetime)
-
-        ## Fix fields for files that have NAN values and thus aren't INTs
-        ##   when they should be INTs
-        ## https://pandas.pydata.org/pandas-docs/stable/user_guide/integer_na.html#integer-na
-        df.vendor_id = pd.array(df.vendor_id, dtype=pd.Int64Dtype())
-        df.passenger_count = pd.array(df.passenger_count, dtype=pd.Int64Dtype())
-        df.payment_type = pd.array(df.payment_type, dtype=pd.Int64Dtype())
-        df.trip_type = pd.array(df.trip_type, dtype=pd.Int64Dtype())
-        df.rate_code_id = pd.array(df.rate_code_id, dtype=pd.Int64Dtype())
-
-        ## Replace payment_type of 0 or NULL with correct voided value of 6, according to data dictionary
-        ## https://www.nyc.gov/assets/tlc/downloads/pdf/data_dictionary_trip_records_green.pdf
-        ## https://stackoverflow.com/questions/31511997/pandas-dataframe-replace-all-values-in-a-column-based-on-condition
-        # df.loc[df['payment_type'] == 0, 'payment_type'] = 6
-        df.loc[df['payment_type'].isnull() == True, 'payment_type'] = 6
-        # print(df.payment_type.unique())
-
-    # elif service == 'fhv':
-    else:
-        ## Rename columns
-        df.rename({'dropOff_datetime':'dropoff_datetime',
-                   'PUlocationID':'pu_location_id',
-                   'DOlocationID':'do_location_id',
-                   'SR_Flag':'sr_flag',
-                   'Affiliated_base_number':'affiliated_base_number'
-                },
-            axis='columns', inplace=True
-        )
-
-        ## Fix datetimes
-        df.pickup_datetime = pd.to_datetime(df.pickup_datetime)
-        df.dropoff_datetime = pd.to_datetime(df.dropoff_datetime)
-
-        ## Fix fields for files that have NAN values and thus aren't INTs
-        ##   when they should be INTs
-        ## https://pandas.pydata.org/pandas-docs/stable/user_guide/integer_na.html#integer-na
-        df.pu_location_id = pd.array(df.pu_location_id, dtype=pd.Int64Dtype())
-        df.do_location_id = pd.array(df.do_location_id, dtype=pd.Int64Dtype())
-
-        ## Fix a DOUBLE that may be trying to be forced into an INT
-        df.sr_flag = pd.array(df.sr_flag, dtype=pd.Int64Dtype())
-
-    return df
-
-
-def web_to_pg(year, service, user, password, host, port, database):
+def load_zones():
+    '''Download the zones CSV and create the SQL table if it doesn't already exist'''
 
     ## Check if Postgres tables exist already and note if so via a Boolean variable to use later
-    ## NOTE: Need *double* quotes around psycopg2 SQL queries
-    ## https://stackoverflow.com/questions/1874113/checking-if-a-postgresql-table-exists-under-python-and-probably-psycopg2
-    ## https://stackoverflow.com/questions/57604339/psycopg2-error-column-doesnt-exist-error-when-trying-to-write-injection-safe
-    conn = psycopg2.connect(f'dbname={database} user={user} host={host} password={password}')
-    
-    zones_cur = conn.cursor()
-    zones_cur.execute(f"select * from information_schema.tables where table_name = 'zones'")
-    zones_table_exists = bool(zones_cur.rowcount)
-
-    ## Download the zones CSV and create the SQL table if it doesn't already exist
+    ##  (through a pooled connection of the shared engine, instead of a separate psycopg2 connection)
+    zones_table_exists = table_exists(engine, 'zones')
+
     if zones_table_exists == False:
         ## Download zones data
         zones_url = 'https://github.com/DataTalksClub/nyc-tlc-data/releases/download/misc/taxi_zone_lookup.csv'
-        zones_csv_name = './data/taxi_zone_lookup.csv'
-        zones_file = Path(zones_csv_name)
 
-        ## If the file is not already downloaded/does not exist, download it
-        if not zones_file.is_file():
-            print(f'\nDownloading the taxi zone data...')
-            os.system(f'wget {zones_url} -O {zones_csv_name}')  # -O = output to the given file name        
+        ## Only downloaded if it isn't in the download cache already
+        zones_csv_name = get_cache().get(zones_url)
+
+        ## Add in the smaller taxi zones table first before the long loop for the taxi data
+        ##  (swapped in with its primary key in one go, so it's never there half loaded)
+        print('\nLoading in zone data...')
+        df_zones = pd.read_csv(zones_csv_name)
+        replace_table(df_zones, 'zones', engine, primary_key=['LocationID'])
+        print('Loaded in zone data')
+
+
+def download_month(year, service, month, pin=False):
+    '''
+    Download a monthly CSV file into the download cache if it isn't cached yet, and return its path
+        - `pin=True` keeps it from being evicted until it's released (see `download_cache.py`)
+    '''
+
+    ## Create CSV file_name to download
+    file_name = f'{service}_tripdata_{year}-{month}.csv.gz'
+
+    ## Streamed to disk if it's not in the cache (a partial download from an earlier run is resumed),
+    ##  and kept under its own file name inside the cache
+    request_url = f'{init_url}{service}/{file_name}'
+    # print(request_url)
+    taxi_file = Path(get_cache().get(request_url, pin=pin))
+
+    return taxi_file
+
+
+## The pickup datetime column of each service, used for the validation stats
+pickup_columns = {
+    'yellow': 'tpep_pickup_datetime',
+    'green': 'lpep_pickup_datetime',
+    'fhv': 'pickup_datetime'
+}
+
+## Only let one thread create a trip data table from the DataFrame headers
+create_table_lock = threading.Lock()
+
+
+def trip_indexes(service):
+    '''Indexes of a trip data table, built after a bulk load (for the dbt models' joins and date filters)'''
+    return {
+        'pickup_datetime': [pickup_columns.get(service, 'pickup_datetime')],
+        'pu_location_id': ['pu_location_id'],
+        'do_location_id': ['do_location_id']
+    }
+
+
+def iter_clean_chunks(taxi_file, service, chunksize=None, compact=False, **sizer_kwargs):
+    '''
+    Parse a monthly CSV in chunks, cleaning each chunk as it is read
+        - By default the chunks are sized adaptively (see `adaptive_chunks.py`, `sizer_kwargs` are
+          its memory/latency bounds), or pass a fixed `chunksize`
+        - `compact=True` keeps the chunks in `taxi_schema.compact_data()`'s dtypes, which take about
+          half the memory, so the chunks can grow bigger
+    '''
+    ## Chunk dataset into smaller sizes to load into the database via the 'chunksize' arg
+    ## FOR CSV's, MUST DEFINE THE DATA TYPE (and the datetime format, so each value isn't guessed)
+    ## https://stackoverflow.com/questions/24251219/pandas-read-csv-low-memory-and-dtype-options
+    df_iter = pd.read_csv(taxi_file,
+                          compression='gzip',
+                          iterator=True,
+                          chunksize=chunksize,
+                          **read_csv_kwargs(service, compact))
+
+    if chunksize is None:
+        ## Each file gets its own sizer, since each service's rows take a different amount of memory/time
+        sizer = ChunkSizer(name=Path(taxi_file).name, **sizer_kwargs)
+        yield from iter_adaptive_chunks(df_iter, sizer, transform=partial(clean_data, service=service, compact=compact))
+        return
+
+    for df in df_iter:
+        ## Clean the data and fix the data types
+        yield clean_data(df, service, compact)
+
+
+def load_chunks(chunks, service, file_name, load_method='copy', content_hash=None, resumable=True,
+                table_name=None, unlogged=False, partition_month=None, dedup=False):
+    '''
+    Load a stream of cleaned chunks into `{service}_trip_data`, counting rows and collecting
+        validation stats from the same chunks, so each file is only read once
+        - `vendor_id_nulls` are the rows the dbt staging models drop (`WHERE vendor_id IS NOT NULL`)
+        - With `resumable=True`, each chunk is committed together with its `load_manifest` entry,
+          a file that is already complete is skipped and a partial load picks up after the rows
+          it already committed (`content_hash` is the source file's MD5, if known)
+        - `table_name` loads into another table instead (e.g. a bulk load's staging table), which
+          is created UNLOGGED and without indexes with `unlogged=True`
+        - With a `partition_month` (the file's month), the table is partitioned by pickup month
+          and the file's rows are loaded into that month's partition (see `pg_partitions.py`)
+        - With `dedup=True`, every row gets a `unique_row_id` hash and rows that are already in the
+          table are skipped (see `pg_dedup.py`). An UNLOGGED staging table is only deduplicated
+          when it's swapped in, by `web_to_pg_bulk()`.
+    '''
+    table_name = table_name or f'{service}_trip_data'
+    pickup_column = pickup_columns.get(service, 'pickup_datetime')
+
+    stats = {'file_name': file_name, 'content_hash': content_hash, 'rows': 0, 'chunks': 0, 'vendor_id_nulls': 0,
+             'min_pickup_datetime': None, 'max_pickup_datetime': None, 'null_counts': None, 'duplicates': 0}
+
+    manifest = begin_file(engine, file_name, table_name, content_hash) if resumable else None
+    if manifest is not None and manifest['complete']:
+        print(f'\nSkipping {file_name}, its {manifest["rows"]} rows are already loaded')
+        ## Don't start reading (or streaming) a file we don't need
+        if hasattr(chunks, 'close'):
+            chunks.close()
+        stats.update(rows=manifest['rows'], vendor_id_nulls=None, skipped=True)
+        return stats
+
+    start = time.time()
+    start_datetime = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start))
+    print(f'\nUploading {file_name} to Postgres starting at {start_datetime}...')
+
+    for df in chunks:
+        ## Compact chunks' float32 amounts go back to their exact float64 values (and DOUBLE PRECISION columns)
+        df = expand_data(df)
+        ## The rows as they're written, i.e. with their hash when deduplicating (the stats below use `df`)
+        rows = add_unique_row_id(df, service) if dedup else df
+
+        ## If table doesn't already exist, create it via the headers of the first chunk
+        if stats['chunks'] == 0:
+            with create_table_lock:
+                if partition_month is not None:
+                    with engine.begin() as connection:
+                        create_partitioned_table(connection, table_name, rows, pickup_column)
+                        ensure_month_partition(connection, table_name, pickup_column, partition_month)
+                else:
+                    rows.head(n=0).to_sql(name=table_name, con=engine, if_exists='append')
+                if unlogged:
+                    prepare_staging(engine, table_name)
+                elif dedup:
+                    with engine.begin() as connection:
+                        ensure_unique_index(connection, table_name, pickup_column)
+
+        if dedup and not unlogged:
+            ## Only the rows that aren't in the table yet, in one transaction with the chunk's manifest entry (if any)
+            chunk_start = time.time()
+            committed = 0 if manifest is None else pending_rows(manifest, len(rows.index))
+            new_rows = rows.iloc[committed:]
+            append = partial(append_deduplicated, new_rows, table_name, pickup_column, load_method=load_method,
+                             month=partition_month)
+            if manifest is None:
+                with engine.begin() as connection:
+                    inserted = append(connection)
+            elif committed < len(rows.index):
+                inserted = commit_chunk(manifest, engine, append, len(new_rows.index), df_hash(new_rows))
+            else:
+                inserted = 0
+            stats['duplicates'] += len(new_rows.index) - inserted
+            chunk_time = time.time() - chunk_start
+            print(f'Inserted {inserted} of {len(new_rows.index)} rows into {table_name} in %.3f seconds '
+                  '(%.0f rows/sec), skipped %d duplicates.'
+                  % (chunk_time, len(new_rows.index) / max(chunk_time, 1e-9), len(new_rows.index) - inserted))
+        elif partition_month is not None:
+            ## Into the month's partition, in one transaction with the chunk's manifest entry (if any)
+            append = partial(append_partitioned, rows, table_name, pickup_column, partition_month, load_method=load_method)
+            if manifest is None:
+                with engine.begin() as connection:
+                    append(connection)
+            else:
+                committed = pending_rows(manifest, len(rows.index))
+                if committed < len(rows.index):
+                    new_rows = rows.iloc[committed:]
+                    commit_chunk(manifest, engine,
+                                 partial(append_partitioned, new_rows, table_name, pickup_column, partition_month,
+                                         load_method=load_method),
+                                 len(new_rows.index), df_hash(new_rows))
+        elif manifest is None:
+            ## Use COPY FROM STDIN by default, or `load_method='insert'` to use `to_sql()`
+            load_chunk(rows, table_name, engine, load_method)
+        else:
+            ## Skip the rows an earlier run already committed, then append the rest and
+            ##  record them in the manifest in one transaction
+            committed = pending_rows(manifest, len(rows.index))
+            if committed < len(rows.index):
+                new_rows = rows.iloc[committed:]
+                chunk_start = time.time()
+                method = commit_chunk(manifest, engine,
+                                      partial(append_chunk, new_rows, table_name, load_method=load_method),
+                                      len(new_rows.index), df_hash(new_rows))
+                chunk_time = time.time() - chunk_start
+                print(f'Inserted {len(new_rows.index)} rows into {table_name} via {method} in %.3f seconds '
+                      '(%.0f rows/sec).' % (chunk_time, len(new_rows.index) / max(chunk_time, 1e-9)))
+
+        ## Count rows and collect the stats from the chunk we just loaded
+        stats['rows'] += len(df.index)
+        stats['chunks'] += 1
+        null_counts = df.isna().sum()
+        stats['null_counts'] = null_counts if stats['null_counts'] is None \
+            else stats['null_counts'].add(null_counts, fill_value=0)
+        if 'vendor_id' in df.columns:
+            stats['vendor_id_nulls'] += int(null_counts['vendor_id'])
+        if pickup_column in df.columns and len(df.index) > 0:
+            chunk_min, chunk_max = df[pickup_column].min(), df[pickup_column].max()
+            if stats['min_pickup_datetime'] is None or chunk_min < stats['min_pickup_datetime']:
+                stats['min_pickup_datetime'] = chunk_min
+            if stats['max_pickup_datetime'] is None or chunk_max > stats['max_pickup_datetime']:
+                stats['max_pickup_datetime'] = chunk_max
+
+    if manifest is not None:
+        finish_file(manifest, engine)
+
+    end = time.time()
+    print(f'Loaded {stats["rows"]} rows ({stats["chunks"]} chunks) from {file_name} in %.3f seconds.' % (end - start))
+    print(f'  Pickups from {stats["min_pickup_datetime"]} to {stats["max_pickup_datetime"]}, '
+          f'{stats["vendor_id_nulls"]} rows without a vendor_id')
+    if dedup and not unlogged:
+        print(f'  Skipped {stats["duplicates"]} rows that were already loaded')
+
+    return stats
+
+
+def print_load_summary(service, year, all_stats):
+    '''Print the exact per-file and per-year row counts, to reconcile with the dbt staging tables'''
+    print(f'\nRow counts for {service} in {year}:')
+    for stats in all_stats:
+        if stats.get('skipped'):
+            print(f'  {stats["file_name"]}: {stats["rows"]} rows (loaded by an earlier run)')
+        else:
+            print(f'  {stats["file_name"]}: {stats["rows"]} rows '
+                  f'({stats["rows"] - stats["vendor_id_nulls"]} with a vendor_id)')
 
-            ## Add in the smaller taxi zones table first before the long loop for the taxi data
-            print('\nLoading in zone data...')
-            df_zones = pd.read_csv(zones_csv_name)
-            df_zones.to_sql(name='zones', con=engine, if_exists='replace')
-            print('Loaded in zone data')
+    total_rows = sum(stats['rows'] for stats in all_stats)
+    print(f'Total rows for {service} in {year}: {total_rows}')
+
+    return total_rows
+
+
+def web_to_pg(year, service, user, password, host, port, database, load_method='copy', compact=False,
+              chunksize=None, partitioned=False, reload_months=(), dedup=False):
+    '''
+    Load every month of a year into `{service}_trip_data`
+        - `partitioned=True` loads into a table partitioned by pickup month (see `pg_partitions.py`)
+        - `reload_months` (e.g. ['03']) are loaded again even if they're complete, by dropping their
+          partitions (so only with `partitioned=True`)
+        - `dedup=True` only inserts rows that aren't in the table yet (see `pg_dedup.py`)
+    '''
+    if reload_months and not partitioned:
+        raise ValueError('reload_months needs partitioned=True')
+
+    ## Check if Postgres tables exist already and note if so via a Boolean variable to use later
+    load_zones()
 
-    ## Keep track of total rows to compare with GCS
-    total_rows = 0
+    ## Keep track of each file's rows to compare with GCS
+    all_stats = []
 
     ## Loop through the months
     for i in range(1, 13):
     # for i in range(3):
         
-        ## Set the month part of the file_name string
-        if len(str(i)) == 1:
-            # print(f'Single digit: {i}')
-            month = '0' + str(i)
-        else:
-            # print(f'Double digit: {i}')
-            month = (i)
-        # print(month)
+        ## Set the month part of the file_name string (a string for every month, so it can be
+        ##  compared with `reload_months`)
+        month = f'{i:02d}'
 
-        ## Create CSV file_name and path to write parquet file to
+        ## Don't download a file an earlier run already loaded completely
         file_name = f'{service}_tripdata_{year}-{month}.csv.gz'
-        taxi_file = Path(f'data/{service}_tripdata_{year}-{month}.csv.gz') # .as_posix()
-
-        ## Make the directory to hold the CSV file if it doesn't exist
-        os.makedirs(os.path.dirname(taxi_file), exist_ok=True)        
-
-        ## If the file is not already downloaded/does not exist, download it
-        if not taxi_file.is_file():
-            ## Download taxi CSV using `requests` via a Pandas DataFrame
-            print(f'\nDownloading {file_name}...')
-            request_url = f'{init_url}{service}/{file_name}'
-            # print(request_url)
-            r = requests.get(request_url)
-            open(f'data/{file_name}', 'wb').write(r.content)
-
-        ## FOR CSV's, MUST DEFINE THE DATA TYPE
-        ## https://stackoverflow.com/questions/24251219/pandas-read-csv-low-memory-and-dtype-options
-        if service == 'yellow':
-            ## Map the data types
-            taxi_dtypes = {
-                            'vendor_id': pd.Int64Dtype(),
-                            'passenger_count': pd.Int64Dtype(),
-                            'trip_distance': float,
-                            'rate_code_id': pd.Int64Dtype(),
-                            'store_and_fwd_flag': str,
-                            'pu_location_id': pd.Int64Dtype(),
-                            'do_location_id': pd.Int64Dtype(),
-                            'payment_type': pd.Int64Dtype(),
-                            'fare_amount': float,
-                            'extra': float,
-                            'mta_tax': float,
-                            'tip_amount': float,
-                            'tolls_amount': float,
-                            'improvement_surcharge': float,
-                            'total_amount': float,
-                            'congestion_surcharge': float
-                        }
-            
-            ## Parse the datetime columns
-            parse_dates = ['tpep_pickup_datetime', 'tpep_dropoff_datetime']
-        
-        elif service == 'green':
-            ## Map the data types
-            taxi_dtypes = {
-                            'vendor_id': pd.Int64Dtype(),
-                            'passenger_count': pd.Int64Dtype(),
-                            'trip_distance': float,
-                            'Ratecorate_code_iddeID': pd.Int64Dtype(),
-                            'store_and_fwd_flag': str,
-                            'pu_location_id': pd.Int64Dtype(),
-                            'do_location_id': pd.Int64Dtype(),
-                            'payment_type': pd.Int64Dtype(),
-                            'fare_amount': float,
-                            'extra': float,
-                            'mta_tax': float,
-                            'tip_amount': float,
-                            'tolls_amount': float,
-                            'improvement_surcharge': float,
-                            'total_amount': float,
-                            'congestion_surcharge': float,
-                            'ehail_fee': float,
-                            'trip_type': pd.Int64Dtype()
-                        }
-            
-            ## Parse the datetime columns
-            parse_dates = ['lpep_pickup_datetime', 'lpep_dropoff_datetime']
-
-        # elif service == 'fhv':
-        else:
-            taxi_dtypes = {
-                            'dispatching_base_num': str,
-                            'pu_location_id': pd.Int64Dtype(),
-                            'do_location_id': pd.Int64Dtype(),
-                            'SR_Flag': float,
-                            'affiliated_base_number': str
-                        }
-            
-            ## Parse the datetime columns
-            parse_dates = ['pickup_datetime', 'dropOff_datetime']             
-
-        ## See how many rows are in green or yellow data file and add it to a total row count
-        df = pd.read_csv(f'./data/{file_name}',
-                         compression='gzip',
-                         # iterator=True,
-                         # chunksize=100000,
-                         dtype=taxi_dtypes,
-                         parse_dates=parse_dates)
-        
-        print(f'Adding {df.shape[0]} rows from {file_name} to {total_rows} total rows so far')
-        total_rows += df.shape[0]
-                
-        ## Chunk dataset into smaller sizes to load into the database via the 'chunksize' arg
-        df_iter = pd.read_csv(f'./data/{file_name}',
-                              compression='gzip',
-                              iterator=True,
-                              chunksize=100000,
-                              dtype=taxi_dtypes,
-                              parse_dates=parse_dates)
-
-        ## Return the next item in an iterator object with the 'next()' function
-        df = next(df_iter)
-        
-        # # NOTE: one FHV file has an out-of-bounds timestamp
-        # # https://stackoverflow.com/questions/74467923/pandas-read-parquet-error-pyarrow-lib-arrowinvalid-casting-from-timestampus
-        # # df = pd.read_parquet(file_name)
-        # table = pq.read_table(file_name)
-
-        # if service == 'fhv':
-        #     df = table.filter(
-        #         pc.less_equal(table['dropOff_datetime'], pa.scalar(pd.Timestamp.max))
-        #     ).to_pandas()
-        # else:
-        #     df = table.to_pandas()
+        if month in reload_months:
+            forget_month(service, year, month, file_name)
+        if is_complete(engine, file_name):
+            all_stats.append(load_chunks(iter([]), service, file_name, load_method))
+            continue
+
+        ## Download the CSV file if it isn't already downloaded
+        taxi_file = download_month(year, service, month)
+
+        ## Read, count and load the file in a single pass over its chunks
+        all_stats.append(load_chunks(iter_clean_chunks(taxi_file, service, chunksize, compact), service, taxi_file.name, load_method,
+                                     content_hash=file_md5(taxi_file),
+                                     partition_month=f'{year}-{month}' if partitioned else None, dedup=dedup))
+
+    return print_load_summary(service, year, all_stats)
+
+
+def forget_month(service, year, month, file_name):
+    '''Drop a month's rows (see `pg_partitions.drop_month()`) and its manifest entry, so it's loaded again from scratch'''
+    table_name = f'{service}_trip_data'
+    pickup_column = pickup_columns.get(service, 'pickup_datetime')
+    create_manifest(engine)
+    if not table_exists(engine, table_name):
+        return
+
+    ## In one transaction, so a failure leaves the month as it was
+    with engine.begin() as connection:
+        drop_month(connection, table_name, pickup_column, f'{year}-{month}')
+        forget_file(connection, file_name)
+
+
+def web_to_pg_bulk(years, service, user, password, host, port, database, load_method='copy', compact=False,
+                   chunksize=None, dedup=False):
+    '''
+    Rebuild `{service}_trip_data` from every month of `years` in bulk mode (see `pg_bulk_load.py`)
+        - All the months are loaded into an UNLOGGED `{service}_trip_data__staging` without
+          indexes, which then gets its indexes, is swapped in for the old table in one
+          transaction and ANALYZEd
+        - The old table stays complete and readable until the swap
+        - The load manifest is rewritten to the loaded files in the same transaction. The bulk
+          load itself isn't resumable though: a failed run starts over with a new staging table.
+        - With `dedup=True`, duplicate rows are deleted from the staging table before the swap and
+          the new table gets the unique `unique_row_id` index `web_to_pg(..., dedup=True)` loads against
+    '''
+    load_zones()
+    create_manifest(engine)
+
+    table_name = f'{service}_trip_data'
+    staging = staging_table_name(table_name)
+    ## A failed earlier run can leave its staging table behind
+    drop_table(engine, staging)
+
+    all_stats = []
+    for year in years:
+        year_stats = []
+        for i in range(1, 13):
+            taxi_file = download_month(year, service, f'{i:02d}')
+            year_stats.append(load_chunks(iter_clean_chunks(taxi_file, service, chunksize, compact), service,
+                                          taxi_file.name, load_method, content_hash=file_md5(taxi_file),
+                                          resumable=False, table_name=staging, unlogged=True, dedup=dedup))
+        print_load_summary(service, year, year_stats)
+        all_stats += year_stats
+
+    if dedup:
+        delete_duplicates(engine, staging)
+    swap_in_staging(engine, table_name, indexes=trip_indexes(service),
+                    unique_indexes={unique_row_id_column: [unique_row_id_column]} if dedup else None,
+                    on_swap=partial(replace_table_files, table_name=table_name, files=all_stats))
+
+    return sum(stats['rows'] for stats in all_stats)
+
+
+def read_and_clean(month, taxi_file, service, compact=False, chunksize=None, spill_dir=None):
+    '''
+    Parse a monthly CSV in chunks and clean each chunk (runs in a worker process)
+        - Each cleaned chunk is pickled to its own file in a temp dir under `spill_dir` as soon as
+          it's cleaned, so the worker only holds one chunk at a time and only the paths are sent
+          back to the parent (`iter_spilled_chunks()` reads them back one at a time)
+        - Adaptive chunk sizes only see the parse/clean time here, since the load happens later
+    '''
+    month_dir = tempfile.mkdtemp(prefix=f'{service}_{month}_', dir=spill_dir)
+    paths = []
+    try:
+        for df in iter_clean_chunks(taxi_file, service, chunksize, compact):
+            path = os.path.join(month_dir, f'chunk_{len(paths):05d}.pkl')
+            ## Pickles keep every dtype (Int64, Arrow-backed, datetime64[us], ...) exactly as cleaned
+            df.to_pickle(path)
+            paths.append(path)
+    except BaseException:
+        shutil.rmtree(month_dir, ignore_errors=True)
+        raise
+
+    return month_dir, paths
+
+
+def iter_spilled_chunks(spilled):
+    '''The chunks `read_and_clean()` spilled to disk, deleting each file once it's read (and the dir at the end)'''
+    month_dir, paths = spilled
+    try:
+        for path in paths:
+            df = pd.read_pickle(path)
+            os.remove(path)
+            yield df
+    finally:
+        ## Also when the month is skipped (`load_chunks()` closes the generator) or its load fails
+        shutil.rmtree(month_dir, ignore_errors=True)
+
+
+def web_to_pg_parallel(year, service, user, password, host, port, database, load_method='copy',
+                       download_workers=4, transform_workers=2, load_workers=2, max_in_flight=4, compact=False,
+                       chunksize=None, dedup=False, spill_dir=None):
+    '''
+    Same as `web_to_pg()`, but downloads, parses/cleans and loads different months at the same time
+        - `load_workers` is the number of DB connections used at once, so keep it <= the engine's pool size
+        - The cleaned months are handed from the parse/clean workers to the loaders as chunk files
+          under `spill_dir` (the system temp dir by default), so each worker and loader only holds
+          one chunk in memory at a time. `max_in_flight` caps how many cleaned months are on disk
+          at once, and `compact=True` about halves the size of their chunks.
+    '''
+    load_zones()
+
+    def load(month, spilled):
+        return load_chunks(iter_spilled_chunks(spilled), service, f'{service}_tripdata_{year}-{month}.csv.gz',
+                           load_method, dedup=dedup)
+
+    ## Only download/parse the months an earlier run didn't load completely
+    months = [f'{i:02d}' for i in range(1, 13)]
+    loaded = [month for month in months if is_complete(engine, f'{service}_tripdata_{year}-{month}.csv.gz')]
+    all_stats = [load_chunks(iter([]), service, f'{service}_tripdata_{year}-{month}.csv.gz', load_method)
+                 for month in loaded]
+    all_stats += run_months([month for month in months if month not in loaded],
+                            download=partial(download_month, year, service, pin=True),
+                            transform=partial(read_and_clean, service=service, compact=compact, chunksize=chunksize,
+                                              spill_dir=spill_dir),
+                            load=load,
+                            download_workers=download_workers,
+                            transform_workers=transform_workers,
+                            load_workers=load_workers,
+                            max_in_flight=max_in_flight,
+                            release=get_cache().release)
+    all_stats.sort(key=lambda stats: stats['file_name'])
+
+    return print_load_summary(service, year, all_stats)
+
+
+def web_to_pg_streaming(year, service, user, password, host, port, database, load_method='copy', queue_depth=4,
+                        compact=False, dedup=False, chunksize=None):
+    '''
+    Same as `web_to_pg()`, but starts loading each month while its .csv.gz is still downloading
+        - download -> gunzip -> parse/clean -> load all run at once, handing data along bounded queues,
+          so at most ~`queue_depth` chunks per stage are held in memory
+        - The chunks are sized adaptively by default (see `adaptive_chunks.py`), or pass a fixed `chunksize`
+        - Nothing is written to ./data/ for the trip files
+    '''
+    load_zones()
+
+    ## Keep track of each file's rows to compare with GCS
+    all_stats = []
 
-        ## Clean the data and fix the data types
-        df = clean_data(df, service)
-
-        ## If table doesn't already exist, create it via the headers of the dataframe
-        taxi_cur = conn.cursor()
-        taxi_cur.execute(f"select * from information_schema.tables where table_name = '{service}_trip_data'")
-        taxi_table_exists = bool(taxi_cur.rowcount)
-
-        if taxi_table_exists == False:
-            ## Get the header (column) names
-            header = df.head(n=0)
-            # print(header)
-
-            ## Add the column headers to the table in the database connection, 
-            ##  and replace the table if it exists (ONLY FOR MONTH 1/JANUARY)
-            print(f'Creating the {service} trip data table with DataFrame headers...')
-            header.to_sql(name=f'{service}_trip_data', con=engine, if_exists='replace')        
-
-        start = time.time()
-        start_datetime = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start))
-
-        ## Add (append) first chunk of data to the table and time how long it takes
-        print('\nLoading in taxi data in chunks...')
-        print(f'Uploading {file_name} to Postgres starting at {start_datetime}...')
-        # print(f'Number of rows: {len(df.index)}')
-        print(f'Adding {df.shape[0]} rows...')
-        total_rows += df.shape[0]
-
-        start = time.time()
-        df.to_sql(f'{service}_trip_data',  con=engine, if_exists='append')
-        end = time.time()
-        print("Time to insert first chunk: in %.3f seconds." % (end - start))
-
-        def load_chunks(df, total_rows):
-            try:
-                print('Loading next chunk...')
-                start = time.time()
-
-                ## Get next chunk
-                df = next(df_iter)
-
-                # print(f'Adding {df.shape[0]} rows...')
-                # total_rows += df.shape[0]
-
-                ## Clean the data and fix the data types
-                df = clean_data(df, service)
-                    
-                ## Add chunk
-                df.to_sql(name=f'{service}_trip_data', con=engine, if_exists='append')
-
-                end = time.time()
-
-                print('Inserted another of ' + file_name +  ' chunk in %.3f seconds.' % (end - start))
-
-            except:
-                ## Will come to this clause when we throw an error after running out of data chunks
-                print('All data chunks loaded.')
-                
-                ## Don't know why I have to return something here or else code enters
-                ##      infinite loop
-                return total_rows
-
-            # except:
-            #     ## Program will come to this clause when it throws an error after
-            #     ##   running out of data chunks
-            #     print("All data chunks loaded.")
-
-            #     return()
-
-            #     # ## Exit with code of 1 (an error occured)
-            #     # ## NOTE: quit() is only intended to work in the interactive Python shell
-            #     # sys.exit(1)
-
-
-        ## Insert the rest of the chunks until loop breaks when all data is added
-        while True:
-            if load_chunks(df, total_rows):
-                break
-            else:
-                continue
+    for i in range(1, 13):
+        month = f'{i:02d}'
+        file_name = f'{service}_tripdata_{year}-{month}.csv.gz'
+        request_url = f'{init_url}{service}/{file_name}'
+
+        chunks = stream_csv_chunks(request_url,
+                                   chunksize=chunksize,
+                                   queue_depth=queue_depth,
+                                   transform=partial(clean_data, service=service, compact=compact),
+                                   **read_csv_kwargs(service, compact))
+        all_stats.append(load_chunks(chunks, service, file_name, load_method, dedup=dedup))
+
+    return print_load_summary(service, year, all_stats)
 
-    print(f'Total rows for {service} in {year}: {total_rows}')
 
 if __name__ == '__main__':
     user = 'root'  # admin@admin.com
@@ -400,7 +498,25 @@ if __name__ == '__main__':
     port = '5432'
     database = 'ny_taxi'
 
-    engine = create_pg_engine(user, password, host, port, database)
+    ## One pooled engine for every function and worker thread below
+    ##  - `pool_size` must be >= the `load_workers` of the parallel loaders
+    engine = get_pg_engine(user, password, host, port, database, pool_size=4)
+
+    ## NOTE: Chunks are loaded via COPY FROM STDIN by default, pass `load_method='insert'`
+    ##  to compare the rows/sec against plain `to_sql()`
+    ## NOTE: `web_to_pg_parallel()` takes the same arguments (plus worker counts) and loads
+    ##  several months at once
+    ## NOTE: `web_to_pg_streaming()` takes the same arguments and loads each month while
+    ##  it's still downloading, without saving the .csv.gz to disk
+    ## NOTE: `web_to_pg(..., partitioned=True)` loads into a table partitioned by pickup month, where
+    ##  `reload_months=['03']` reloads a month by dropping its partition instead of a big DELETE
+    ## NOTE: `web_to_pg_bulk(['2019', '2020'], 'yellow', ...)` rebuilds a whole table through an
+    ##  UNLOGGED staging table without indexes, and swaps it in atomically at the end
+    ## NOTE: The chunks of each file are sized from their measured rows/sec and memory (and the
+    ##  sizes chosen are printed), pass e.g. `chunksize=100000` for fixed-size chunks instead
+    ## NOTE: `compact=True` holds each chunk in about half the memory (see benchmark_compact_dtypes.py)
+    ## NOTE: `dedup=True` hashes every row into a `unique_row_id` and skips rows that are already in the
+    ##  table, so loading a file twice adds nothing (build the table with `web_to_pg_bulk(..., dedup=True)`)
 
     ## Green should end up with 7778101 rows total
     # web_to_pg('2019', 'green', user, password,
@@ -418,4 +534,5 @@ if __name__ == '__main__':
     # web_to_pg('2019', 'fhv', user, password,
     #           host, port, database)
 
-    remove_files()
+    ## The downloaded files stay in ./data/cache/ (least recently used first out) for the next run
+    get_cache().report()
@@ -1,10 +1,6 @@
 import sys
-import requests
 import pandas as pd
-# For removing files from a directory
-import os
 # import shutil
-from sqlalchemy import create_engine
 import time
 # For checking if file exists
 from pathlib import Path
@@ -14,6 +10,23 @@ import time
 import pyarrow as pa
 import pyarrow.parquet as pq
 import pyarrow.compute as pc
+# For the shared per-service schema and clean_data()
+from taxi_schema import clean_data
+# For downloading each file once and keeping it in a size-capped local cache
+from download_cache import get_cache
+# For bulk loading via COPY FROM STDIN
+from pg_bulk_load import load_chunk, copy_from_arrow, append_chunk, append_batch, replace_table
+# For skipping files that are already loaded and resuming partial loads
+from load_manifest import is_complete, begin_file, pending_rows, commit_chunk, finish_file, \
+    file_md5, df_hash, batch_hash
+# For streaming Parquet files as Arrow record batches
+from arrow_stream import iter_clean_batches
+# For the shared, pooled engine
+from pg_engine import get_pg_engine
+# For loading several months at once
+import threading
+from functools import partial
+from parallel_ingest import run_months
 
 """
 Pre-reqs: 
@@ -26,130 +39,76 @@ Pre-reqs:
 init_url = 'https://d37ci6vzurychx.cloudfront.net/trip-data'
 
 
-def create_pg_engine(user, password, host, port, database):
-    ## Upload CSV to Postgres
-    print("Creating the engine...")
-    ## Need to convert a DDL statement into something Postgres will understand
-    ##   - via create_engine([database_type]://[user]:[password]@[hostname]:[port]/[database], con=[engine])
-    ## https://stackoverflow.com/questions/9298296/sqlalchemy-support-of-postgres-schemas/49930672#49930672
-    dbschema = 'dev'
-    engine = create_engine(f'postgresql://{user}:{password}@{host}:{port}/{database}',
-                            connect_args={'options': '-csearch_path={}'.format(dbschema)}
-                        )
-
-    return engine
-
-
-def remove_files():
-    print("Removing files...")
-    ## https://stackoverflow.com/questions/32834731/how-to-delete-a-file-by-extension-in-python
-    dir_name = "./data"
-    local_data = os.listdir(dir_name)
-
-    ## Remove the local compressed and uncompressed CSV's
-    for item in local_data:
-        if item.endswith(".csv.gz"):
-            os.remove(os.path.join(dir_name, item))
-        elif item.endswith(".csv"):
-            os.remove(os.path.join(dir_name, item))
-
-    # ## Remove all other the local files in the "data" directory
-    # ## https://stackoverflow.com/questions/48892772/how-to-remove-a-directory-is-os-removedirs-and-os-rmdir-only-used-to-delete-emp
-    # shutil.rmtree("./data/")
-
-
-def clean_data(df, service):
-    '''Fix datatype issues'''
-
-    if service == 'yellow':
-        ## Rename columns
-        df.rename({'VendorID':'vendor_id',
-                   'PULocationID':'pu_location_id',
-                   'DOLocationID':'do_location_id',
-                   'RatecodeID':'rate_code_id'
-                }, 
-            axis='columns', inplace=True
-        )
-                
-        ## Fix datetimes
-        df.tpep_pickup_datetime = pd.to_datetime(df.tpep_pickup_datetime)
-        df.tpep_dropoff_datetime = pd.to_datetime(df.tpep_dropoff_datetime)
-
-        ## Fix fields for files that have NAN values and thus aren't INTs
-        ##   when they should be INTs
-        ## https://pandas.pydata.org/pandas-docs/stable/user_guide/integer_na.html#integer-na
-        df.vendor_id = pd.array(df.vendor_id, dtype=pd.Int64Dtype())
-        df.passenger_count = pd.array(df.passenger_count, dtype=pd.Int64Dtype())
-        df.payment_type = pd.array(df.payment_type, dtype=pd.Int64Dtype())
-        df.rate_code_id = pd.array(df.rate_code_id, dtype=pd.Int64Dtype())
-
-        ## Replace payment_type of 0 or NULL with correct voided value of 6, according to data dictionary
-        ## https://www.nyc.gov/assets/tlc/downloads/pdf/data_dictionary_trip_records_green.pdf
-        ## https://stackoverflow.com/questions/31511997/pandas-dataframe-replace-all-values-in-a-column-based-on-condition
-        df.loc[df['payment_type'] == 0, 'payment_type'] = 6        
-
-    elif service == 'green':
-        ## Rename columns
-        df.rename({'VendorID':'vendor_id',
-                   'PULocationID':'pu_location_id',
-                   'DOLocationID':'do_location_id',
-                   'RatecodeID':'rate_code_id'
-                }, 
-            axis='columns', inplace=True
-        )
-                
-        ## Fix datetimes
-        df.lpep_pickup_datetime = pd.to_datetime(df.lpep_pickup_datetime)
-        df.lpep_dropoff_datetime = pd.to_datetime(df.lpep_dropoff_datetime)
-
-        ## Fix fields for files that have NAN values and thus aren't INTs
-        ##   when they should be INTs
-        ## https://pandas.pydata.org/pandas-docs/stable/user_guide/integer_na.html#integer-na
-        df.vendor_id = pd.array(df.vendor_id, dtype=pd.Int64Dtype())
-        df.passenger_count = pd.array(df.passenger_count, dtype=pd.Int64Dtype())
-        df.payment_type = pd.array(df.payment_type, dtype=pd.Int64Dtype())
-        df.trip_type = pd.array(df.trip_type, dtype=pd.Int64Dtype())
-        df.rate_code_id = pd.array(df.rate_code_id, dtype=pd.Int64Dtype())
-
-        ## Replace payment_type of 0 or NULL with correct voided value of 6, according to data dictionary
-        ## https://www.nyc.gov/assets/tlc/downloads/pdf/data_dictionary_trip_records_green.pdf
-        ## https://stackoverflow.com/questions/31511997/pandas-dataframe-replace-all-values-in-a-column-based-on-condition
-        # df.loc[df['payment_type'] == 0, 'payment_type'] = 6
-        df.loc[df['payment_type'].isnull() == True, 'payment_type'] = 6
-        # print(df.payment_type.unique())
-
-    # elif service == 'fhv':
+def load_zones():
+    '''Download the zones CSV if needed and (re)create the zones table'''
+    ## Download zones data (unless it's in the download cache already)
+    zones_url = 'https://github.com/DataTalksClub/nyc-tlc-data/releases/download/misc/taxi_zone_lookup.csv'
+    zones_csv_name = get_cache().get(zones_url)
+
+    ## Add in the smaller taxi zones table first before the long loop for the taxi data
+    print("\nLoading in zone data...")
+    df_zones = pd.read_csv(zones_csv_name)
+    ## Swapped in with its primary key in one transaction, so readers never see it half loaded
+    replace_table(df_zones, 'zones', engine, primary_key=['LocationID'])
+    print("Loaded in zone data")
+
+
+def download_month(year, service, month, pin=False):
+    '''
+    Download a monthly Parquet file into the download cache if it isn't cached yet, and return its path
+        - `pin=True` keeps it from being evicted until it's released (see `download_cache.py`)
+    '''
+    ## Create file_name to download
+    file_name = f'{service}_tripdata_{year}-{month}.parquet'
+
+    ## Stream the file to disk if it's not in the cache (resuming a partial download from an earlier run)
+    request_url = f"{init_url}/{file_name}"
+    path = Path(get_cache().get(request_url, pin=pin)).as_posix()
+
+    return path
+
+
+def read_and_clean(month, path, service):
+    '''Read a monthly Parquet file into a cleaned DataFrame (runs in a worker process when parallel)'''
+    ## Use `pyarrow` to read the table
+    # df = pd.read_parquet(path)
+    table = pq.read_table(path)
+
+    ## Convert to pandas DataFrame
+    ## NOTE: one FHV file has an out-of-bounds timestamp
+    ## https://stackoverflow.com/questions/74467923/pandas-read-parquet-error-pyarrow-lib-arrowinvalid-casting-from-timestampus
+    if service == 'fhv':
+        df = table.filter(
+            pc.less_equal(table["dropOff_datetime"], pa.scalar(pd.Timestamp.max))
+        ).to_pandas()
     else:
-        ## Rename columns
-        df.rename({'dropOff_datetime':'dropoff_datetime',
-                   'PUlocationID':'pu_location_id',
-                   'DOlocationID':'do_location_id',
-                   'SR_Flag':'sr_flag',
-                   'Affiliated_base_number':'affiliated_base_number'
-                },
-            axis='columns', inplace=True
-        )
+        df = table.to_pandas()
 
-        ## Fix datetimes
-        df.pickup_datetime = pd.to_datetime(df.pickup_datetime)
-        df.dropoff_datetime = pd.to_datetime(df.dropoff_datetime)
+    ## Clean the data and fix the data types
+    return clean_data(df, service)
 
-        ## Fix fields for files that have NAN values and thus aren't INTs
-        ##   when they should be INTs
-        ## https://pandas.pydata.org/pandas-docs/stable/user_guide/integer_na.html#integer-na
-        df.pu_location_id = pd.array(df.pu_location_id, dtype=pd.Int64Dtype())
-        df.do_location_id = pd.array(df.do_location_id, dtype=pd.Int64Dtype())
 
-        ## Fix a DOUBLE that may be trying to be forced into an INT
-        df.sr_flag = pd.array(df.sr_flag, dtype=pd.Int64Dtype())
+def load_month_once(df, file_name, content_hash, table_name, load_method='copy'):
+    '''
+    Load a whole (cleaned) month as one chunk, committed together with its `load_manifest` entry,
+        so rerunning the loader doesn't load it twice
+    '''
+    manifest = begin_file(engine, file_name, table_name, content_hash)
+    if not manifest['complete']:
+        committed = pending_rows(manifest, len(df.index))
+        if committed < len(df.index):
+            df = df.iloc[committed:]
+            commit_chunk(manifest, engine, partial(append_chunk, df, table_name, load_method=load_method),
+                         len(df.index), df_hash(df))
+        finish_file(manifest, engine)
 
-    return df
 
-
-def web_to_pg(year, service):
+def web_to_pg(year, service, load_method='copy', resumable=True):
     ## Keep track of total rows to compare with GCS
     total_rows = 0
 
+    load_zones()
+
     ## Loop through the months
     for i in range(1, 13):
     # for i in range(3):
@@ -163,68 +122,132 @@ def web_to_pg(year, service):
             month = (i)
         # print(month)
 
-        ## Create file_name to download
+        ## Skip months an earlier run already loaded (per the load manifest)
         file_name = f'{service}_tripdata_{year}-{month}.parquet'
+        if resumable and is_complete(engine, file_name):
+            print(f'\nSkipping {file_name}, it is already loaded')
+            continue
 
-        ## Create the path to write the eventual file to
-        path = Path(f'./data/{file_name}').as_posix()
-
-        ## Make the directory to hold the parquet file if it doesn't exist
-        os.makedirs(os.path.dirname(path), exist_ok=True)
-
-        ## Download zones data
-        zones_url = 'https://github.com/DataTalksClub/nyc-tlc-data/releases/download/misc/taxi_zone_lookup.csv'
-        zones_csv_name = "./data/taxi_zone_lookup.csv"
-        zones_file = Path(zones_csv_name)
-
-        ## If the file is not already downloaded/does not exist, download it
-        if not zones_file.is_file():
-            print("\nDownloading the taxi zone data...")
-            os.system(f"wget {zones_url} -O {zones_csv_name}")  # -O = output to the given file name        
-
-        ## Add in the smaller taxi zones table first before the long loop for the taxi data
-        print("\nLoading in zone data...")
-        df_zones = pd.read_csv(zones_csv_name)
-        df_zones.to_sql(name='zones', con=engine, if_exists="replace")
-        print("Loaded in zone data")
-
-        ## Download taxi CSV using `requests`
-        print(f'\nDownloading {file_name}...')
-        request_url = f"{init_url}/{file_name}"
-        r = requests.get(request_url)
-        open(file_name, 'wb').write(r.content)
-        
-        ## Use `pyarrow` to read the table
-        print(f'Saving {file_name} to {path}...')
-        # df = pd.read_parquet(file_name)
-        table = pq.read_table(file_name)
-
-        ## Convert to pandas DataFrame
-        ## NOTE: one FHV file has an out-of-bounds timestamp
-        ## https://stackoverflow.com/questions/74467923/pandas-read-parquet-error-pyarrow-lib-arrowinvalid-casting-from-timestampus
-        if service == 'fhv':
-            df = table.filter(
-                pc.less_equal(table["dropOff_datetime"], pa.scalar(pd.Timestamp.max))
-            ).to_pandas()
-        else:
-            df = table.to_pandas()
+        path = download_month(year, service, month)
+
+        ## Read and clean the data
+        df = read_and_clean(month, path, service)
 
         ## Add to total number of rows
         print(f'Number of rows: {len(df.index)}')
         total_rows += len(df.index)
 
-        ## Clean the data and fix the data types
-        df = clean_data(df, service)
-
-        ## Add data
+        ## Add data, via COPY FROM STDIN by default or `load_method='insert'` to use `to_sql()`
         print(f'Uploading {file_name} to Postgres...')        
         start = time.time()
-        df.to_sql(name=f'{service}_trip_data', con=engine, if_exists='append')
+        if resumable:
+            load_month_once(df, file_name, file_md5(path), f'{service}_trip_data', load_method)
+        else:
+            load_chunk(df, f'{service}_trip_data', engine, load_method)
         end = time.time()
         print(f'Time to insert {file_name}: %.3f seconds.' % (end - start))
 
     print(f'Total rows for {service} in {year}: {total_rows}')        
 
+
+def web_to_pg_parallel(year, service, load_method='copy', resumable=True,
+                       download_workers=4, transform_workers=2, load_workers=2, max_in_flight=3):
+    '''
+    Same as `web_to_pg()`, but downloads, reads/cleans and loads different months at the same time
+        - `load_workers` is the number of DB connections used at once, so keep it <= the engine's pool size
+        - `max_in_flight` caps how many (whole, cleaned) months are held in memory at once
+    '''
+    load_zones()
+
+    table_name = f'{service}_trip_data'
+    ## Only let one loader thread create the table from the DataFrame headers
+    create_table_lock = threading.Lock()
+
+    def load(month, df):
+        with create_table_lock:
+            df.head(n=0).to_sql(name=table_name, con=engine, if_exists='append')
+
+        file_name = f'{service}_tripdata_{year}-{month}.parquet'
+        print(f'Uploading {file_name} to Postgres...')
+        if resumable:
+            ## The cached file's path isn't passed along to here, so there's no MD5 to compare
+            load_month_once(df, file_name, None, table_name, load_method)
+        else:
+            load_chunk(df, table_name, engine, load_method)
+
+        return len(df.index)
+
+    ## Skip months an earlier run already loaded (per the load manifest)
+    months = [f'{i:02d}' for i in range(1, 13)]
+    if resumable:
+        months = [month for month in months if not is_complete(engine, f'{service}_tripdata_{year}-{month}.parquet')]
+    month_rows = run_months(months,
+                            download=partial(download_month, year, service, pin=True),
+                            transform=partial(read_and_clean, service=service),
+                            load=load,
+                            download_workers=download_workers,
+                            transform_workers=transform_workers,
+                            load_workers=load_workers,
+                            max_in_flight=max_in_flight,
+                            release=get_cache().release)
+
+    for month, rows in zip(months, month_rows):
+        print(f'{service}_tripdata_{year}-{month}.parquet: {rows} rows')
+    print(f'Total rows for {service} in {year}: {sum(month_rows)}')
+
+
+def web_to_pg_arrow(year, service, batch_size=100000, resumable=True):
+    '''
+    Same as `web_to_pg()`, but streams each file as Arrow record batches straight into Postgres via COPY
+        - The data is never converted to pandas, so memory stays at about one `batch_size` batch
+        - With `resumable=True`, each batch is committed with its `load_manifest` entry, and a rerun
+          skips loaded files and resumes partial ones after their last committed batch
+    '''
+    ## Keep track of total rows to compare with GCS
+    total_rows = 0
+    table_name = f'{service}_trip_data'
+
+    load_zones()
+
+    for i in range(1, 13):
+        month = f'{i:02d}'
+        file_name = f'{service}_tripdata_{year}-{month}.parquet'
+        if resumable and is_complete(engine, file_name):
+            print(f'\nSkipping {file_name}, it is already loaded')
+            continue
+
+        path = download_month(year, service, month)
+        manifest = begin_file(engine, file_name, table_name, file_md5(path)) if resumable else None
+
+        print(f'Uploading {file_name} to Postgres in batches of {batch_size} rows...')
+        start = time.time()
+        file_rows = 0
+        for batch in iter_clean_batches(path, service, batch_size=batch_size):
+            if manifest is not None:
+                ## Skip the rows an earlier run already committed
+                batch = batch.slice(pending_rows(manifest, batch.num_rows))
+                if batch.num_rows == 0:
+                    continue
+            batch_start = time.time()
+            if manifest is not None:
+                commit_chunk(manifest, engine, partial(append_batch, batch, table_name),
+                             batch.num_rows, batch_hash(batch))
+            else:
+                copy_from_arrow(batch, table_name, engine)
+            batch_end = time.time()
+            print(f'Inserted {batch.num_rows} rows via copy in %.3f seconds (%.0f rows/sec).'
+                  % (batch_end - batch_start, batch.num_rows / max(batch_end - batch_start, 1e-9)))
+            file_rows += batch.num_rows
+        if manifest is not None:
+            finish_file(manifest, engine)
+        end = time.time()
+
+        print(f'Time to insert {file_rows} rows from {file_name}: %.3f seconds.' % (end - start))
+        total_rows += file_rows
+
+    print(f'Total rows for {service} in {year}: {total_rows}')
+
+
 if __name__ == '__main__':
     user = "root"  # admin@admin.com
     password = "root"
@@ -232,7 +255,9 @@ if __name__ == '__main__':
     port = "5432"
     database = "ny_taxi"
 
-    engine = create_pg_engine(user, password, host, port, database)
+    ## One pooled engine for every function and worker thread below, loading into the dev schema
+    ##  - `pool_size` must be >= the `load_workers` of `web_to_pg_parallel()`
+    engine = get_pg_engine(user, password, host, port, database, schema='dev', pool_size=4)
 
     # web_to_pg('2019', 'green')
     # web_to_pg('2020', 'green')
@@ -240,5 +265,12 @@ if __name__ == '__main__':
     web_to_pg('2020', 'yellow')
     # web_to_pg('2019', 'fhv')
 
-    remove_files()
+    ## Or stream each file into Postgres as Arrow record batches, without pandas
+    # web_to_pg_arrow('2019', 'yellow', batch_size=100000)
+
+    ## Or load several months at once (same rows as the serial run)
+    # web_to_pg_parallel('2019', 'yellow', download_workers=4, transform_workers=2, load_workers=2)
+
+    ## The downloaded files stay in ./data/cache/ (least recently used first out) for the next run
+    get_cache().report()
 